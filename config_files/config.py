@@ -66,6 +66,14 @@ epsilon_boltzmann_schedule = [
 tau_epsilon_boltzmann = 0.01
 discard_non_greedy_actions_in_nsteps = True
 buffer_test_ratio = 0.05
+# If fixed_test_set_size > 0, loss_test is measured on a fixed set of transitions sampled from the test buffer and kept on the GPU,
+# every fixed_test_set_eval_every_n_batches training batches, instead of on random batches of the test buffer. The set is evaluated in
+# chunks of fixed_test_set_chunk_size transitions without gradients, and sampled again every fixed_test_set_refresh_every_n_evals
+# evaluations. fixed_test_set_size should be a multiple of fixed_test_set_chunk_size.
+fixed_test_set_size = 0
+fixed_test_set_chunk_size = 2048
+fixed_test_set_eval_every_n_batches = 50
+fixed_test_set_refresh_every_n_evals = 20
 
 engineered_speedslide_reward_schedule = [
     (0, 0),
@@ -92,14 +100,79 @@ iqn_embedding_dimension = 64
 iqn_n = 8  # must be an even number because we sample tau symmetrically around 0.5
 iqn_k = 32  # must be an even number because we sample tau symmetrically around 0.5
 iqn_kappa = 5e-3
+# Number of quantiles of the online network's outputs processed at once by the IQN loss. Lower values reduce the memory used by the loss
+# when iqn_n or batch_size are large. None to process all quantiles at once.
+iqn_loss_chunk_size = None
 use_ddqn = False
+# With use_ddqn, evaluate the next states with the target and online networks in one batched computation (torch.func.vmap over their
+# stacked parameters) instead of two forward passes. Only supported on Linux, where the networks are compiled with torch.compile.
+stacked_ddqn_next_state_evaluation = False
 
 prio_alpha = np.float32(0)  # Rainbow-IQN paper: 0.2, Rainbow paper: 0.5, PER paper 0.6
 prio_epsilon = np.float32(2e-3)  # Defaults to 10^-6 in stable-baselines
 prio_beta = np.float32(1)
+# Priorities computed by each batch are queued on the GPU, and applied to the replay buffer in bulk every priority_update_every_n_batches
+# batches, such that the learner does not wait for them. Meanwhile, batches are sampled with the previous priorities of these transitions.
+priority_update_every_n_batches = 1
 
 number_times_single_memory_is_used_before_discard = 32  # 32 // 4
 
+# If True, frames are stored once in a pool shared by state_img and next_state_img, instead of once per transition and per field.
+# This roughly halves the memory used by the replay buffer.
+deduplicate_frames_in_buffer = True
+# If True, the replay buffer stores whole rollouts frame by frame, and builds n-step transitions (rewards, gammas, next states) when
+# they are sampled. This uses less memory per transition, and changes of the reward schedules or gamma apply to the whole buffer at once.
+# Takes precedence over deduplicate_frames_in_buffer and compress_frames_in_buffer. Not compatible with buffer_storage_on_device.
+store_trajectories_in_buffer = False
+# If True (and deduplicate_frames_in_buffer is True), frames in the pool are compressed. This fits several times more transitions in the
+# same RAM, at the cost of decoding frames when batches are sampled. Not compatible with buffer_storage_on_device and save_buffer_snapshots.
+compress_frames_in_buffer = False
+buffer_frame_compression_level = 1  # zlib level, from 1 (fastest) to 9 (smallest)
+buffer_frame_codec_threads = 4
+buffer_decoded_frames_cache_size = 1024
+# If True, the replay buffer is stored in memory-mapped files in save/{run_name}/buffer_memmap/ instead of RAM.
+# This allows buffers larger than RAM when save/ is on a fast SSD. Use scripts/tools/benchmark_replay_buffer.py to compare both modes.
+buffer_storage_on_disk = False
+# If True, the replay buffer is stored as tensors on the GPU. Batches are then gathered and prepared without host-to-device copies.
+# The GPU must have enough memory for the whole buffer. Use scripts/tools/benchmark_replay_buffer.py to compare both modes.
+buffer_storage_on_device = False
+# If True, mini-races of batches gathered in host memory are prepared on the GPU, after the gathered rows are copied to it, instead of
+# with numpy before the copy. Batches of buffer_storage_on_device are always prepared on the device. Not used with buffer_sampler_process.
+mini_races_on_device = False
+# If True, the replay buffers are kept in shared memory (multiprocessing.shared_memory) instead of the private memory of the learner.
+# Not compatible with buffer_storage_on_disk, buffer_storage_on_device, store_trajectories_in_buffer and compress_frames_in_buffer.
+buffer_storage_in_shared_memory = False
+# If True (and buffer_storage_in_shared_memory is True), batches of the training buffer are gathered and their mini-races prepared by a
+# dedicated sampler process, n_batches_prefetched batches ahead. n_prefetch_workers is then unused.
+buffer_sampler_process = False
+# Number of threads preparing batches of the training buffer ahead of time, and number of batches prepared in advance.
+# Each prepared batch holds one page-locked staging copy of a batch in host memory.
+n_prefetch_workers = 2
+n_batches_prefetched = 4
+# If True, the replay buffers are saved to save/{run_name}/buffer_snapshot/ every 5 minutes, and reloaded when the learner restarts.
+# Snapshots are incremental and written in the background, but they use as much disk space as the buffers use memory.
+save_buffer_snapshots = False
+# Path of a replay dataset (see scripts/tools/export_replay_dataset.py) whose transitions fill the replay buffers when the learner starts
+# with empty buffers, e.g. to seed a new run with the transitions of a previous run. None to start with empty buffers.
+seed_buffers_from_replay_dataset = None
+# Fraction of the replay buffers reserved for the transitions of each map, e.g. {"map5": 0.3, "A01-Race": 0.2}. Transitions of a map
+# only overwrite older transitions of the same map. The remaining fraction is shared by the other maps. If empty, buffers are not
+# partitioned. Partitioned buffers cannot shrink: memory_size_schedule must be non-decreasing.
+map_buffer_partitions = {}
+# Relative share of each batch drawn from each partition (1 for partitions which are not listed, "other" for the shared partition).
+# If empty, partitions are sampled in proportion to the number of transitions they hold.
+map_buffer_sampling_weights = {}
+# Transitions overwritten by new transitions once the training buffer is full:
+#   - "oldest": the oldest transitions
+#   - "lowest_priority": the transitions with the lowest priority (requires prio_alpha > 0)
+#   - "most_sampled": the transitions sampled the largest number of times
+# With the last two policies, only the oldest buffer_eviction_window_fraction of the buffer can be overwritten. Candidates are chosen
+# by batches of buffer_eviction_candidates_fraction of the buffer. Not compatible with map_buffer_partitions and
+# store_trajectories_in_buffer.
+buffer_eviction_policy = "oldest"
+buffer_eviction_window_fraction = 0.5
+buffer_eviction_candidates_fraction = 0.02
+
 memory_size_schedule = [
     (0, (50_000, 20_000)),
     (5_000_000 * global_schedule_speed, (100_000, 75_000)),
@@ -165,12 +238,23 @@ max_rollout_queue_size = 1
 
 use_jit = True
 
+# Device on which the learner trains ("cuda" or "cpu"), and device on which collectors run inference. On "cpu", mixed precision uses
+# bfloat16 instead of float16, and each process uses the given number of threads. With device = "cpu", buffer_storage_on_device keeps
+# the replay buffers as tensors in RAM.
+device = "cuda"
+collector_device = device
+learner_cpu_threads = 8
+collector_cpu_threads = 1
+
 # gpu_collectors_count is the number of Trackmania instances that will be launched in parallel.
 # It is recommended that users adjust this number depending on the performance of their machine.
 # We recommend trying different values and finding the one that maximises the number of batches done per unit of time.
 gpu_collectors_count = 2
 
 send_shared_network_every_n_batches = 10
+# Store the parameters of each network in one flat contiguous buffer. Soft target updates and weight decay then run as a single
+# operation on that buffer, and weights are published to collectors with a single copy.
+flat_network_parameters = False
 update_inference_network_every_n_actions = 20
 
 target_self_loss_clamp_ratio = 4
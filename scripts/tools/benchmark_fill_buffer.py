@@ -0,0 +1,248 @@
+"""
+This script measures the time taken by trackmania_rl.buffer_management.fill_buffer_from_rollout_with_n_steps_rule() to convert a
+rollout into transitions, and compares it to the previous implementation which looped over frames in Python.
+
+Both implementations are run on the same synthetic rollout, and the script checks that they produce identical transitions
+(after conversion to the dtypes used by the replay buffer storage).
+
+The previous implementation multiplies float32 scalars by Python floats, which NumPy 2 computes in float32 instead of float64 (NEP 50).
+The comparison therefore requires the NumPy version of requirements_conda.txt (1.26), with which the previous implementation ran.
+
+This script reads config_files/config_copy.py, which is created when scripts/train.py is launched.
+
+Example:
+    python scripts/tools/benchmark_fill_buffer.py --n-frames 6000
+"""
+import argparse
+import math
+import random
+import time
+
+import numpy as np
+
+from config_files import config_copy
+from trackmania_rl.buffer_management import fill_buffer_from_rollout_with_n_steps_rule
+from trackmania_rl.experience_replay.columnar_storage import experience_fields_dtypes
+from trackmania_rl.experience_replay.experience_replay_interface import Experience, ExperienceBatch
+from trackmania_rl.reward_shaping import speedslide_quality_tarmac
+
+
+class TransitionRecorder:
+    """
+    Stands in for a ReplayBuffer, and records the transitions it receives.
+    """
+
+    def __init__(self):
+        self.experiences = []
+        self._storage = None  # Transitions are recorded as ExperienceBatch, as for a buffer whose storage is not a TrajectoryStorage
+
+    def add(self, experience: Experience) -> None:
+        self.experiences.append(experience)
+
+    def extend(self, batch: ExperienceBatch) -> None:
+        for i in range(len(batch)):
+            self.experiences.append(Experience(*(getattr(batch, field)[i] for field in Experience.__slots__)))
+
+
+def legacy_get_potential(state_float):
+    vector_vcp_to_vcp_further_ahead = state_float[65:68] - state_float[62:65]
+    vector_vcp_to_vcp_further_ahead_normalized = vector_vcp_to_vcp_further_ahead / np.linalg.norm(vector_vcp_to_vcp_further_ahead)
+
+    return (
+        config_copy.shaped_reward_dist_to_cur_vcp
+        * max(
+            config_copy.shaped_reward_min_dist_to_cur_vcp,
+            min(config_copy.shaped_reward_max_dist_to_cur_vcp, np.linalg.norm(state_float[62:65])),
+        )
+    ) + (config_copy.shaped_reward_point_to_vcp_ahead * (vector_vcp_to_vcp_further_ahead_normalized[2] - 1))
+
+
+def legacy_fill_buffer_from_rollout_with_n_steps_rule(
+    buffer,
+    buffer_test,
+    rollout_results,
+    n_steps_max,
+    gamma,
+    discard_non_greedy_actions_in_nsteps,
+    engineered_speedslide_reward,
+    engineered_neoslide_reward,
+    engineered_kamikaze_reward,
+    engineered_close_to_vcp_reward,
+):
+    """
+    Per-frame implementation of fill_buffer_from_rollout_with_n_steps_rule(), kept as a reference.
+    """
+    n_frames = len(rollout_results["frames"])
+
+    number_memories_added_train = 0
+    number_memories_added_test = 0
+    buffer_to_fill = buffer_test if random.random() < config_copy.buffer_test_ratio else buffer
+
+    gammas = (gamma ** np.linspace(1, n_steps_max, n_steps_max)).astype(np.float32)
+
+    reward_into = np.zeros(n_frames)
+    for i in range(1, n_frames):
+        reward_into[i] += config_copy.constant_reward_per_ms * (
+            config_copy.ms_per_action
+            if (i < n_frames - 1 or ("race_time" not in rollout_results))
+            else rollout_results["race_time"] - (n_frames - 2) * config_copy.ms_per_action
+        )
+        reward_into[i] += (
+            rollout_results["meters_advanced_along_centerline"][i] - rollout_results["meters_advanced_along_centerline"][i - 1]
+        ) * config_copy.reward_per_m_advanced_along_centerline
+        if i < n_frames - 1:
+            if rollout_results["state_float"][i][58] > 0:
+                reward_into[i] += config_copy.final_speed_reward_per_m_per_s * (
+                    np.linalg.norm(rollout_results["state_float"][i][56:59]) - np.linalg.norm(rollout_results["state_float"][i - 1][56:59])
+                )
+            if np.all(rollout_results["state_float"][i][25:29]):
+                reward_into[i] += engineered_speedslide_reward * max(
+                    0, 1 - abs(speedslide_quality_tarmac(rollout_results["state_float"][i][56], rollout_results["state_float"][i][58]) - 1)
+                )
+            reward_into[i] += engineered_neoslide_reward if abs(rollout_results["state_float"][i][56]) >= 2.0 else 0
+            if rollout_results["actions"][i] <= 2 or np.sum(rollout_results["state_float"][i][25:29]) <= 1:
+                reward_into[i] += engineered_kamikaze_reward
+
+            reward_into[i] += engineered_close_to_vcp_reward * max(
+                config_copy.engineered_reward_min_dist_to_cur_vcp,
+                min(config_copy.engineered_reward_max_dist_to_cur_vcp, np.linalg.norm(rollout_results["state_float"][i][62:65])),
+            )
+    for i in range(n_frames - 1):
+        if random.random() < 0.1:
+            buffer_to_fill = buffer_test if random.random() < config_copy.buffer_test_ratio else buffer
+
+        n_steps = min(n_steps_max, n_frames - 1 - i)
+        if discard_non_greedy_actions_in_nsteps:
+            try:
+                first_non_greedy = rollout_results["action_was_greedy"][i + 1 : i + n_steps].index(False) + 1
+                n_steps = min(n_steps, first_non_greedy)
+            except ValueError:
+                pass
+
+        rewards = np.empty(n_steps_max).astype(np.float32)
+        for j in range(n_steps):
+            rewards[j] = (gamma**j) * reward_into[i + j + 1] + (rewards[j - 1] if j >= 1 else 0)
+
+        state_img = rollout_results["frames"][i]
+        state_float = rollout_results["state_float"][i]
+        state_potential = legacy_get_potential(rollout_results["state_float"][i])
+
+        action = rollout_results["actions"][i]
+        terminal_actions = float((n_frames - 1) - i) if "race_time" in rollout_results else math.inf
+        next_state_has_passed_finish = ((i + n_steps) == (n_frames - 1)) and ("race_time" in rollout_results)
+
+        if not next_state_has_passed_finish:
+            next_state_img = rollout_results["frames"][i + n_steps]
+            next_state_float = rollout_results["state_float"][i + n_steps]
+            next_state_potential = legacy_get_potential(rollout_results["state_float"][i + n_steps])
+        else:
+            next_state_img = state_img
+            next_state_float = state_float
+            next_state_potential = 0
+
+        buffer_to_fill.add(
+            Experience(
+                state_img,
+                state_float,
+                state_potential,
+                action,
+                n_steps,
+                rewards,
+                next_state_img,
+                next_state_float,
+                next_state_potential,
+                gammas,
+                terminal_actions,
+            ),
+        )
+        if buffer_to_fill is buffer:
+            number_memories_added_train += 1
+        else:
+            number_memories_added_test += 1
+
+    return buffer, buffer_test, number_memories_added_train, number_memories_added_test
+
+
+def make_synthetic_rollout(n_frames: int, race_finished: bool) -> dict:
+    # When the race is finished, the last frame has no state_float and no action, as in GameInstanceManager.rollout()
+    n_frames_with_floats = n_frames - 1 if race_finished else n_frames
+    state_float = np.random.randn(n_frames_with_floats, config_copy.float_input_dim).astype(np.float32)
+    state_float[:, 25:29] = np.random.rand(n_frames_with_floats, 4) < 0.8
+    state_float[:, 56] *= 3
+    state_float[:, 58] = 30 * np.random.rand(n_frames_with_floats) - 5
+    rollout_results = {
+        "frames": [
+            np.random.randint(0, 255, (1, config_copy.H_downsized, config_copy.W_downsized), dtype=np.uint8) for _ in range(n_frames)
+        ],
+        "current_zone_idx": list(range(n_frames)),
+        "state_float": list(state_float),
+        "actions": np.random.randint(0, len(config_copy.inputs), n_frames_with_floats).tolist(),
+        "action_was_greedy": (np.random.rand(n_frames_with_floats) < 0.97).tolist(),
+        "meters_advanced_along_centerline": list(np.cumsum(np.random.rand(n_frames))),
+    }
+    if race_finished:
+        rollout_results["frames"][-1] = np.nan
+        rollout_results["actions"].append(np.nan)
+        rollout_results["action_was_greedy"].append(np.nan)
+        rollout_results["race_time"] = (n_frames - 2) * config_copy.ms_per_action + 17
+    return rollout_results
+
+
+def assert_identical(reference: list, experiences: list) -> None:
+    assert len(reference) == len(experiences)
+    for expected, actual in zip(reference, experiences):
+        for field in Experience.__slots__:
+            expected_value, actual_value = getattr(expected, field), getattr(actual, field)
+            if field.endswith("img"):
+                assert expected_value is actual_value, field
+                continue
+            if field == "rewards":
+                # The legacy implementation leaves rewards[n_steps:] uninitialized
+                expected_value, actual_value = expected_value[: expected.n_steps], actual_value[: actual.n_steps]
+            dtype = experience_fields_dtypes[field]
+            assert np.array_equal(np.asarray(expected_value, dtype=dtype), np.asarray(actual_value, dtype=dtype)), field
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-frames", type=int, default=6000)
+    parser.add_argument("--n-repeats", type=int, default=5)
+    args = parser.parse_args()
+    assert np.lib.NumpyVersion(np.__version__) < "2.0.0", "The previous implementation is only reproduced with NumPy 1.x"
+
+    for race_finished in [False, True]:
+        rollout_results = make_synthetic_rollout(args.n_frames, race_finished)
+        fill_args = (
+            rollout_results,
+            config_copy.n_steps,
+            0.99,
+            config_copy.discard_non_greedy_actions_in_nsteps,
+            -0.1,
+            0.05,
+            -0.02,
+            0.01,
+        )
+        timings = {}
+        recorders = {}
+        for name, fill_function in [
+            ("legacy", legacy_fill_buffer_from_rollout_with_n_steps_rule),
+            ("vectorized", fill_buffer_from_rollout_with_n_steps_rule),
+        ]:
+            timings[name] = math.inf
+            for _ in range(args.n_repeats):
+                recorders[name] = (TransitionRecorder(), TransitionRecorder())
+                random.seed(0)
+                start_time = time.perf_counter()
+                fill_function(*recorders[name], *fill_args)
+                timings[name] = min(timings[name], time.perf_counter() - start_time)
+
+        for legacy_recorder, vectorized_recorder in zip(recorders["legacy"], recorders["vectorized"]):
+            assert_identical(legacy_recorder.experiences, vectorized_recorder.experiences)
+        print(
+            f"{race_finished=!s:<5}  legacy: {1000 * timings['legacy']:7.1f} ms  vectorized: {1000 * timings['vectorized']:7.1f} ms  "
+            f"speedup: x{timings['legacy'] / timings['vectorized']:.1f}  (transitions are identical)"
+        )
+
+
+if __name__ == "__main__":
+    main()
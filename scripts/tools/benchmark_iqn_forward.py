@@ -0,0 +1,99 @@
+"""
+This script measures the step time (forward and backward pass) and the peak activation memory of IQN_Network.forward(), and compares
+them to the previous implementation which repeated the embedding of the states num_quantiles times before mixing it with the embedding
+of the quantiles.
+
+Both implementations are run with the same weights, inputs and quantiles, and the script checks that they return identical Q values.
+Peak memory is only reported on CUDA devices.
+
+This script reads config_files/config_copy.py, which is created when scripts/train.py is launched.
+
+Example:
+    python scripts/tools/benchmark_iqn_forward.py --batch-size 512 --num-quantiles 8
+"""
+import argparse
+import math
+import time
+
+import torch
+
+from config_files import config_copy
+from trackmania_rl import utilities
+from trackmania_rl.agents.iqn import IQN_Network, make_untrained_iqn_network
+
+
+def legacy_forward(network: IQN_Network, img: torch.Tensor, float_inputs: torch.Tensor, num_quantiles: int, tau: torch.Tensor):
+    img_outputs = network.img_head(img)
+    float_outputs = network.float_feature_extractor((float_inputs - network.float_inputs_mean) / network.float_inputs_std)
+    concat = torch.cat((img_outputs, float_outputs), 1)
+    quantile_net = torch.cos(torch.arange(1, network.iqn_embedding_dimension + 1, 1, device=img.device) * math.pi * tau)
+    quantile_net = network.iqn_fc(quantile_net)
+    concat = concat.repeat(num_quantiles, 1)
+    concat = concat * quantile_net
+    A = network.A_head(concat)
+    V = network.V_head(concat)
+    Q = V + A - A.mean(dim=-1).unsqueeze(-1)
+    return Q, tau
+
+
+def measure(forward, inputs: tuple, n_repeats: int, device: str) -> tuple[float, int]:
+    """
+    Returns the fastest step time in seconds, and the peak memory allocated during a step in bytes (0 on CPU).
+    """
+    best_time = math.inf
+    peak_memory = 0
+    for _ in range(n_repeats):
+        if device == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            memory_before = torch.cuda.memory_allocated()
+        start_time = time.perf_counter()
+        with utilities.autocast(device):
+            Q, _ = forward(*inputs)
+        Q.float().sum().backward()
+        if device == "cuda":
+            torch.cuda.synchronize()
+            peak_memory = max(peak_memory, torch.cuda.max_memory_allocated() - memory_before)
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return best_time, peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default=config_copy.device)
+    parser.add_argument("--batch-size", type=int, default=config_copy.batch_size)
+    parser.add_argument("--num-quantiles", type=int, default=config_copy.iqn_n)
+    parser.add_argument("--n-repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    _, network = make_untrained_iqn_network(jit=False, device=args.device)
+    img = torch.randn(
+        (args.batch_size, 1, config_copy.H_downsized, config_copy.W_downsized), device=args.device
+    ).to(memory_format=torch.channels_last)
+    float_inputs = torch.randn((args.batch_size, config_copy.float_input_dim), device=args.device)
+    tau = torch.rand((args.batch_size * args.num_quantiles, 1), device=args.device)
+
+    with torch.no_grad(), utilities.autocast(args.device):
+        legacy_Q, _ = legacy_forward(network, img, float_inputs, args.num_quantiles, tau)
+        Q, _ = network(img, float_inputs, args.num_quantiles, tau)
+    assert torch.equal(legacy_Q, Q), "The Q values differ"
+
+    inputs = (img, float_inputs, args.num_quantiles, tau)
+    results = {}
+    for name, forward in [
+        ("legacy", lambda *forward_inputs: legacy_forward(network, *forward_inputs)),
+        ("broadcast", network),
+    ]:
+        measure(forward, inputs, 3, args.device)  # Warm-up
+        network.zero_grad(set_to_none=True)
+        results[name] = measure(forward, inputs, args.n_repeats, args.device)
+        network.zero_grad(set_to_none=True)
+
+    for name, (step_time, peak_memory) in results.items():
+        print(f"{name:<9}  step: {1000 * step_time:7.2f} ms  peak memory: {peak_memory / 2**20:8.1f} MiB")
+    print(f"speedup: x{results['legacy'][0] / results['broadcast'][0]:.2f}  (Q values are identical)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+This script measures the time (forward and backward pass) and the peak memory of trackmania_rl.agents.iqn.fused_iqn_loss(), and compares
+them to the previous implementation which called iqn_loss() twice: once for the loss, once for the target self-loss.
+
+Both implementations are run on the same synthetic targets, outputs and quantiles, and the script checks that they return the same
+losses and the same gradients with regard to outputs (up to float32 rounding). Peak memory is only reported on CUDA devices.
+Consecutive training steps with the fused loss are checked by scripts/tools/check_train_on_batch.py.
+
+This script reads config_files/config_copy.py, which is created when scripts/train.py is launched.
+
+Example:
+    python scripts/tools/benchmark_iqn_loss.py --batch-size 2048 --num-quantiles 32 --chunk-size 8
+"""
+import argparse
+import math
+import time
+
+import torch
+
+from config_files import config_copy
+from trackmania_rl.agents.iqn import fused_iqn_loss, iqn_loss
+
+
+def legacy_losses(targets, outputs, tau_outputs, tau_targets, num_quantiles, batch_size):
+    loss = iqn_loss(targets, outputs, tau_outputs, num_quantiles, batch_size)
+    target_self_loss = iqn_loss(targets.detach(), targets.detach(), tau_targets.detach(), num_quantiles, batch_size)
+    return loss, target_self_loss
+
+
+def measure(loss_function, inputs: tuple, outputs: torch.Tensor, n_repeats: int, device: str) -> tuple[float, int]:
+    """
+    Returns the fastest time in seconds, and the peak memory allocated during a forward and backward pass in bytes (0 on CPU).
+    """
+    best_time = math.inf
+    peak_memory = 0
+    for _ in range(n_repeats):
+        outputs.grad = None
+        if device == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            memory_before = torch.cuda.memory_allocated()
+        start_time = time.perf_counter()
+        loss, _ = loss_function(*inputs)
+        loss.sum().backward()
+        if device == "cuda":
+            torch.cuda.synchronize()
+            peak_memory = max(peak_memory, torch.cuda.max_memory_allocated() - memory_before)
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return best_time, peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default=config_copy.device)
+    parser.add_argument("--batch-size", type=int, default=config_copy.batch_size)
+    parser.add_argument("--num-quantiles", type=int, default=config_copy.iqn_n)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--n-repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    shape = (args.batch_size, args.num_quantiles, 1)
+    targets = torch.randn(shape, device=args.device) * 0.1
+    outputs = (torch.randn(shape, device=args.device) * 0.1).requires_grad_()
+    tau_outputs = torch.rand((args.batch_size * args.num_quantiles, 1), device=args.device)
+    tau_targets = torch.rand((args.batch_size * args.num_quantiles, 1), device=args.device)
+    inputs = (targets, outputs, tau_outputs, tau_targets, args.num_quantiles, args.batch_size)
+
+    results = {}
+    losses = {}
+    grads = {}
+    for name, loss_function in [
+        ("legacy", legacy_losses),
+        ("fused", lambda *loss_inputs: fused_iqn_loss(*loss_inputs, chunk_size=args.chunk_size)),
+    ]:
+        measure(loss_function, inputs, outputs, 3, args.device)  # Warm-up and compilation
+        results[name] = measure(loss_function, inputs, outputs, args.n_repeats, args.device)
+        outputs.grad = None
+        losses[name] = loss_function(*inputs)
+        losses[name][0].sum().backward()
+        grads[name] = outputs.grad.clone()
+
+    for legacy_loss, fused_loss in zip(losses["legacy"], losses["fused"]):
+        assert torch.allclose(legacy_loss, fused_loss, rtol=1e-5, atol=1e-7), "The losses differ"
+    assert torch.allclose(grads["legacy"], grads["fused"], rtol=1e-5, atol=1e-7), "The gradients differ"
+    # The target self-loss feeds the moving averages of Trainer, it must not hold a graph (see scripts/tools/check_train_on_batch.py)
+    assert not losses["fused"][1].requires_grad, "The target self-loss holds a graph"
+
+    for name, (loss_time, peak_memory) in results.items():
+        print(f"{name:<6}  forward+backward: {1000 * loss_time:7.2f} ms  peak memory: {peak_memory / 2**20:8.1f} MiB")
+    print(f"speedup: x{results['legacy'][0] / results['fused'][0]:.2f}  (losses and gradients match)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+This script measures the throughput of the replay buffer for the various storage modes available in trackmania_rl.buffer_utilities.
+
+A buffer is filled with synthetic rollouts shaped like real ones (frames of shape (1, H, W), float inputs, n-step rewards...).
+The script then reports:
+    - the time needed to fill the buffer
+    - the number of batches per second that can be sampled and gathered from the storage (including priority updates with --prioritized)
+    - the number of batches per second that can be sampled and collated. Host storages are prepared by worker threads as in
+      training (--n-prefetch-workers). Batches are collated on --device (config.device), which may be "cpu" to compare CPU
+      throughput with the GPU path. Device storages are also kept on --device.
+    - with --prioritized, the number of batches per second that can be sampled and collated when the priorities of each batch are
+      computed on the device and applied immediately, then queued and applied every --priority-update-every-n-batches batches.
+      Compare with the "Gather + collate" line of a run without --prioritized to measure the cost of prioritized sampling.
+    - with --storage compressed, the memory used per transition and the time spent decoding frames per batch
+    - with --grow-to, the time needed to grow the full buffer to a larger capacity, as when memory_size_schedule steps up. The buffer is
+      grown in two steps before the new rows are filled, and the script checks that new transitions are then written to the new rows
+      first, and then overwrite the oldest transitions.
+
+Use it to choose between keeping the replay buffer in RAM or on disk (config.buffer_storage_on_disk): for disk mode, choose a
+memory size larger than the available RAM, otherwise the page cache hides the cost of reading from disk.
+Also use it to compare the default mode to keeping the replay buffer on the GPU (config.buffer_storage_on_device).
+
+This script reads config_files/config_copy.py, which is created when scripts/train.py is launched.
+
+Example:
+    python scripts/tools/benchmark_replay_buffer.py --storage memmap --memory-size 1000000 --memmap-dir D:/linesight_memmap
+    python scripts/tools/benchmark_replay_buffer.py --storage device_frame_pool --device cuda
+    python scripts/tools/benchmark_replay_buffer.py --prioritized --prio-alpha 0.5
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from config_files import config_copy
+from trackmania_rl.buffer_utilities import (
+    CustomPrioritizedSampler,
+    CustomRandomSampler,
+    buffer_collate_function,
+    device_buffer_collate_function,
+    grow_buffer,
+)
+from trackmania_rl.experience_replay.columnar_storage import ColumnarStorage, FramePoolStorage
+from trackmania_rl.experience_replay.compressed_frame_storage import CompressedFramePoolStorage
+from trackmania_rl.experience_replay.device_storage import DeviceFramePoolStorage, DeviceStorage
+from trackmania_rl.experience_replay.experience_replay_interface import ExperienceBatch
+from trackmania_rl.experience_replay.prefetching_replay_buffer import PrefetchingReplayBuffer
+from trackmania_rl.experience_replay.ring_writer import RingWriter
+
+
+def make_synthetic_rollout(n_frames: int) -> ExperienceBatch:
+    # Frames are a vertical gradient (sky and road) with a textured band, such that their compressibility resembles real frames
+    gradient = np.linspace(40, 200, config_copy.H_downsized, dtype=np.uint8)[None, :, None]
+    frames = []
+    for _ in range(n_frames + config_copy.n_steps):
+        frame = np.broadcast_to(gradient, (1, config_copy.H_downsized, config_copy.W_downsized)).copy()
+        band_start = np.random.randint(config_copy.H_downsized // 2)
+        frame[:, band_start : band_start + config_copy.H_downsized // 4] += np.random.randint(
+            0, 32, size=(1, config_copy.H_downsized // 4, config_copy.W_downsized), dtype=np.uint8
+        )
+        frames.append(frame)
+    state_float = np.random.randn(n_frames + config_copy.n_steps, config_copy.float_input_dim).astype(np.float32)
+    return ExperienceBatch(
+        state_img=frames[:n_frames],
+        state_float=state_float[:n_frames],
+        state_potential=np.random.randn(n_frames).astype(np.float32),
+        action=np.random.randint(low=0, high=len(config_copy.inputs), size=n_frames),
+        n_steps=np.full(n_frames, config_copy.n_steps),
+        rewards=np.random.randn(n_frames, config_copy.n_steps).astype(np.float32),
+        next_state_img=frames[config_copy.n_steps :],
+        next_state_float=state_float[config_copy.n_steps :],
+        next_state_potential=np.random.randn(n_frames).astype(np.float32),
+        gammas=np.ones((n_frames, config_copy.n_steps), dtype=np.float32),
+        terminal_actions=np.full(n_frames, np.inf, dtype=np.float32),
+    )
+
+
+def check_overwrite_order(buffer: PrefetchingReplayBuffer, rows_by_age: np.ndarray, rollout_length: int) -> None:
+    """
+    Checks that after grow_buffer(), new transitions fill the rows added by the growth in order, then overwrite the oldest transitions.
+    rows_by_age are the rows of the buffer before it grew, from the oldest transition to the most recent one.
+    """
+    new_rows = np.arange(len(rows_by_age), buffer._storage.max_size)
+    index = np.asarray(buffer.extend(make_synthetic_rollout(len(new_rows) + rollout_length)))
+    assert np.array_equal(index, np.concatenate((new_rows, rows_by_age[:rollout_length]))), "Transitions are not overwritten in order"
+    assert len(buffer) == buffer._storage.max_size
+
+
+def make_storage(args) -> ColumnarStorage:
+    memmap_dir = args.memmap_dir if args.storage == "memmap" else None
+    if args.storage == "columnar":
+        return ColumnarStorage(args.memory_size)
+    if args.storage == "device":
+        return DeviceStorage(args.memory_size, args.device)
+    if args.storage == "device_frame_pool":
+        return DeviceFramePoolStorage(args.memory_size, args.device)
+    if args.storage == "compressed":
+        return CompressedFramePoolStorage(args.memory_size)
+    return FramePoolStorage(args.memory_size, memmap_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--storage", choices=["columnar", "frame_pool", "compressed", "memmap", "device", "device_frame_pool"], default="frame_pool"
+    )
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device of collated batches and device storages"
+    )
+    parser.add_argument("--memory-size", type=int, default=200_000)
+    parser.add_argument("--rollout-length", type=int, default=6000)
+    parser.add_argument("--n-batches", type=int, default=500)
+    parser.add_argument("--prioritized", action="store_true", help="Use prioritized sampling, as when config.prio_alpha > 0")
+    parser.add_argument("--prio-alpha", type=float, default=0.5, help="Alpha of prioritized sampling, must be positive")
+    parser.add_argument("--priority-update-every-n-batches", type=int, default=max(2, config_copy.priority_update_every_n_batches))
+    parser.add_argument("--grow-to", type=int, default=0, help="Capacity to which the buffer is grown after the measurements")
+    parser.add_argument("--memmap-dir", type=Path, default=Path(__file__).resolve().parents[2] / "save" / "benchmark_memmap")
+    parser.add_argument("--n-prefetch-workers", type=int, default=config_copy.n_prefetch_workers)
+    args = parser.parse_args()
+    assert args.prio_alpha > 0 or not args.prioritized, "Prioritized sampling requires --prio-alpha > 0"
+    config_copy.device = args.device
+
+    on_device = args.storage.startswith("device")
+    buffer = PrefetchingReplayBuffer(
+        storage=make_storage(args),
+        batch_size=config_copy.batch_size,
+        collate_fn=device_buffer_collate_function if on_device else buffer_collate_function,
+        n_workers=1 if on_device else args.n_prefetch_workers,
+        n_batches_ahead=1 if on_device else config_copy.n_batches_prefetched,
+        # As in training, grow_buffer() keeps the oldest transitions next in line for overwriting
+        writer=RingWriter(),
+        sampler=CustomPrioritizedSampler(
+            args.memory_size, args.prio_alpha, config_copy.prio_beta, config_copy.prio_epsilon, torch.float64
+        )
+        if args.prioritized
+        else CustomRandomSampler(),
+    )
+
+    fill_start_time = time.perf_counter()
+    written_rows = []
+    while len(buffer) < args.memory_size:
+        written_rows.append(np.asarray(buffer.extend(make_synthetic_rollout(args.rollout_length))))
+    print(f"Fill            : {time.perf_counter() - fill_start_time:.1f} s for {len(buffer)} transitions")
+
+    gather_start_time = time.perf_counter()
+    for _ in range(args.n_batches):
+        index, _ = buffer._sampler.sample(buffer._storage, config_copy.batch_size)
+        buffer._storage.get(index)
+        if args.prioritized:
+            buffer.update_priority(index, np.random.rand(len(index)))
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    print(f"Gather          : {args.n_batches / (time.perf_counter() - gather_start_time):.1f} batches/s")
+    if isinstance(buffer._storage, CompressedFramePoolStorage):
+        compression_stats = buffer._storage.compression_stats()
+        print(f"Compression     : {compression_stats['buffer_bytes_per_transition']:.0f} bytes/transition")
+        print(f"Decode          : {compression_stats['buffer_frame_decode_ms_per_batch']:.2f} ms/batch")
+
+    sample_start_time = time.perf_counter()
+    for _ in range(args.n_batches):
+        buffer.sample()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    print(f"Gather + collate: {args.n_batches / (time.perf_counter() - sample_start_time):.1f} batches/s")
+
+    if args.prioritized:
+        for priority_update_every_n_batches in (1, args.priority_update_every_n_batches):
+            sample_start_time = time.perf_counter()
+            for _ in range(args.n_batches):
+                batch, batch_info = buffer.sample(return_info=True)
+                # Stand-in for the TD errors computed by Trainer.train_on_batch()
+                priority = batch[1][:, 0].abs().type(torch.float64)
+                if buffer.queue_priority_update(batch_info["index"], priority, batch_info["write_version"]) >= (
+                    priority_update_every_n_batches
+                ):
+                    buffer.flush_priority_updates()
+            buffer.flush_priority_updates()
+            print(
+                f"+ priorities/{priority_update_every_n_batches:<3}: "
+                f"{args.n_batches / (time.perf_counter() - sample_start_time):.1f} batches/s"
+            )
+
+    if args.grow_to > args.memory_size:
+        grow_start_time = time.perf_counter()
+        grow_buffer(buffer, (args.memory_size + args.grow_to) // 2, args.grow_to)
+        grow_buffer(buffer, args.grow_to, args.grow_to)
+        print(f"Grow            : {1000 * (time.perf_counter() - grow_start_time):.1f} ms from {args.memory_size} to {args.grow_to}")
+        check_overwrite_order(buffer, np.concatenate(written_rows)[-args.memory_size :], args.rollout_length)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+This script measures the time taken to evaluate the next states of a batch with the target and online networks, as done by
+Trainer._compute_loss() when config.use_ddqn is True, and compares two implementations:
+    - two forward passes, one per network
+    - trackmania_rl.agents.iqn.stacked_forward(), which vectorizes one forward pass over the stacked parameters of both networks
+
+Both implementations are run under autocast on images of the dtype of collated batches (float16 on GPU, bfloat16 on CPU), with the
+same random state, such that they sample the same tau. Autocast does not apply inside torch.func.vmap: stacked_forward() computes in
+float32 and rounds Q to the autocast dtype. The script checks that its Q values match two forward passes run in float32 on the same
+inputs, up to the rounding of the autocast dtype, and reports the difference with two forward passes under autocast.
+The benchmark is run on CPU, and on GPU when CUDA is available. stacked_forward() is also exercised with collated batches through
+Trainer.train_on_batch() by scripts/tools/check_train_on_batch.py --use-ddqn --stacked-ddqn-next-state-evaluation.
+
+This script reads config_files/config_copy.py, which is created when scripts/train.py is launched.
+
+Example:
+    python scripts/tools/benchmark_stacked_forward.py --batch-size 512
+"""
+import argparse
+import math
+import time
+
+import torch
+
+from config_files import config_copy
+from trackmania_rl import utilities
+from trackmania_rl.agents.iqn import make_untrained_iqn_network, stacked_forward
+
+
+def two_pass_forward(networks, img, float_inputs, num_quantiles):
+    Q, tau = zip(*(network(img, float_inputs, num_quantiles, tau=None) for network in networks))
+    return torch.stack(Q), torch.stack(tau)
+
+
+def measure(forward, inputs: tuple, n_repeats: int, device: str) -> float:
+    best_time = math.inf
+    for _ in range(n_repeats):
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        with torch.no_grad(), utilities.autocast(device):
+            forward(*inputs)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return best_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=config_copy.batch_size)
+    parser.add_argument("--num-quantiles", type=int, default=config_copy.iqn_n)
+    parser.add_argument("--n-repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    for device in ["cpu"] + (["cuda"] if torch.cuda.is_available() else []):
+        torch.manual_seed(0)
+        networks = (make_untrained_iqn_network(jit=False, device=device)[0], make_untrained_iqn_network(jit=False, device=device)[0])
+        with utilities.autocast(device):
+            img_dtype = utilities.autocast_dtype(device)
+        # Collated images are normalized in the autocast dtype, see buffer_utilities.normalize_and_augment_images()
+        img = (
+            torch.randn((args.batch_size, 1, config_copy.H_downsized, config_copy.W_downsized), device=device)
+            .to(img_dtype)
+            .to(memory_format=torch.channels_last)
+        )
+        float_inputs = torch.randn((args.batch_size, config_copy.float_input_dim), device=device)
+        inputs = (networks, img, float_inputs, args.num_quantiles)
+
+        outputs = {}
+        for name, forward in [("two passes", two_pass_forward), ("stacked", stacked_forward)]:
+            torch.manual_seed(1)
+            with torch.no_grad(), utilities.autocast(device):
+                outputs[name] = forward(*inputs)
+        torch.manual_seed(1)
+        with torch.no_grad():
+            float32_Q, _ = two_pass_forward(networks, img.float(), float_inputs, args.num_quantiles)
+        assert torch.equal(outputs["two passes"][1], outputs["stacked"][1]), "The sampled tau differ"
+        assert outputs["stacked"][0].dtype == outputs["two passes"][0].dtype, "The Q values have different dtypes"
+        assert torch.allclose(float32_Q, outputs["stacked"][0].float(), rtol=1e-2, atol=1e-5), "The Q values differ"
+        autocast_difference = (outputs["two passes"][0].float() - outputs["stacked"][0].float()).abs().max().item()
+
+        timings = {}
+        for name, forward in [("two passes", two_pass_forward), ("stacked", stacked_forward)]:
+            measure(forward, inputs, 3, device)  # Warm-up
+            timings[name] = measure(forward, inputs, args.n_repeats, device)
+        print(
+            f"{device:<4}  two passes: {1000 * timings['two passes']:7.2f} ms  stacked: {1000 * timings['stacked']:7.2f} ms  "
+            f"speedup: x{timings['two passes'] / timings['stacked']:.2f}  (Q values match, max difference with autocast passes: "
+            f"{autocast_difference:.1e})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+This script runs several consecutive Trainer.train_on_batch() steps on buffers built by buffer_utilities.make_buffers() and filled with
+synthetic transitions, as the learner does. It checks that consecutive steps train and that losses stay finite, which an isolated call
+to the loss functions does not cover (e.g. a graph carried from one batch to the next through the moving averages of Trainer).
+
+Options of config_copy which change the training path can be overridden from the command line.
+
+This script reads config_files/config_copy.py, which is created when scripts/train.py is launched.
+
+Examples:
+    python scripts/tools/check_train_on_batch.py --device cpu --prio-alpha 0.5 --iqn-loss-chunk-size 4
+    python scripts/tools/check_train_on_batch.py --prio-alpha 0.5 --map-buffer-partitions '{"map5": 0.3, "A01-Race": 0.2}'
+    python scripts/tools/check_train_on_batch.py --prio-alpha 0.5 --buffer-eviction-policy lowest_priority
+    python scripts/tools/check_train_on_batch.py --use-ddqn --stacked-ddqn-next-state-evaluation
+"""
+import argparse
+import json
+import math
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from config_files import config_copy
+from trackmania_rl.agents.iqn import Trainer, make_untrained_iqn_network
+from trackmania_rl.buffer_utilities import make_buffers, select_map_partition
+from trackmania_rl.experience_replay.experience_replay_interface import ExperienceBatch
+from trackmania_rl.experience_replay.map_partitions import other_maps_partition_name
+
+
+def make_synthetic_transitions(n_transitions: int) -> ExperienceBatch:
+    frames = list(
+        np.random.randint(0, 255, (n_transitions + 1, 1, config_copy.H_downsized, config_copy.W_downsized), dtype=np.uint8)
+    )
+    state_float = np.random.randn(n_transitions + 1, config_copy.float_input_dim).astype(np.float32)
+    return ExperienceBatch(
+        state_img=frames[:-1],
+        state_float=state_float[:-1],
+        state_potential=np.random.randn(n_transitions).astype(np.float32),
+        action=np.random.randint(low=0, high=len(config_copy.inputs), size=n_transitions),
+        n_steps=np.full(n_transitions, config_copy.n_steps),
+        rewards=np.random.randn(n_transitions, config_copy.n_steps).astype(np.float32),
+        next_state_img=frames[1:],
+        next_state_float=state_float[1:],
+        next_state_potential=np.random.randn(n_transitions).astype(np.float32),
+        gammas=np.full((n_transitions, config_copy.n_steps), 0.99, dtype=np.float32),
+        terminal_actions=np.full(n_transitions, np.inf, dtype=np.float32),
+    )
+
+
+def make_trainer() -> Trainer:
+    online_network, _ = make_untrained_iqn_network(config_copy.use_jit, config_copy.device)
+    target_network, _ = make_untrained_iqn_network(config_copy.use_jit, config_copy.device)
+    return Trainer(
+        online_network=online_network,
+        target_network=target_network,
+        optimizer=torch.optim.RAdam(online_network.parameters(), lr=1e-4, eps=config_copy.adam_epsilon),
+        scaler=torch.cuda.amp.GradScaler(enabled=torch.device(config_copy.device).type == "cuda"),
+        batch_size=config_copy.batch_size,
+        iqn_n=config_copy.iqn_n,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default=config_copy.device)
+    parser.add_argument("--prio-alpha", type=float, default=config_copy.prio_alpha)
+    parser.add_argument("--iqn-loss-chunk-size", type=int, default=config_copy.iqn_loss_chunk_size)
+    parser.add_argument("--use-ddqn", action=argparse.BooleanOptionalAction, default=config_copy.use_ddqn)
+    parser.add_argument(
+        "--stacked-ddqn-next-state-evaluation",
+        action=argparse.BooleanOptionalAction,
+        default=config_copy.stacked_ddqn_next_state_evaluation,
+    )
+    parser.add_argument("--map-buffer-partitions", type=json.loads, default=config_copy.map_buffer_partitions)
+    parser.add_argument("--buffer-eviction-policy", default=config_copy.buffer_eviction_policy)
+    parser.add_argument("--memory-size", type=int, default=20_000)
+    parser.add_argument("--n-batches", type=int, default=5)
+    args = parser.parse_args()
+    config_copy.device = args.device
+    config_copy.collector_device = args.device
+    config_copy.prio_alpha = args.prio_alpha
+    config_copy.iqn_loss_chunk_size = args.iqn_loss_chunk_size
+    config_copy.use_ddqn = args.use_ddqn
+    config_copy.stacked_ddqn_next_state_evaluation = args.stacked_ddqn_next_state_evaluation
+    config_copy.map_buffer_partitions = args.map_buffer_partitions
+    config_copy.buffer_eviction_policy = args.buffer_eviction_policy
+    config_copy.buffer_storage_on_disk = False
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as save_dir:
+        buffer, buffer_test = make_buffers(args.memory_size, Path(save_dir))
+        # Transitions are added by rollouts, one map at a time. Twice the capacity is added, such that transitions are overwritten.
+        map_names = list(args.map_buffer_partitions) + [other_maps_partition_name]
+        rollout_length = args.memory_size // 10
+        for rollout_number in range(20):
+            select_map_partition(buffer, map_names[rollout_number % len(map_names)])
+            buffer.extend(make_synthetic_transitions(rollout_length))
+        trainer = make_trainer()
+        try:
+            for batch_number in range(args.n_batches):
+                loss, grad_norm = trainer.train_on_batch(buffer, do_learn=True)
+                assert math.isfinite(float(loss)), f"Batch {batch_number}: the loss is not finite"
+                print(f"Batch {batch_number}: {float(loss)=:.3e} {grad_norm=:.3e}")
+        finally:
+            buffer.stop_workers()
+            buffer_test.stop_workers()
+    print(f"{args.n_batches} consecutive batches trained")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+This script exports the replay buffers of a run to a replay dataset: sharded columnar files which can be read lazily with memory
+mapping, see trackmania_rl/experience_replay/replay_dataset.py.
+
+The buffers are read from the replay buffer snapshot of the run (config.save_buffer_snapshots must have been True during training).
+The dataset can then be read with ReplayDataset, e.g. for offline experiments, or used to seed the buffers of a new run with
+config.seed_buffers_from_replay_dataset.
+
+This script reads config_files/config_copy.py, which is created when scripts/train.py is launched. The storage options of the config
+must be those used by the run.
+
+Example:
+    python scripts/tools/export_replay_dataset.py --run-name my_run --output D:/linesight_datasets/my_run
+"""
+import argparse
+import json
+from pathlib import Path
+
+from config_files import config_copy
+from trackmania_rl.buffer_utilities import make_buffers
+from trackmania_rl.experience_replay.buffer_snapshot import BufferSnapshotter
+from trackmania_rl.experience_replay.replay_dataset import export_replay_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run-name", default=config_copy.run_name)
+    parser.add_argument("--output", type=Path, required=True, help="Directory of the replay dataset")
+    parser.add_argument("--shard-size", type=int, default=16384, help="Number of transitions per shard")
+    args = parser.parse_args()
+
+    save_dir = Path(__file__).resolve().parents[2] / "save" / args.run_name
+    snapshot_dir = save_dir / "buffer_snapshot"
+    with open(snapshot_dir / "metadata.json", "r") as f:
+        buffer_size = json.load(f)["buffers"]["buffer"]["max_size"]
+    buffer, buffer_test = make_buffers(buffer_size, save_dir)
+    buffers = {"buffer": buffer, "buffer_test": buffer_test}
+    if not BufferSnapshotter(snapshot_dir).load(buffers):
+        raise SystemExit(f"Could not load the replay buffer snapshot in {snapshot_dir}")
+
+    export_replay_dataset(buffers, args.output, args.shard_size)
+    for name, exported_buffer in buffers.items():
+        print(f"{name:<12}: {len(exported_buffer)} transitions exported to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -115,7 +115,8 @@ if __name__ == "__main__":
     rollout_queues = [mp.Queue(config_copy.max_rollout_queue_size) for _ in range(config_copy.gpu_collectors_count)]
     shared_network_lock = Lock()
     game_spawning_lock = Lock()
-    _, uncompiled_shared_network = make_untrained_iqn_network(jit=config_copy.use_jit)
+    # The shared network lives on the device of the collectors, which copy its weights
+    _, uncompiled_shared_network = make_untrained_iqn_network(jit=config_copy.use_jit, device=config_copy.collector_device)
     uncompiled_shared_network.share_memory()
 
     # Start learner process
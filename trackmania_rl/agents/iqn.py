@@ -12,10 +12,24 @@ from typing import Optional, Tuple
 import numpy as np
 import numpy.typing as npt
 import torch
-from torchrl.data import ReplayBuffer
 
 from config_files import config_copy
 from trackmania_rl import utilities
+from trackmania_rl.experience_replay.prefetching_replay_buffer import PrefetchingReplayBuffer
+
+
+def sample_tau(batch_size: int, num_quantiles: int, device: torch.device) -> torch.Tensor:
+    """
+    Samples tau randomly in num_quantiles regularly spaced segments, and symmetrically around 0.5.
+
+    Returns:
+        tau: a torch.Tensor of shape (batch_size * num_quantiles, 1), ordered quantile first
+    """
+    tau = (
+        torch.arange(num_quantiles // 2, device=device, dtype=torch.float32).repeat_interleave(batch_size).unsqueeze(1)
+        + torch.rand(size=(batch_size * num_quantiles // 2, 1), device=device, dtype=torch.float32)
+    ) / num_quantiles  # (batch_size * num_quantiles // 2, 1) (random numbers)
+    return torch.cat((tau, 1 - tau), dim=0)  # ensure that tau are sampled symmetrically
 
 
 class IQN_Network(torch.nn.Module):
@@ -70,8 +84,9 @@ class IQN_Network(torch.nn.Module):
         self.n_actions = n_actions
 
         # States are not normalized when the method forward() is called. Normalization is done as the first step of the forward() method.
-        self.float_inputs_mean = torch.tensor(float_inputs_mean, dtype=torch.float32).to("cuda")
-        self.float_inputs_std = torch.tensor(float_inputs_std, dtype=torch.float32).to("cuda")
+        # Non-persistent buffers follow the network when it is moved to a device, and are not part of its state_dict.
+        self.register_buffer("float_inputs_mean", torch.tensor(float_inputs_mean, dtype=torch.float32), persistent=False)
+        self.register_buffer("float_inputs_std", torch.tensor(float_inputs_std, dtype=torch.float32), persistent=False)
 
     def initialize_weights(self):
         lrelu_neg_slope = 1e-2
@@ -120,13 +135,9 @@ class IQN_Network(torch.nn.Module):
         float_outputs = self.float_feature_extractor((float_inputs - self.float_inputs_mean) / self.float_inputs_std)
         concat = torch.cat((img_outputs, float_outputs), 1)  # (batch_size, dense_input_dimension)
         if tau is None:
-            tau = (
-                torch.arange(num_quantiles // 2, device="cuda", dtype=torch.float32).repeat_interleave(batch_size).unsqueeze(1)
-                + torch.rand(size=(batch_size * num_quantiles // 2, 1), device="cuda", dtype=torch.float32)
-            ) / num_quantiles  # (batch_size * num_quantiles // 2, 1) (random numbers)
-            tau = torch.cat((tau, 1 - tau), dim=0)  # ensure that tau are sampled symmetrically
+            tau = sample_tau(batch_size, num_quantiles, img.device)
         quantile_net = torch.cos(
-            torch.arange(1, self.iqn_embedding_dimension + 1, 1, device="cuda") * math.pi * tau
+            torch.arange(1, self.iqn_embedding_dimension + 1, 1, device=img.device) * math.pi * tau
         )  # (batch_size*num_quantiles, 1)
         quantile_net = quantile_net.expand(
             [-1, self.iqn_embedding_dimension]
@@ -134,17 +145,55 @@ class IQN_Network(torch.nn.Module):
         # (8 or 32 initial random numbers, expanded with cos to iqn_embedding_dimension)
         # (batch_size*num_quantiles, dense_input_dimension)
         quantile_net = self.iqn_fc(quantile_net)
-        # (batch_size*num_quantiles, dense_input_dimension)
-        concat = concat.repeat(num_quantiles, 1)
-        # (batch_size*num_quantiles, dense_input_dimension)
-        concat = concat * quantile_net
+        # Rows of quantile_net are ordered quantile first, like tau: row q * batch_size + i holds quantile q of state i.
+        # The embedding of the states is broadcast over quantiles instead of being repeated num_quantiles times.
+        # (num_quantiles, batch_size, dense_input_dimension)
+        concat = concat.unsqueeze(0) * quantile_net.reshape(num_quantiles, batch_size, -1)
 
-        A = self.A_head(concat)  # (batch_size*num_quantiles, n_actions)
-        V = self.V_head(concat)  # (batch_size*num_quantiles, 1)
+        A = self.A_head(concat)  # (num_quantiles, batch_size, n_actions)
+        V = self.V_head(concat)  # (num_quantiles, batch_size, 1)
 
         Q = V + A - A.mean(dim=-1).unsqueeze(-1)
 
-        return Q, tau
+        return Q.reshape(batch_size * num_quantiles, -1), tau
+
+
+def stacked_forward(
+    networks: Tuple[torch.nn.Module, ...], img: torch.Tensor, float_inputs: torch.Tensor, num_quantiles: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Evaluates several copies of IQN_Network on the same inputs as one batched computation: the parameters of the copies are stacked
+    (torch.func.stack_module_state) and the forward pass is vectorized over them with torch.func.vmap. Each copy uses its own tau,
+    sampled as in IQN_Network.forward().
+
+    The parameters are stacked at each call, which copies them: this is only worth it when the forward passes are small enough that
+    launching their kernels once instead of len(networks) times dominates.
+
+    Autocast does not apply inside torch.func.vmap: the batched forward pass runs in float32, on inputs cast to float32 (collated images
+    are float16 or bfloat16), and Q is returned in the dtype of the enclosing autocast context, as the forward pass of each network would.
+    Q values match the forward pass of each network up to the rounding of that dtype.
+
+    Args:
+        networks: IQN_Network objects, or torch.compile() wrappers around them
+        img, float_inputs, num_quantiles: as in IQN_Network.forward()
+
+    Returns:
+        Q: a torch.Tensor of shape (len(networks), batch_size * num_quantiles, n_actions)
+        tau: a torch.Tensor of shape (len(networks), batch_size * num_quantiles, 1)
+    """
+    modules = [getattr(network, "_orig_mod", network) for network in networks]
+    params, buffers = torch.func.stack_module_state(modules)
+    tau = torch.stack([sample_tau(img.shape[0], num_quantiles, img.device) for _ in modules])
+    output_dtype = utilities.autocast_dtype(img.device.type) or torch.float32
+    img = img.float()
+    float_inputs = float_inputs.float()
+
+    def forward(module_params, module_buffers, module_tau):
+        return torch.func.functional_call(modules[0], (module_params, module_buffers), (img, float_inputs, num_quantiles, module_tau))
+
+    with torch.autocast(device_type=img.device.type, enabled=False):
+        Q, tau = torch.func.vmap(forward)(params, buffers, tau)
+    return Q.to(output_dtype), tau
 
 
 @torch.compile(disable=not config_copy.is_linux, dynamic=False)
@@ -175,6 +224,111 @@ def iqn_loss(targets: torch.Tensor, outputs: torch.Tensor, tau_outputs: torch.Te
     return loss
 
 
+@torch.compile(disable=not config_copy.is_linux, dynamic=False)
+def _pinball_loss_chunk(targets: torch.Tensor, outputs: torch.Tensor, tau: torch.Tensor, kappa: float) -> torch.Tensor:
+    """
+    Args:
+        targets: a torch.Tensor of shape (batch_size, iqn_n)
+        outputs: a torch.Tensor of shape (batch_size, chunk_size), a chunk of the quantiles of the outputs
+        tau: a torch.Tensor of shape (batch_size, chunk_size), the quantiles of these outputs
+        kappa: (float)
+
+    Returns:
+        loss: a torch.Tensor of shape (batch_size, ), the pinball loss summed over targets and the chunk of outputs
+    """
+    TD_error = targets[:, :, None] - outputs[:, None, :]  # (batch_size, iqn_n, chunk_size)
+    huber_loss = torch.where(torch.lt(torch.abs(TD_error), kappa), (0.5 / kappa) * TD_error**2, torch.abs(TD_error) - 0.5 * kappa)
+    return (torch.where(torch.lt(TD_error, 0), 1 - tau[:, None, :], tau[:, None, :]) * huber_loss).sum(dim=(1, 2))
+
+
+@torch.compile(disable=not config_copy.is_linux, dynamic=False)
+def _pinball_loss_chunk_grad(targets: torch.Tensor, outputs: torch.Tensor, tau: torch.Tensor, kappa: float) -> torch.Tensor:
+    """
+    Same arguments as _pinball_loss_chunk(). Returns the gradient of its loss with regard to each TD error, a torch.Tensor of shape
+    (batch_size, iqn_n, chunk_size).
+    """
+    TD_error = targets[:, :, None] - outputs[:, None, :]  # (batch_size, iqn_n, chunk_size)
+    huber_grad = torch.where(torch.lt(torch.abs(TD_error), kappa), TD_error / kappa, torch.sign(TD_error))
+    return torch.where(torch.lt(TD_error, 0), 1 - tau[:, None, :], tau[:, None, :]) * huber_grad
+
+
+class _FusedIQNLoss(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, targets, outputs, tau_outputs, tau_targets, kappa, chunk_size):
+        num_quantiles = targets.shape[1]
+        loss = torch.zeros(targets.shape[0], device=targets.device, dtype=torch.float32)
+        target_self_loss = torch.zeros_like(loss)
+        for chunk_start in range(0, num_quantiles, chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            # Both losses read the same targets in the same pass
+            loss += _pinball_loss_chunk(targets, outputs[:, chunk], tau_outputs[:, chunk], kappa)
+            target_self_loss += _pinball_loss_chunk(targets, targets[:, chunk], tau_targets[:, chunk], kappa)
+        # Only the inputs are kept for backward: the (batch_size, iqn_n, chunk_size) intermediates are recomputed chunk by chunk
+        ctx.save_for_backward(targets, outputs, tau_outputs)
+        ctx.kappa = kappa
+        ctx.chunk_size = chunk_size
+        loss /= num_quantiles
+        target_self_loss /= num_quantiles
+        # The target self-loss feeds the moving averages of Trainer: it must not carry the graph of this batch to the next ones
+        ctx.mark_non_differentiable(target_self_loss)
+        return loss, target_self_loss
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_target_self_loss):
+        targets, outputs, tau_outputs = ctx.saved_tensors
+        num_quantiles = targets.shape[1]
+        grad_outputs = torch.empty(outputs.shape, device=outputs.device, dtype=torch.float32)
+        grad_targets = torch.zeros(targets.shape, device=targets.device, dtype=torch.float32) if ctx.needs_input_grad[0] else None
+        for chunk_start in range(0, num_quantiles, ctx.chunk_size):
+            chunk = slice(chunk_start, chunk_start + ctx.chunk_size)
+            grad_TD_error = _pinball_loss_chunk_grad(targets, outputs[:, chunk], tau_outputs[:, chunk], ctx.kappa)
+            grad_outputs[:, chunk] = -grad_TD_error.sum(dim=1)
+            if grad_targets is not None:
+                grad_targets += grad_TD_error.sum(dim=2)
+        scale = grad_loss[:, None] / num_quantiles
+        if grad_targets is not None:
+            grad_targets = (grad_targets * scale).to(targets.dtype)
+        return grad_targets, (grad_outputs * scale).to(outputs.dtype), None, None, None, None
+
+
+def fused_iqn_loss(
+    targets: torch.Tensor,
+    outputs: torch.Tensor,
+    tau_outputs: torch.Tensor,
+    tau_targets: torch.Tensor,
+    num_quantiles: int,
+    batch_size: int,
+    chunk_size: Optional[int] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Computes iqn_loss(targets, outputs, tau_outputs) and iqn_loss(targets, targets, tau_targets) in a single pass over targets.
+
+    Quantiles of outputs are processed chunk_size at a time, such that the (batch_size, iqn_n, iqn_n) TD errors are never materialized
+    at once when chunk_size < num_quantiles. The backward pass recomputes them chunk by chunk instead of storing them.
+
+    Args:
+        targets: a torch.Tensor of shape (batch_size, num_quantiles, 1)
+        outputs: a torch.Tensor of shape (batch_size, num_quantiles, 1)
+        tau_outputs: a torch.Tensor of shape (batch_size * num_quantiles, 1), the quantiles of outputs
+        tau_targets: a torch.Tensor of shape (batch_size * num_quantiles, 1), the quantiles of targets
+        num_quantiles: (int)
+        batch_size: (int)
+        chunk_size: the number of quantiles of outputs processed at once, None to process all quantiles at once
+
+    Returns:
+        loss: a torch.Tensor of shape (batch_size, )
+        target_self_loss: a torch.Tensor of shape (batch_size, ), without gradient
+    """
+    return _FusedIQNLoss.apply(
+        targets[:, :, 0],
+        outputs[:, :, 0],
+        tau_outputs.reshape([num_quantiles, batch_size]).transpose(0, 1),  # (batch_size, iqn_n), a view without copy
+        tau_targets.detach().reshape([num_quantiles, batch_size]).transpose(0, 1),
+        config_copy.iqn_kappa,
+        num_quantiles if chunk_size is None else chunk_size,
+    )
+
+
 class Trainer:
     __slots__ = (
         "online_network",
@@ -205,7 +359,106 @@ class Trainer:
         self.typical_self_loss = 0.01
         self.typical_clamped_self_loss = 0.01
 
-    def train_on_batch(self, buffer: ReplayBuffer, do_learn: bool):
+    def _compute_loss(self, batch: tuple, batch_size: int, update_typical_losses: bool) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Calculates the IQN loss of each transition of a collated batch. Must be called in an autocast context.
+
+        Args:
+            batch: a tuple of tensors, as returned by the collate function of the replay buffer
+            batch_size: the number of transitions in batch
+            update_typical_losses: a boolean indicating whether the moving averages of the target self-loss should be updated
+
+        Returns:
+            loss: a torch.Tensor of shape (batch_size, )
+            outputs_target_tau2: a torch.Tensor of shape (batch_size, iqn_n, 1)
+            outputs_tau3: a torch.Tensor of shape (batch_size, iqn_n, 1)
+        """
+        (
+            state_img_tensor,
+            state_float_tensor,
+            actions,
+            rewards,
+            next_state_img_tensor,
+            next_state_float_tensor,
+            gammas_terminal,
+        ) = batch
+        with torch.no_grad():
+            rewards = rewards.unsqueeze(-1).repeat(
+                [self.iqn_n, 1]
+            )  # (batch_size*iqn_n, 1)     a,b,c,d becomes a,b,c,d,a,b,c,d,a,b,c,d,... (iqn_n times)
+            gammas_terminal = gammas_terminal.unsqueeze(-1).repeat([self.iqn_n, 1])  # (batch_size*iqn_n, 1)
+            actions = actions.unsqueeze(-1).repeat([self.iqn_n, 1])  # (batch_size*iqn_n, 1)
+            if config_copy.use_ddqn and config_copy.stacked_ddqn_next_state_evaluation:
+                #   Evaluate the next state with target_network and online_network in one batched computation
+                (q__stpo__target__quantiles_tau2, q__stpo__online__quantiles), (tau2, _) = stacked_forward(
+                    (self.target_network, self.online_network), next_state_img_tensor, next_state_float_tensor, self.iqn_n
+                )
+            else:
+                #
+                #   Use target_network to evaluate the action chosen, per quantile.
+                #
+                q__stpo__target__quantiles_tau2, tau2 = self.target_network(
+                    next_state_img_tensor, next_state_float_tensor, self.iqn_n, tau=None
+                )  # (batch_size*iqn_n, n_actions)
+                if config_copy.use_ddqn:
+                    q__stpo__online__quantiles = self.online_network(
+                        next_state_img_tensor,
+                        next_state_float_tensor,
+                        self.iqn_n,
+                        tau=None,
+                    )[0]  # (batch_size*iqn_n, n_actions)
+            #
+            #   Use online network to choose an action for next state.
+            #   This action is chosen AFTER reduction to the mean, and repeated to all quantiles
+            #
+            if config_copy.use_ddqn:
+                a__tpo__online__reduced_repeated = (
+                    q__stpo__online__quantiles.reshape([self.iqn_n, batch_size, self.online_network.n_actions])
+                    .mean(dim=0)
+                    .argmax(dim=1, keepdim=True)
+                    .repeat([self.iqn_n, 1])
+                )  # (iqn_n * batch_size, 1)
+                #
+                #   Build IQN target on tau2 quantiles
+                #
+                outputs_target_tau2 = rewards + gammas_terminal * q__stpo__target__quantiles_tau2.gather(
+                    1, a__tpo__online__reduced_repeated
+                )  # (batch_size*iqn_n, 1)
+            else:
+                outputs_target_tau2 = (
+                    rewards + gammas_terminal * q__stpo__target__quantiles_tau2.max(dim=1, keepdim=True)[0]
+                )  # (batch_size*iqn_n, 1)
+
+            #
+            #   This is our target
+            #
+            outputs_target_tau2 = outputs_target_tau2.reshape([self.iqn_n, batch_size, 1]).transpose(0, 1)  # (batch_size, iqn_n, 1)
+
+        q__st__online__quantiles_tau3, tau3 = self.online_network(
+            state_img_tensor, state_float_tensor, self.iqn_n, tau=None
+        )  # (batch_size*iqn_n,n_actions)
+        outputs_tau3 = (
+            q__st__online__quantiles_tau3.gather(1, actions).reshape([self.iqn_n, batch_size, 1]).transpose(0, 1)
+        )  # (batch_size, iqn_n, 1)
+
+        loss, target_self_loss = fused_iqn_loss(
+            outputs_target_tau2, outputs_tau3, tau3, tau2, self.iqn_n, batch_size, config_copy.iqn_loss_chunk_size
+        )
+        target_self_loss = torch.sqrt(target_self_loss)
+
+        if update_typical_losses:
+            self.typical_self_loss = 0.99 * self.typical_self_loss + 0.01 * target_self_loss.mean()
+
+        correction_clamped = target_self_loss.clamp(min=self.typical_self_loss / config_copy.target_self_loss_clamp_ratio)
+
+        if update_typical_losses:
+            self.typical_clamped_self_loss = 0.99 * self.typical_clamped_self_loss + 0.01 * correction_clamped.mean()
+
+        loss *= self.typical_clamped_self_loss / correction_clamped
+
+        return loss, outputs_target_tau2, outputs_tau3
+
+    def train_on_batch(self, buffer: PrefetchingReplayBuffer, do_learn: bool):
         """
         Implements one iteration of the training loop:
             1) Sample a batch of transitions from the replay buffer
@@ -216,7 +469,7 @@ class Trainer:
         The training loop may be configured to use DDQN-style updates with config.use_ddqn.
 
         Args:
-            buffer: a ReplayBuffer object from which transitions are sampled. Currently, handles a basic buffer or a prioritized replay buffer.
+            buffer: a PrefetchingReplayBuffer object from which transitions are sampled. Currently, handles a basic buffer or a prioritized replay buffer.
             do_learn: a boolean indicating whether steps 3 and 4 should be applied. If these are not applied, the method only returns total_loss and grad_norm for logging purposes.
 
         Returns:
@@ -226,89 +479,13 @@ class Trainer:
         """
         self.optimizer.zero_grad(set_to_none=True)
 
-        with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+        with utilities.autocast(config_copy.device):
             with torch.no_grad():
                 batch, batch_info = buffer.sample(self.batch_size, return_info=True)
-                (
-                    state_img_tensor,
-                    state_float_tensor,
-                    actions,
-                    rewards,
-                    next_state_img_tensor,
-                    next_state_float_tensor,
-                    gammas_terminal,
-                ) = batch
                 if config_copy.prio_alpha > 0:
-                    IS_weights = torch.from_numpy(batch_info["_weight"]).to("cuda", non_blocking=True)
-
-                rewards = rewards.unsqueeze(-1).repeat(
-                    [self.iqn_n, 1]
-                )  # (batch_size*iqn_n, 1)     a,b,c,d becomes a,b,c,d,a,b,c,d,a,b,c,d,... (iqn_n times)
-                gammas_terminal = gammas_terminal.unsqueeze(-1).repeat([self.iqn_n, 1])  # (batch_size*iqn_n, 1)
-                actions = actions.unsqueeze(-1).repeat([self.iqn_n, 1])  # (batch_size*iqn_n, 1)
-                #
-                #   Use target_network to evaluate the action chosen, per quantile.
-                #
-                q__stpo__target__quantiles_tau2, tau2 = self.target_network(
-                    next_state_img_tensor, next_state_float_tensor, self.iqn_n, tau=None
-                )  # (batch_size*iqn_n, n_actions)
-                #
-                #   Use online network to choose an action for next state.
-                #   This action is chosen AFTER reduction to the mean, and repeated to all quantiles
-                #
-                if config_copy.use_ddqn:
-                    a__tpo__online__reduced_repeated = (
-                        self.online_network(
-                            next_state_img_tensor,
-                            next_state_float_tensor,
-                            self.iqn_n,
-                            tau=None,
-                        )[0]
-                        .reshape([self.iqn_n, self.batch_size, self.online_network.n_actions])
-                        .mean(dim=0)
-                        .argmax(dim=1, keepdim=True)
-                        .repeat([self.iqn_n, 1])
-                    )  # (iqn_n * batch_size, 1)
-                    #
-                    #   Build IQN target on tau2 quantiles
-                    #
-                    outputs_target_tau2 = rewards + gammas_terminal * q__stpo__target__quantiles_tau2.gather(
-                        1, a__tpo__online__reduced_repeated
-                    )  # (batch_size*iqn_n, 1)
-                else:
-                    outputs_target_tau2 = (
-                        rewards + gammas_terminal * q__stpo__target__quantiles_tau2.max(dim=1, keepdim=True)[0]
-                    )  # (batch_size*iqn_n, 1)
-
-                #
-                #   This is our target
-                #
-                outputs_target_tau2 = outputs_target_tau2.reshape([self.iqn_n, self.batch_size, 1]).transpose(
-                    0, 1
-                )  # (batch_size, iqn_n, 1)
-
-            q__st__online__quantiles_tau3, tau3 = self.online_network(
-                state_img_tensor, state_float_tensor, self.iqn_n, tau=None
-            )  # (batch_size*iqn_n,n_actions)
-            outputs_tau3 = (
-                q__st__online__quantiles_tau3.gather(1, actions).reshape([self.iqn_n, self.batch_size, 1]).transpose(0, 1)
-            )  # (batch_size, iqn_n, 1)
-
-            loss = iqn_loss(outputs_target_tau2, outputs_tau3, tau3, config_copy.iqn_n, config_copy.batch_size)
-
-            target_self_loss = torch.sqrt(
-                iqn_loss(
-                    outputs_target_tau2.detach(), outputs_target_tau2.detach(), tau2.detach(), config_copy.iqn_n, config_copy.batch_size
-                )
-            )
+                    IS_weights = torch.from_numpy(batch_info["_weight"]).to(config_copy.device, non_blocking=True)
 
-            self.typical_self_loss = 0.99 * self.typical_self_loss + 0.01 * target_self_loss.mean()
-
-            correction_clamped = target_self_loss.clamp(min=self.typical_self_loss / config_copy.target_self_loss_clamp_ratio)
-
-            self.typical_clamped_self_loss = 0.99 * self.typical_clamped_self_loss + 0.01 * correction_clamped.mean()
-
-            loss *= self.typical_clamped_self_loss / correction_clamped
+            loss, outputs_target_tau2, outputs_tau3 = self._compute_loss(batch, self.batch_size, update_typical_losses=True)
 
             total_loss = torch.sum(IS_weights * loss if config_copy.prio_alpha > 0 else loss)
 
@@ -329,18 +506,42 @@ class Trainer:
 
             total_loss = total_loss.detach().cpu()
             if config_copy.prio_alpha > 0:
-                mask_update_priority = torch.lt(state_float_tensor[:, 0], config_copy.min_horizon_to_update_priority_actions).detach().cpu()
                 # Only update the transition priority if the transition was sampled with a sufficiently long-term horizon.
-                buffer.update_priority(
-                    batch_info["index"][mask_update_priority],
-                    (outputs_tau3.mean(axis=1) - outputs_target_tau2.mean(axis=1))
-                    .abs()[mask_update_priority]
-                    .detach()
-                    .cpu()
-                    .type(torch.float64),
+                # The update is queued without waiting for the GPU, and queued updates are applied every priority_update_every_n_batches.
+                state_float_tensor = batch[1]
+                mask_update_priority = torch.lt(state_float_tensor[:, 0], config_copy.min_horizon_to_update_priority_actions)
+                n_queued_priority_updates = buffer.queue_priority_update(
+                    batch_info["index"],
+                    torch.where(
+                        mask_update_priority,
+                        (outputs_tau3.mean(axis=1) - outputs_target_tau2.mean(axis=1)).abs().squeeze(-1).type(torch.float64),
+                        torch.nan,
+                    ),
+                    batch_info["write_version"],
                 )
+                if n_queued_priority_updates >= config_copy.priority_update_every_n_batches:
+                    buffer.flush_priority_updates()
         return total_loss, grad_norm
 
+    def evaluate_fixed_test_set(self, test_set: tuple, chunk_size: int) -> torch.Tensor:
+        """
+        Calculates the loss on a fixed set of transitions (see buffer_utilities.sample_fixed_test_set()), in chunks of chunk_size
+        transitions, without gradients. Unlike train_on_batch(buffer_test, do_learn=False), the moving averages of the target self-loss
+        are not updated.
+
+        Returns:
+            total_loss: the mean loss per transition multiplied by batch_size, such that it is comparable to the total_loss returned by
+            train_on_batch()
+        """
+        n_transitions = len(test_set[0])
+        with torch.inference_mode(), utilities.autocast(config_copy.device):
+            total_loss = torch.zeros((), device=test_set[0].device)
+            for chunk_start in range(0, n_transitions, chunk_size):
+                chunk = tuple(tensor[chunk_start : chunk_start + chunk_size] for tensor in test_set)
+                loss, _, _ = self._compute_loss(chunk, len(chunk[0]), update_typical_losses=False)
+                total_loss += loss.sum()
+        return (total_loss * self.batch_size / n_transitions).cpu()
+
 
 class Inferer:
     __slots__ = (
@@ -350,10 +551,12 @@ class Inferer:
         "epsilon_boltzmann",
         "tau_epsilon_boltzmann",
         "is_explo",
+        "device",
     )
 
-    def __init__(self, inference_network, iqn_k, tau_epsilon_boltzmann):
+    def __init__(self, inference_network, iqn_k, tau_epsilon_boltzmann, device: str = "cuda"):
         self.inference_network = inference_network
+        self.device = device
         self.iqn_k = iqn_k
         self.epsilon = None
         self.epsilon_boltzmann = None
@@ -376,10 +579,10 @@ class Inferer:
             state_img_tensor = (
                 torch.from_numpy(img_inputs_uint8)
                 .unsqueeze(0)
-                .to("cuda", memory_format=torch.channels_last, non_blocking=True, dtype=torch.float32)
+                .to(self.device, memory_format=torch.channels_last, non_blocking=True, dtype=torch.float32)
                 - 128
             ) / 128
-            state_float_tensor = torch.from_numpy(np.expand_dims(float_inputs, axis=0)).to("cuda", non_blocking=True)
+            state_float_tensor = torch.from_numpy(np.expand_dims(float_inputs, axis=0)).to(self.device, non_blocking=True)
             q_values = (
                 self.inference_network(
                     state_img_tensor,
@@ -432,15 +635,18 @@ class Inferer:
         )
 
 
-def make_untrained_iqn_network(jit: bool) -> Tuple[torch.nn.Module, torch.nn.Module]:
+def make_untrained_iqn_network(jit: bool, device: str = "cuda") -> Tuple[torch.nn.Module, torch.nn.Module]:
     """
     Constructs two identical copies of the IQN network.
 
     The first copy is compiled (if jit == True) and is used for inference, for rollouts, for training, etc...
     The second copy is never compiled and **only** used to efficiently share a neural network's weights between processes.
 
+    With config.flat_network_parameters, the parameters of each copy are views into one flat buffer (see utilities.flatten_parameters()).
+
     Args:
         jit: a boolean indicating whether compilation should be used
+        device: the device on which both copies are placed
     """
 
     uncompiled_model = IQN_Network(
@@ -452,7 +658,10 @@ def make_untrained_iqn_network(jit: bool) -> Tuple[torch.nn.Module, torch.nn.Mod
         n_actions=len(config_copy.inputs),
         float_inputs_mean=config_copy.float_inputs_mean,
         float_inputs_std=config_copy.float_inputs_std,
-    )
+    ).to(device, memory_format=torch.channels_last)
+    if config_copy.flat_network_parameters:
+        # After the move to the device and to channels_last, which would replace the parameters, and before compilation
+        utilities.flatten_parameters(uncompiled_model)
     if jit:
         if config_copy.is_linux:
             model = torch.compile(uncompiled_model, dynamic=False)
@@ -460,7 +669,7 @@ def make_untrained_iqn_network(jit: bool) -> Tuple[torch.nn.Module, torch.nn.Mod
             model = torch.jit.script(uncompiled_model)
     else:
         model = copy.deepcopy(uncompiled_model)
-    return (
-        model.to("cuda", memory_format=torch.channels_last).train(),
-        uncompiled_model.to("cuda", memory_format=torch.channels_last).train(),
-    )
+        if config_copy.flat_network_parameters:
+            # deepcopy() clones each parameter separately: the copy needs its own flat buffer
+            utilities.flatten_parameters(model)
+    return model.train(), uncompiled_model.train()
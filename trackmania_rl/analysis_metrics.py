@@ -14,6 +14,7 @@ import torch
 from PIL import Image
 
 from config_files import config_copy
+from trackmania_rl import utilities
 from trackmania_rl.agents.iqn import iqn_loss
 
 
@@ -62,7 +63,7 @@ def race_time_left_curves(rollout_results, inferer, save_dir, map_name):
             q_h = defaultdict(list)
             a_h = defaultdict(list)
 
-            tau = torch.linspace(0.05, 0.95, config_copy.iqn_k)[:, None].to("cuda")
+            tau = torch.linspace(0.05, 0.95, config_copy.iqn_k)[:, None].to(inferer.device)
             for j in x_axis:
                 # print(j)
                 rollout_results_copy["state_float"][frame_number][0] = j
@@ -108,7 +109,7 @@ def tau_curves(rollout_results, inferer, save_dir, map_name):
 
     rollout_results_copy = rollout_results.copy()
 
-    tau = torch.linspace(0.05, 0.95, config_copy.iqn_k)[:, None].to("cuda")
+    tau = torch.linspace(0.05, 0.95, config_copy.iqn_k)[:, None].to(inferer.device)
 
     n_best_actions_to_plot = 12
 
@@ -144,7 +145,7 @@ def patrick_curves(rollout_results, inferer, save_dir, map_name):
 
     rollout_results_copy = rollout_results.copy()
 
-    tau = torch.linspace(0.05, 0.95, config_copy.iqn_k)[:, None].to("cuda")
+    tau = torch.linspace(0.05, 0.95, config_copy.iqn_k)[:, None].to(inferer.device)
 
     horizons_to_plot = [140, 120, 100, 80, 60, 40, 20, 10]
 
@@ -189,7 +190,7 @@ def highest_prio_transitions(buffer, save_dir):
     shutil.rmtree(save_dir / "high_prio_figures", ignore_errors=True)
     (save_dir / "high_prio_figures").mkdir(parents=True, exist_ok=True)
 
-    prios = [buffer._sampler._sum_tree.at(i) for i in range(len(buffer))]
+    prios = buffer._sampler.priorities(len(buffer))
 
     for high_error_idx in np.argsort(prios)[-20:]:
         for idx in range(max(0, high_error_idx - 4), min(len(buffer) - 1, high_error_idx + 5)):
@@ -218,8 +219,8 @@ def get_output_and_target_for_batch(batch, online_network, target_network, num_q
     state_float_tensor[:, 0] = (0 - config_copy.float_inputs_mean[0]) / config_copy.float_inputs_std[0]
     next_state_float_tensor[:, 0] = state_float_tensor[:, 0] + delta
 
-    tau = torch.linspace(0, 1, num_quantiles, device="cuda").repeat_interleave(batch_size).unsqueeze(1)
-    with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
+    tau = torch.linspace(0, 1, num_quantiles, device=state_img_tensor.device).repeat_interleave(batch_size).unsqueeze(1)
+    with utilities.autocast(config_copy.device):
         with torch.no_grad():
             rewards = rewards.unsqueeze(-1).repeat(
                 [num_quantiles, 1]
@@ -2,30 +2,121 @@
 This file's main entry point is the function fill_buffer_from_rollout_with_n_steps_rule().
 Its main inputs are a rollout_results object (obtained from a GameInstanceManager object), and a buffer to be filled.
 It reassembles the rollout_results object into transitions, as defined in /trackmania_rl/experience_replay/experience_replay_interface.py
+
+Transitions are computed with array operations over the whole rollout. Floating point operations are performed in the same order and
+precision as the previous per-frame implementation with the NumPy version of requirements_conda.txt (1.26), such that transitions are
+bit-identical to it. That implementation multiplied float32 scalars by Python floats, which NumPy 1.x computes in float64: these
+promotions are made explicit with astype(np.float64), and operations it performed in float32 are kept in float32.
 """
 import math
 import random
+from typing import Optional
 
 import numpy as np
+import numpy.typing as npt
 from torchrl.data import ReplayBuffer
 
 from config_files import config_copy
-from trackmania_rl.experience_replay.experience_replay_interface import Experience
-from trackmania_rl.reward_shaping import speedslide_quality_tarmac
+from trackmania_rl.experience_replay.experience_replay_interface import ExperienceBatch, TrajectoryBatch
+from trackmania_rl.experience_replay.trajectory_storage import TrajectoryStorage
+from trackmania_rl.reward_shaping import speedslide_quality_tarmac, weigh_reward_components
+
+
+def row_norms(vectors: npt.NDArray) -> npt.NDArray:
+    """
+    Euclidean norm of each row of a float32 array of shape (N, 3).
 
+    np.linalg.norm(v) computes sqrt(v.dot(v)) in float32. A matmul of (1, 3) and (3, 1) matrices uses the same dot product routine,
+    such that the result is bit-identical to calling np.linalg.norm() on each row.
+    """
+    vectors = np.ascontiguousarray(vectors)
+    return np.sqrt(np.matmul(vectors.reshape(-1, 1, 3), vectors.reshape(-1, 3, 1))[:, 0, 0])
 
-def get_potential(state_float):
+
+def get_potentials(state_float: npt.NDArray) -> npt.NDArray:
+    """
+    Potential of each state, for an array of state_float of shape (N, float_input_dim).
+    """
     # https://people.eecs.berkeley.edu/~pabbeel/cs287-fa09/readings/NgHaradaRussell-shaping-ICML1999.pdf
-    vector_vcp_to_vcp_further_ahead = state_float[65:68] - state_float[62:65]
-    vector_vcp_to_vcp_further_ahead_normalized = vector_vcp_to_vcp_further_ahead / np.linalg.norm(vector_vcp_to_vcp_further_ahead)
+    vector_vcp_to_vcp_further_ahead = state_float[:, 65:68] - state_float[:, 62:65]
+    vector_vcp_to_vcp_further_ahead_normalized_z = vector_vcp_to_vcp_further_ahead[:, 2] / row_norms(vector_vcp_to_vcp_further_ahead)
 
     return (
         config_copy.shaped_reward_dist_to_cur_vcp
-        * max(
+        * np.maximum(
             config_copy.shaped_reward_min_dist_to_cur_vcp,
-            min(config_copy.shaped_reward_max_dist_to_cur_vcp, np.linalg.norm(state_float[62:65])),
+            np.minimum(config_copy.shaped_reward_max_dist_to_cur_vcp, row_norms(state_float[:, 62:65]).astype(np.float64)),
         )
-    ) + (config_copy.shaped_reward_point_to_vcp_ahead * (vector_vcp_to_vcp_further_ahead_normalized[2] - 1))
+    ) + (config_copy.shaped_reward_point_to_vcp_ahead * (vector_vcp_to_vcp_further_ahead_normalized_z - 1).astype(np.float64))
+
+
+def get_reward_weights(
+    engineered_speedslide_reward: float,
+    engineered_neoslide_reward: float,
+    engineered_kamikaze_reward: float,
+    engineered_close_to_vcp_reward: float,
+) -> npt.NDArray:
+    """
+    Returns the weight of each column of get_reward_components(), given the current values of the engineered reward schedules.
+    """
+    return np.array(
+        [
+            config_copy.constant_reward_per_ms,
+            config_copy.reward_per_m_advanced_along_centerline,
+            config_copy.final_speed_reward_per_m_per_s,
+            engineered_speedslide_reward,
+            engineered_neoslide_reward,
+            engineered_kamikaze_reward,
+            engineered_close_to_vcp_reward,
+        ],
+        dtype=np.float64,
+    )
+
+
+def get_reward_components(rollout_results: dict, state_float: npt.NDArray) -> npt.NDArray:
+    """
+    Returns an array of shape (n_frames, n_components), where the reward received when reaching frame i is the sum of the components of
+    row i multiplied by the weights returned by get_reward_weights(). Row 0 is 0.
+
+    Float32 inputs are converted to float64 before arithmetic with Python floats, as NumPy 1.x does for scalars. Operations between float32
+    values and integers stay in float32, e.g. the side friction in speedslide_quality_tarmac().
+    """
+    n_frames = len(rollout_results["frames"])
+    components = np.zeros((n_frames, 7))
+    if n_frames < 2:
+        return components
+
+    ms_per_frame = np.full(n_frames - 1, config_copy.ms_per_action, dtype=np.float64)
+    if "race_time" in rollout_results:
+        ms_per_frame[-1] = rollout_results["race_time"] - (n_frames - 2) * config_copy.ms_per_action
+    components[1:, 0] = ms_per_frame
+    components[1:, 1] = np.diff(np.asarray(rollout_results["meters_advanced_along_centerline"], dtype=np.float64))
+
+    # The following terms are only given for frames 1 to n_frames - 2, for which state_float[i] and state_float[i - 1] exist
+    inner_state_float = state_float[1 : n_frames - 1].astype(np.float64)
+    speed_norm = row_norms(state_float[: n_frames - 1, 56:59])
+    wheels_on_ground = state_float[1 : n_frames - 1, 25:29]
+    actions = np.asarray(rollout_results["actions"][1 : n_frames - 1])
+
+    # car has velocity *forward*
+    components[1 : n_frames - 1, 2] = np.where(inner_state_float[:, 58] > 0, (speed_norm[1:] - speed_norm[:-1]).astype(np.float64), 0.0)
+    # all wheels touch the ground
+    components[1 : n_frames - 1, 3] = np.where(
+        np.all(wheels_on_ground, axis=1),
+        np.maximum(0, 1 - np.abs(speedslide_quality_tarmac(state_float[1 : n_frames - 1, 56], inner_state_float[:, 58]) - 1)),
+        0.0,
+    )  # TODO : indices 25:29, 56 and 58 are hardcoded, this is bad....
+    # lateral speed is higher than 2 meters per second
+    components[1 : n_frames - 1, 4] = np.abs(inner_state_float[:, 56]) >= 2.0  # TODO : 56 is hardcoded, this is bad....
+    # kamikaze reward
+    components[1 : n_frames - 1, 5] = (actions <= 2) | (np.sum(wheels_on_ground, axis=1) <= 1)
+    components[1 : n_frames - 1, 6] = np.maximum(
+        config_copy.engineered_reward_min_dist_to_cur_vcp,
+        np.minimum(
+            config_copy.engineered_reward_max_dist_to_cur_vcp, row_norms(state_float[1 : n_frames - 1, 62:65]).astype(np.float64)
+        ),
+    )
+    return components
 
 
 def fill_buffer_from_rollout_with_n_steps_rule(
@@ -39,106 +130,106 @@ def fill_buffer_from_rollout_with_n_steps_rule(
     engineered_neoslide_reward: float,
     engineered_kamikaze_reward: float,
     engineered_close_to_vcp_reward: float,
+    map_name: Optional[str] = None,
+    rollout_id: int = -1,
 ):
     assert len(rollout_results["frames"]) == len(rollout_results["current_zone_idx"])
     n_frames = len(rollout_results["frames"])
-
-    number_memories_added_train = 0
-    number_memories_added_test = 0
-    buffer_to_fill = buffer_test if random.random() < config_copy.buffer_test_ratio else buffer
-
-    gammas = (gamma ** np.linspace(1, n_steps_max, n_steps_max)).astype(
-        np.float32
-    )  # Discount factor that will be placed in front of next_step in Bellman equation, depending on n_steps chosen
-
-    reward_into = np.zeros(n_frames)
-    for i in range(1, n_frames):
-        reward_into[i] += config_copy.constant_reward_per_ms * (
-            config_copy.ms_per_action
-            if (i < n_frames - 1 or ("race_time" not in rollout_results))
-            else rollout_results["race_time"] - (n_frames - 2) * config_copy.ms_per_action
+    n_transitions = n_frames - 1
+    race_finished = "race_time" in rollout_results
+    if n_transitions <= 0:
+        return buffer, buffer_test, 0, 0
+
+    # When the race is finished, the last frame has no state_float.
+    state_float = np.stack(rollout_results["state_float"])
+
+    transition_index = np.arange(n_transitions)
+    n_steps = np.minimum(n_steps_max, n_frames - 1 - transition_index)
+    if discard_non_greedy_actions_in_nsteps:
+        # n_steps is truncated at the first non-greedy action played after frame i
+        action_was_non_greedy = np.array(rollout_results["action_was_greedy"], dtype=object) == False  # noqa: E712
+        next_non_greedy_frame = np.minimum.accumulate(np.where(action_was_non_greedy, np.arange(n_frames), n_frames)[::-1])[::-1]
+        n_steps = np.minimum(n_steps, next_non_greedy_frame[transition_index + 1] - transition_index)
+
+    next_frame = transition_index + n_steps
+    next_state_has_passed_finish = (next_frame == n_frames - 1) & race_finished
+    terminal_actions = (
+        (n_frames - 1 - transition_index).astype(np.float32) if race_finished else np.full(n_transitions, math.inf, dtype=np.float32)
+    )
+    potentials = get_potentials(state_float)
+    reward_components = get_reward_components(rollout_results, state_float)
+
+    if isinstance(buffer._storage, TrajectoryStorage):
+        # Rewards are computed when transitions are sampled. When the race is finished, the last frame has no image nor state_float:
+        # only its reward components are used, the other attributes are placeholders.
+        n_placeholder_frames = n_frames - len(state_float)
+        frames = list(rollout_results["frames"][: len(state_float)])
+        transitions = TrajectoryBatch(
+            frames=frames + frames[-1:] * n_placeholder_frames,
+            state_float=np.concatenate((state_float, state_float[-1:].repeat(n_placeholder_frames, axis=0))),
+            state_potential=np.concatenate((potentials, np.zeros(n_placeholder_frames))),
+            action=np.concatenate(
+                (np.asarray(rollout_results["actions"][: len(state_float)]), np.zeros(n_placeholder_frames, dtype=np.int64))
+            ),
+            reward_components=reward_components,
+            first_frame=transition_index,
+            n_steps=n_steps,
+            terminal_actions=terminal_actions,
+            next_state_has_passed_finish=next_state_has_passed_finish,
         )
-        reward_into[i] += (
-            rollout_results["meters_advanced_along_centerline"][i] - rollout_results["meters_advanced_along_centerline"][i - 1]
-        ) * config_copy.reward_per_m_advanced_along_centerline
-        if i < n_frames - 1:
-            if rollout_results["state_float"][i][58] > 0:
-                # car has velocity *forward*
-                reward_into[i] += config_copy.final_speed_reward_per_m_per_s * (
-                    np.linalg.norm(rollout_results["state_float"][i][56:59]) - np.linalg.norm(rollout_results["state_float"][i - 1][56:59])
-                )
-            if np.all(rollout_results["state_float"][i][25:29]):
-                # all wheels touch the ground
-                reward_into[i] += engineered_speedslide_reward * max(
-                    0, 1 - abs(speedslide_quality_tarmac(rollout_results["state_float"][i][56], rollout_results["state_float"][i][58]) - 1)
-                )  # TODO : indices 25:29, 56 and 58 are hardcoded, this is bad....
-
-            # lateral speed is higher than 2 meters per second
-            reward_into[i] += (
-                engineered_neoslide_reward if abs(rollout_results["state_float"][i][56]) >= 2.0 else 0
-            )  # TODO : 56 is hardcoded, this is bad....
-            # kamikaze reward
-            if rollout_results["actions"][i] <= 2 or np.sum(rollout_results["state_float"][i][25:29]) <= 1:
-                reward_into[i] += engineered_kamikaze_reward
-
-            reward_into[i] += engineered_close_to_vcp_reward * max(
-                config_copy.engineered_reward_min_dist_to_cur_vcp,
-                min(config_copy.engineered_reward_max_dist_to_cur_vcp, np.linalg.norm(rollout_results["state_float"][i][62:65])),
-            )
-    for i in range(n_frames - 1):  # Loop over all frames that were generated
-        # Switch memory buffer sometimes
-        if random.random() < 0.1:
-            buffer_to_fill = buffer_test if random.random() < config_copy.buffer_test_ratio else buffer
-
-        n_steps = min(n_steps_max, n_frames - 1 - i)
-        if discard_non_greedy_actions_in_nsteps:
-            try:
-                first_non_greedy = rollout_results["action_was_greedy"][i + 1 : i + n_steps].index(False) + 1
-                n_steps = min(n_steps, first_non_greedy)
-            except ValueError:
-                pass
-
-        rewards = np.empty(n_steps_max).astype(np.float32)
-        for j in range(n_steps):
-            rewards[j] = (gamma**j) * reward_into[i + j + 1] + (rewards[j - 1] if j >= 1 else 0)
-
-        state_img = rollout_results["frames"][i]
-        state_float = rollout_results["state_float"][i]
-        state_potential = get_potential(rollout_results["state_float"][i])
-
-        # Get action that was played
-        action = rollout_results["actions"][i]
-        terminal_actions = float((n_frames - 1) - i) if "race_time" in rollout_results else math.inf
-        next_state_has_passed_finish = ((i + n_steps) == (n_frames - 1)) and ("race_time" in rollout_results)
-
-        if not next_state_has_passed_finish:
-            next_state_img = rollout_results["frames"][i + n_steps]
-            next_state_float = rollout_results["state_float"][i + n_steps]
-            next_state_potential = get_potential(rollout_results["state_float"][i + n_steps])
-        else:
-            # It doesn't matter what next_state_img and next_state_float contain, as the transition will be forced to be final
-            next_state_img = state_img
-            next_state_float = state_float
-            next_state_potential = 0
-
-        buffer_to_fill.add(
-            Experience(
-                state_img,
-                state_float,
-                state_potential,
-                action,
-                n_steps,
-                rewards,
-                next_state_img,
-                next_state_float,
-                next_state_potential,
-                gammas,
-                terminal_actions,
+    else:
+        gammas = (gamma ** np.linspace(1, n_steps_max, n_steps_max)).astype(
+            np.float32
+        )  # Discount factor that will be placed in front of next_step in Bellman equation, depending on n_steps chosen
+
+        reward_into = weigh_reward_components(
+            reward_components,
+            get_reward_weights(
+                engineered_speedslide_reward, engineered_neoslide_reward, engineered_kamikaze_reward, engineered_close_to_vcp_reward
             ),
         )
-        if buffer_to_fill is buffer:
-            number_memories_added_train += 1
-        else:
-            number_memories_added_test += 1
 
-    return buffer, buffer_test, number_memories_added_train, number_memories_added_test
+        # Cumulative discounted rewards, accumulated in float32 like rewards[j] = gamma**j * reward_into[i + j + 1] + rewards[j - 1]
+        rewards = np.zeros((n_transitions, n_steps_max), dtype=np.float32)
+        reward_into_padded = np.concatenate((reward_into, np.zeros(n_steps_max)))
+        for j in range(n_steps_max):
+            rewards[:, j] = (gamma**j) * reward_into_padded[transition_index + j + 1] + (rewards[:, j - 1] if j >= 1 else 0)
+        rewards[np.arange(n_steps_max) >= n_steps[:, None]] = 0
+
+        # It doesn't matter what next_state_img and next_state_float contain, as the transition will be forced to be final
+        next_frame_or_current = np.where(next_state_has_passed_finish, transition_index, next_frame)
+        next_state_potential = np.where(next_state_has_passed_finish, 0, potentials[next_frame_or_current])
+
+        transitions = ExperienceBatch(
+            state_img=rollout_results["frames"][:n_transitions],
+            state_float=state_float[:n_transitions],
+            state_potential=potentials[:n_transitions],
+            action=np.asarray(rollout_results["actions"][:n_transitions]),
+            n_steps=n_steps,
+            rewards=rewards,
+            next_state_img=[rollout_results["frames"][k] for k in next_frame_or_current],
+            next_state_float=state_float[next_frame_or_current],
+            next_state_potential=next_state_potential,
+            gammas=np.broadcast_to(gammas, (n_transitions, n_steps_max)),
+            terminal_actions=terminal_actions,
+        )
+
+    # Transitions are split between buffer and buffer_test with the same random draws as when they were added one at a time
+    goes_to_test = np.empty(n_transitions, dtype=bool)
+    to_test = random.random() < config_copy.buffer_test_ratio
+    for i in range(n_transitions):
+        # Switch memory buffer sometimes
+        if random.random() < 0.1:
+            to_test = random.random() < config_copy.buffer_test_ratio
+        goes_to_test[i] = to_test
+
+    train_positions = np.flatnonzero(~goes_to_test)
+    test_positions = np.flatnonzero(goes_to_test)
+    # The map and rollout of each transition are recorded for exports of the buffers (see replay_dataset.py)
+    for target_buffer, positions in ((buffer, train_positions), (buffer_test, test_positions)):
+        if len(positions) > 0:
+            index = target_buffer.extend(transitions.select(positions))
+            if map_name is not None:
+                target_buffer.provenance.record(index, target_buffer.provenance.map_id_of(map_name), rollout_id)
+
+    return buffer, buffer_test, len(train_positions), len(test_positions)
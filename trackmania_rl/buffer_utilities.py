@@ -3,79 +3,63 @@ This file contains various utility functions used to manage replay buffers.
 This is where the magic of "mini-races" or "clipped horizon average reward" is handled.
 """
 import random
+import threading
 from copy import deepcopy
-from typing import Any, Dict, Union
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
 
 import numpy as np
 import torch
 import torchvision.transforms.v2 as transforms
 from torch import Tensor
-from torchrl.data import ListStorage, ReplayBuffer
+from torchrl.data import ReplayBuffer
 from torchrl.data.replay_buffers.samplers import PrioritizedSampler, RandomSampler
 from torchrl.data.replay_buffers.storages import Storage
 from torchrl.data.replay_buffers.utils import INT_CLASSES, _to_numpy
 
 from config_files import config_copy
-
-to_torch_dtype = {
-    "uint8": torch.uint8,
-    "float32": torch.float32,
-    "int64": torch.int64,
-    "float": torch.float32,
-    "int": torch.int,
-    "float64": torch.float32,
-}
-
-
-def fast_collate_cpu(batch, attr_name):
-    elem = getattr(batch[0], attr_name)
-    elem_array = hasattr(elem, "__len__")
-    shape = (len(batch),) + (elem.shape if elem_array else ())
-    data_type = elem.flat[0].dtype if elem_array else type(elem).__name__
-    data_type = to_torch_dtype[str(data_type)]
-    buffer = torch.empty(size=shape, dtype=data_type, pin_memory=True).numpy()
-    source = [getattr(memory, attr_name) for memory in batch]
-    buffer[:] = source[:]
-    return buffer
+from trackmania_rl.experience_replay.columnar_storage import ColumnarStorage, FramePoolStorage
+from trackmania_rl.experience_replay.compressed_frame_storage import CompressedFramePoolStorage
+from trackmania_rl.experience_replay.device_storage import DeviceFramePoolStorage, DeviceStorage
+from trackmania_rl.experience_replay.evicting_writer import EvictingWriter
+from trackmania_rl.experience_replay.experience_replay_interface import ExperienceBatch
+from trackmania_rl.experience_replay.map_partitions import MapPartitions, PartitionedWriter
+from trackmania_rl.experience_replay.prefetching_replay_buffer import PrefetchingReplayBuffer
+from trackmania_rl.experience_replay.ring_writer import RingWriter
+from trackmania_rl.experience_replay.sampler_process_replay_buffer import SamplerProcessReplayBuffer
+from trackmania_rl.experience_replay.shared_memory_storage import SharedMemoryFramePoolStorage, SharedMemoryStorage
+from trackmania_rl.experience_replay.sum_tree import SumTree
+from trackmania_rl.experience_replay.trajectory_storage import TrajectoryStorage
+
+# Number of transitions moved at once when copying the content of a buffer into another buffer
+copy_chunk_size = 4096
 
 
 def send_to_gpu(batch, attr_name):
+    # Copies to the training device (config.device), which may be the CPU
     return torch.as_tensor(batch).to(
-        non_blocking=True, device="cuda", memory_format=torch.channels_last if "img" in attr_name else torch.preserve_format
+        non_blocking=True, device=config_copy.device, memory_format=torch.channels_last if "img" in attr_name else torch.preserve_format
     )
 
 
-def buffer_collate_function(batch):
-    (
-        state_img,
-        state_float,
-        state_potential,
-        action,
-        rewards,
-        next_state_img,
-        next_state_float,
-        next_state_potential,
-        gammas,
-        terminal_actions,
-        n_steps,
-    ) = tuple(
-        map(
-            lambda attr_name: fast_collate_cpu(batch, attr_name),
-            [
-                "state_img",
-                "state_float",
-                "state_potential",
-                "action",
-                "rewards",
-                "next_state_img",
-                "next_state_float",
-                "next_state_potential",
-                "gammas",
-                "terminal_actions",
-                "n_steps",
-            ],
-        )
-    )
+def prepare_mini_races(batch: ExperienceBatch) -> tuple[np.ndarray, ...]:
+    """
+    Host part of buffer_collate_function(): places each transition at a random position within its mini-race, and computes the
+    corresponding rewards and gammas. state_float and next_state_float of the batch are modified in place.
+
+    Returns (state_img, state_float, action, rewards, next_state_img, next_state_float, gammas) as numpy arrays.
+    """
+    state_img = batch.state_img
+    state_float = batch.state_float
+    state_potential = batch.state_potential
+    action = batch.action
+    rewards = batch.rewards
+    next_state_img = batch.next_state_img
+    next_state_float = batch.next_state_float
+    next_state_potential = batch.next_state_potential
+    gammas = batch.gammas
+    terminal_actions = batch.terminal_actions
+    n_steps = batch.n_steps
 
     temporal_mini_race_current_time_actions = (
         np.abs(
@@ -110,18 +94,17 @@ def buffer_collate_function(batch):
     rewards += np.where(terminal, 0, gammas * next_state_potential)
     rewards -= state_potential
 
+    return state_img, state_float, action, rewards, next_state_img, next_state_float, gammas
+
+
+def send_batch_to_gpu(prepared_batch: tuple[np.ndarray, ...]):
+    """
+    Device part of buffer_collate_function(): copies the arrays returned by prepare_mini_races() to the GPU, and normalizes images.
+    """
     state_img, state_float, action, rewards, next_state_img, next_state_float, gammas = tuple(
         map(
             lambda batch, attr_name: send_to_gpu(batch, attr_name),
-            [
-                state_img,
-                state_float,
-                action,
-                rewards,
-                next_state_img,
-                next_state_float,
-                gammas,
-            ],
+            prepared_batch,
             [
                 "state_img",
                 "state_float",
@@ -134,8 +117,139 @@ def buffer_collate_function(batch):
         )
     )
 
-    state_img = (state_img.to(torch.float16) - 128) / 128
-    next_state_img = (next_state_img.to(torch.float16) - 128) / 128
+    state_img, next_state_img = normalize_and_augment_images(state_img, next_state_img)
+
+    return (
+        state_img,
+        state_float,
+        action,
+        rewards,
+        next_state_img,
+        next_state_float,
+        gammas,
+    )
+
+
+def buffer_collate_function(batch: ExperienceBatch):
+    return send_batch_to_gpu(prepare_mini_races(batch))
+
+
+# Batches are collated by several prefetching threads, whereas compilation is not thread-safe. The first call for each device and shape of
+# batch traces and compiles mini_race_transform() under this lock. Later calls only run the compiled graph, without taking the lock.
+mini_race_transform_lock = threading.Lock()
+mini_race_transform_compiled_keys = set()
+
+
+@torch.compile(disable=not config_copy.is_linux, dynamic=False)
+def mini_race_transform(
+    state_float: torch.Tensor,
+    state_potential: torch.Tensor,
+    rewards: torch.Tensor,
+    next_state_float: torch.Tensor,
+    next_state_potential: torch.Tensor,
+    gammas: torch.Tensor,
+    terminal_actions: torch.Tensor,
+    n_steps: torch.Tensor,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Equivalent of prepare_mini_races() with torch operations, on the device of the batch. state_float and next_state_float are modified
+    in place. Returns rewards and gammas of shape (batch_size, ).
+
+    The function is compiled, such that the horizon logic is fused into a few kernels instead of one kernel per operation. It is compiled
+    on its own rather than with the training step, because batches are collated by the prefetching threads ahead of the step. Outputs are
+    not written to preallocated tensors either: several collated batches are in flight at once, and the compiled graph takes its
+    outputs from the caching allocator of the device.
+    """
+    temporal_mini_race_current_time_actions = (
+        torch.abs(
+            torch.randint(
+                low=-config_copy.oversample_long_term_steps + config_copy.oversample_maximum_term_steps,
+                high=config_copy.temporal_mini_race_duration_actions + config_copy.oversample_maximum_term_steps,
+                size=(len(state_float),),
+                device=state_float.device,
+            )
+        )
+        - config_copy.oversample_maximum_term_steps
+    ).clamp(min=0)
+
+    temporal_mini_race_next_time_actions = temporal_mini_race_current_time_actions + n_steps
+
+    state_float[:, 0] = temporal_mini_race_current_time_actions
+    next_state_float[:, 0] = temporal_mini_race_next_time_actions
+
+    possibly_reduced_n_steps = n_steps - (temporal_mini_race_next_time_actions - config_copy.temporal_mini_race_duration_actions).clamp(
+        min=0
+    )
+
+    terminal = (possibly_reduced_n_steps >= terminal_actions) | (
+        temporal_mini_race_next_time_actions >= config_copy.temporal_mini_race_duration_actions
+    )
+
+    gammas = torch.gather(gammas, 1, possibly_reduced_n_steps[:, None] - 1).squeeze(-1)
+    gammas = torch.where(terminal, 0, gammas)
+
+    rewards = torch.gather(rewards, 1, possibly_reduced_n_steps[:, None] - 1).squeeze(-1)
+
+    rewards = rewards + torch.where(terminal, 0, gammas * next_state_potential)
+    rewards = rewards - state_potential
+
+    return rewards, gammas
+
+
+def device_buffer_collate_function(batch: ExperienceBatch):
+    """
+    Equivalent of buffer_collate_function() for batches whose fields are already tensors on the training device (e.g. gathered from a
+    DeviceStorage). Mini-races are prepared with mini_race_transform() on that device.
+    """
+    transform_inputs = (
+        batch.state_float,
+        batch.state_potential,
+        batch.rewards,
+        batch.next_state_float,
+        batch.next_state_potential,
+        batch.gammas,
+        batch.terminal_actions,
+        batch.n_steps,
+    )
+    compiled_key = (batch.state_float.device, batch.state_float.shape, batch.rewards.shape)
+    if compiled_key in mini_race_transform_compiled_keys:
+        rewards, gammas = mini_race_transform(*transform_inputs)
+    else:
+        with mini_race_transform_lock:
+            rewards, gammas = mini_race_transform(*transform_inputs)
+            mini_race_transform_compiled_keys.add(compiled_key)
+
+    state_img, next_state_img = normalize_and_augment_images(
+        batch.state_img.contiguous(memory_format=torch.channels_last),
+        batch.next_state_img.contiguous(memory_format=torch.channels_last),
+    )
+
+    return (
+        state_img,
+        batch.state_float,
+        batch.action,
+        rewards,
+        next_state_img,
+        batch.next_state_float,
+        gammas,
+    )
+
+
+def device_mini_races_collate_function(batch: ExperienceBatch):
+    """
+    Equivalent of buffer_collate_function() for batches gathered in host memory, where mini-races are prepared on the GPU: the gathered
+    fields are copied to the GPU as they are, then collated by device_buffer_collate_function().
+    """
+    return device_buffer_collate_function(
+        ExperienceBatch(**{field: send_to_gpu(getattr(batch, field), field) for field in ExperienceBatch.__slots__})
+    )
+
+
+def normalize_and_augment_images(state_img: torch.Tensor, next_state_img: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    # Images are in the precision of autocast on their device, see utilities.autocast()
+    image_dtype = torch.float16 if state_img.is_cuda else torch.bfloat16
+    state_img = (state_img.to(image_dtype) - 128) / 128
+    next_state_img = (next_state_img.to(image_dtype) - 128) / 128
 
     if config_copy.apply_randomcrop_augmentation:
         # Same transformation is applied for state and next_state.
@@ -157,15 +271,7 @@ def buffer_collate_function(batch):
             config_copy.W_downsized,
         )
 
-    return (
-        state_img,
-        state_float,
-        action,
-        rewards,
-        next_state_img,
-        next_state_float,
-        gammas,
-    )
+    return state_img, next_state_img
 
 
 class CustomPrioritizedSampler(PrioritizedSampler):
@@ -174,6 +280,8 @@ class CustomPrioritizedSampler(PrioritizedSampler):
 
     A memory's default priority is based on all memories' average priority,
     instead of the maximum priority seen since the beginning of training.
+
+    Priorities are stored in linesight's SumTree, whose operations are batched, instead of torchrl's segment trees.
     """
 
     def __init__(
@@ -190,6 +298,25 @@ class CustomPrioritizedSampler(PrioritizedSampler):
         self._average_priority = None
         self._default_priority_ratio = default_priority_ratio
         self._uninitialized_memories = 0.0
+        self._init()
+
+    def _init(self) -> None:
+        self._sum_tree = SumTree(self._max_capacity)
+        self._max_priority = None
+
+    def _add_or_extend(self, index: Union[int, torch.Tensor]) -> None:
+        self._sum_tree[index] = self.default_priority
+
+    def grow(self, new_max_capacity: int) -> None:
+        assert new_max_capacity >= self._max_capacity
+        self._max_capacity = new_max_capacity
+        self._sum_tree.resize(new_max_capacity)
+
+    def priorities(self, n_memories: int) -> np.ndarray:
+        """
+        Returns the priorities of the first n_memories rows of the storage.
+        """
+        return self._sum_tree.leaves()[:n_memories]
 
     @property
     def default_priority(self) -> float:
@@ -199,6 +326,12 @@ class CustomPrioritizedSampler(PrioritizedSampler):
         else:
             return self._default_priority_ratio * self._average_priority
 
+    def extend(self, index: torch.Tensor) -> None:
+        super().extend(index)
+        # default_priority counts one uninitialized memory per call, whereas extend() adds len(index) memories at once
+        if self._average_priority is None:
+            self._uninitialized_memories += len(index) - 1
+
     def sample(self, storage: Storage, batch_size: int) -> tuple[Tensor, dict[str, Any]]:
         if len(storage) == 0:
             raise RuntimeError("Cannot sample from an empty storage.")
@@ -214,6 +347,8 @@ class CustomPrioritizedSampler(PrioritizedSampler):
             index.clamp_max_(len(storage) - 1)
         else:
             index = np.clip(index, None, len(storage) - 1)
+        if getattr(storage, "gather_sorted_index", False):
+            index = np.sort(_to_numpy(index))
         if self._uninitialized_memories > 0.0:
             return index, {"_weight": 0.5 * np.ones(len(index))}
         else:
@@ -253,6 +388,7 @@ class CustomPrioritizedSampler(PrioritizedSampler):
             "_eps": self._eps,
             "_average_priority": self._average_priority,
             "_default_priority_ratio": self._default_priority_ratio,
+            "_uninitialized_memories": self._uninitialized_memories,
             "_sum_tree": deepcopy(self._sum_tree),
         }
 
@@ -262,50 +398,292 @@ class CustomPrioritizedSampler(PrioritizedSampler):
         self._eps = state_dict["_eps"]
         self._average_priority = state_dict["_average_priority"]
         self._default_priority_ratio = state_dict["_default_priority_ratio"]
+        self._uninitialized_memories = state_dict.get("_uninitialized_memories", 0.0)
         self._sum_tree = state_dict.pop("_sum_tree")
 
 
+class CustomRandomSampler(RandomSampler):
+    """
+    Uniform sampler, which returns sorted indices when the storage benefits from it (see ColumnarStorage.gather_sorted_index).
+    """
+
+    def sample(self, storage: Storage, batch_size: int) -> tuple[Any, dict]:
+        index, info = super().sample(storage, batch_size)
+        if getattr(storage, "gather_sorted_index", False):
+            index = np.sort(_to_numpy(index))
+        return index, info
+
+
+class PartitionedPrioritizedSampler(CustomPrioritizedSampler):
+    """
+    CustomPrioritizedSampler for replay buffers partitioned by map (see experience_replay/map_partitions.py).
+
+    The sum tree is indexed by slot of MapPartitions instead of storage row. The share of the batch drawn from each partition is
+    decided first, then transitions are sampled in proportion to their priority within their partition, with a single descent of the tree.
+    Importance sampling weights account for the share of the batch drawn from each partition.
+    """
+
+    def __init__(self, partitions: MapPartitions, alpha: float, beta: float, eps: float = 1e-8, dtype: torch.dtype = torch.float) -> None:
+        self._partitions = partitions
+        super(PartitionedPrioritizedSampler, self).__init__(partitions.max_size, alpha, beta, eps, dtype)
+
+    def _add_or_extend(self, index: Union[int, torch.Tensor]) -> None:
+        super()._add_or_extend(self._partitions.row_to_slot[_to_numpy(index)])
+
+    def grow_partitions(self, old_slots: np.ndarray, new_slots: np.ndarray) -> None:
+        """
+        Moves priorities after MapPartitions.grow().
+        """
+        leaves = self._sum_tree.leaves()
+        self.grow(self._partitions.max_size)
+        new_leaves = np.zeros(self._partitions.max_size)
+        new_leaves[new_slots] = leaves[old_slots]
+        self._sum_tree.load_leaves(new_leaves)
+
+    def priorities(self, n_memories: int) -> np.ndarray:
+        return self._sum_tree.leaves()[self._partitions.row_to_slot[:n_memories]]
+
+    def sample(self, storage: Storage, batch_size: int) -> tuple[Tensor, dict[str, Any]]:
+        if len(storage) == 0:
+            raise RuntimeError("Cannot sample from an empty storage.")
+        partitions = self._partitions
+        p_sum = self._sum_tree.query(0, partitions.max_size)
+        self._average_priority = p_sum / len(storage)
+        if p_sum <= 0:
+            raise RuntimeError("negative p_sum")
+        partition_end = (partitions.start + partitions.capacity).tolist()
+        partition_mass = np.array([self._sum_tree.query(start, end) for start, end in zip(partitions.start.tolist(), partition_end)])
+        partition_start_mass = np.concatenate(([0.0], np.cumsum(partition_mass)[:-1]))
+        counts = partitions.sample_counts(batch_size)
+        partition = np.repeat(np.arange(len(counts)), counts)
+        mass = partition_start_mass[partition] + np.random.uniform(0.0, 1.0, size=batch_size) * partition_mass[partition]
+        # Rounding may move a slot out of its partition: it is brought back to the partition's first or last transition
+        slot = np.clip(
+            self._sum_tree.scan_lower_bound(mass),
+            partitions.start[partition],
+            partitions.start[partition] + partitions.count[partition] - 1,
+        )
+        index = partitions.slot_to_row[slot]
+        if getattr(storage, "gather_sorted_index", False):
+            order = np.argsort(index)
+            index, slot, partition = index[order], slot[order], partition[order]
+        if self._uninitialized_memories > 0.0:
+            return index, {"_weight": 0.5 * np.ones(len(index))}
+        else:
+            sampling_probability = (counts[partition] / batch_size) * self._sum_tree[slot] / partition_mass[partition]
+            weight = np.power(len(storage) * sampling_probability, -self._beta)
+            return index, {"_weight": weight}
+
+    def update_priority(self, index: Union[int, torch.Tensor], priority: Union[float, torch.Tensor]) -> None:
+        super().update_priority(self._partitions.row_to_slot[_to_numpy(index)], priority)
+
+
+class PartitionedRandomSampler(CustomRandomSampler):
+    """
+    Uniform sampler for replay buffers partitioned by map: the share of the batch drawn from each partition is decided first, then
+    transitions are sampled uniformly within their partition.
+    """
+
+    def __init__(self, partitions: MapPartitions) -> None:
+        super().__init__()
+        self._partitions = partitions
+
+    def sample(self, storage: Storage, batch_size: int) -> tuple[Any, dict]:
+        if len(storage) == 0:
+            raise RuntimeError("Cannot sample from an empty storage.")
+        partitions = self._partitions
+        partition = np.repeat(np.arange(len(partitions.names)), partitions.sample_counts(batch_size))
+        offset = (np.random.uniform(0.0, 1.0, size=batch_size) * partitions.count[partition]).astype(np.int64)
+        slot = partitions.start[partition] + (partitions.head[partition] + offset) % np.maximum(1, partitions.capacity[partition])
+        index = partitions.slot_to_row[slot]
+        if getattr(storage, "gather_sorted_index", False):
+            index = np.sort(index)
+        return index, {}
+
+
+def select_map_partition(buffer: ReplayBuffer, map_name: str) -> None:
+    """
+    Selects the partition receiving the next transitions added to a buffer. Does nothing if the buffer is not partitioned by map.
+    """
+    if isinstance(buffer._writer, PartitionedWriter):
+        buffer._writer.select_partition(map_name)
+
+
+def map_partitions_stats(buffer: ReplayBuffer) -> Dict[str, float]:
+    return buffer._writer.partitions.stats() if isinstance(buffer._writer, PartitionedWriter) else {}
+
+
 def copy_buffer_content_to_other_buffer(source_buffer: ReplayBuffer, target_buffer: ReplayBuffer) -> None:
     assert source_buffer._storage.max_size <= target_buffer._storage.max_size
 
-    target_buffer.extend(source_buffer._storage._storage)
+    for start in range(0, len(source_buffer), copy_chunk_size):
+        stop = min(start + copy_chunk_size, len(source_buffer))
+        index = target_buffer.extend(source_buffer._storage.rows(start, stop))
+        target_buffer.provenance.copy_rows(source_buffer.provenance, np.arange(start, stop), index)
 
     if isinstance(source_buffer._sampler, CustomPrioritizedSampler) and isinstance(target_buffer._sampler, CustomPrioritizedSampler):
         target_buffer._sampler._average_priority = source_buffer._sampler._average_priority
         target_buffer._sampler._uninitialized_memories = source_buffer._sampler._uninitialized_memories
 
-    if isinstance(source_buffer._sampler, PrioritizedSampler) and isinstance(target_buffer._sampler, PrioritizedSampler):
-        for i in range(len(source_buffer)):
-            target_buffer._sampler._sum_tree[i] = source_buffer._sampler._sum_tree.at(i)
+        target_buffer._sampler._sum_tree.load_leaves(source_buffer._sampler.priorities(len(source_buffer)))
 
 
-def make_buffers(buffer_size: int) -> tuple[ReplayBuffer, ReplayBuffer]:
-    buffer = ReplayBuffer(
-        storage=ListStorage(buffer_size),
-        batch_size=config_copy.batch_size,
-        collate_fn=buffer_collate_function,
-        prefetch=1,
-        sampler=CustomPrioritizedSampler(
-            buffer_size, config_copy.prio_alpha, config_copy.prio_beta, config_copy.prio_epsilon, torch.float64
+def sample_fixed_test_set(buffer_test: ReplayBuffer, size: int, chunk_size: int) -> Optional[tuple]:
+    """
+    Samples a fixed set of transitions from buffer_test without replacement, and collates it with the collate function of the buffer,
+    such that it stays on the device until it is replaced. Mini-races are drawn once, when the set is sampled.
+    The size of the set is rounded down to a multiple of chunk_size, such that it is evaluated in chunks of identical shapes.
+    Returns None if buffer_test holds fewer than chunk_size transitions.
+    """
+    size = min(size, len(buffer_test)) // chunk_size * chunk_size
+    if size == 0:
+        return None
+    with buffer_test._replay_lock:
+        index = np.random.choice(len(buffer_test), size, replace=False)
+        batch = buffer_test._storage.get(index)
+    return buffer_test._collate_fn(batch)
+
+
+def make_storage(max_size: int, memmap_dir: Optional[Path]) -> ColumnarStorage:
+    if config_copy.buffer_storage_on_device:
+        assert not config_copy.store_trajectories_in_buffer, "Trajectories cannot be stored on the device"
+        if config_copy.deduplicate_frames_in_buffer:
+            return DeviceFramePoolStorage(max_size, config_copy.device)
+        else:
+            return DeviceStorage(max_size, config_copy.device)
+    if config_copy.buffer_storage_in_shared_memory:
+        assert memmap_dir is None, "Shared memory storages cannot be memory-mapped"
+        assert not config_copy.store_trajectories_in_buffer, "Trajectories cannot be stored in shared memory"
+        assert not config_copy.compress_frames_in_buffer, "Compressed frames cannot be stored in shared memory"
+        if config_copy.deduplicate_frames_in_buffer:
+            return SharedMemoryFramePoolStorage(max_size)
+        else:
+            return SharedMemoryStorage(max_size)
+    if config_copy.store_trajectories_in_buffer:
+        return TrajectoryStorage(max_size, memmap_dir, n_steps_max=config_copy.n_steps)
+    if config_copy.deduplicate_frames_in_buffer and config_copy.compress_frames_in_buffer:
+        assert not config_copy.save_buffer_snapshots, "Compressed frames cannot be saved in replay buffer snapshots"
+        return CompressedFramePoolStorage(
+            max_size,
+            memmap_dir,
+            compression_level=config_copy.buffer_frame_compression_level,
+            n_codec_threads=config_copy.buffer_frame_codec_threads,
+            decoded_frames_cache_size=config_copy.buffer_decoded_frames_cache_size,
         )
-        if config_copy.prio_alpha > 0
-        else RandomSampler(),
-    )
-    buffer_test = ReplayBuffer(
-        storage=ListStorage(int(buffer_size * config_copy.buffer_test_ratio)),
-        batch_size=config_copy.batch_size,
-        collate_fn=buffer_collate_function,
-        sampler=CustomPrioritizedSampler(
-            buffer_size, config_copy.prio_alpha, config_copy.prio_beta, config_copy.prio_epsilon, torch.float64
+    if config_copy.deduplicate_frames_in_buffer:
+        return FramePoolStorage(max_size, memmap_dir)
+    else:
+        return ColumnarStorage(max_size, memmap_dir)
+
+
+def make_writer_and_sampler(storage_size: int, sampler_capacity: int, eviction_policy: str = "oldest") -> dict[str, Any]:
+    """
+    Returns the writer and sampler of a buffer. When config_copy.map_buffer_partitions is not empty, the buffer is partitioned by map.
+    Otherwise, eviction_policy chooses which transitions are overwritten once the buffer is full (see EvictingWriter).
+    """
+    if not config_copy.map_buffer_partitions:
+        sampler = (
+            CustomPrioritizedSampler(
+                sampler_capacity, config_copy.prio_alpha, config_copy.prio_beta, config_copy.prio_epsilon, torch.float64
+            )
+            if config_copy.prio_alpha > 0
+            else CustomRandomSampler()
+        )
+        if eviction_policy == "oldest":
+            return {"writer": RingWriter(), "sampler": sampler}
+        # Old transitions kept in a TrajectoryStorage would keep all subsequent frames in its frame ring
+        assert not config_copy.store_trajectories_in_buffer, "Trajectory storages only evict the oldest transitions"
+        assert eviction_policy != "lowest_priority" or config_copy.prio_alpha > 0, "Priorities are required to evict by priority"
+        writer = EvictingWriter(
+            eviction_policy, config_copy.buffer_eviction_window_fraction, config_copy.buffer_eviction_candidates_fraction
+        )
+        writer.register_sampler(sampler)
+        return {"writer": writer, "sampler": sampler}
+    assert eviction_policy == "oldest", "Partitioned buffers evict the oldest transitions of each partition"
+    partitions = MapPartitions(storage_size, config_copy.map_buffer_partitions, config_copy.map_buffer_sampling_weights or None)
+    return {
+        "writer": PartitionedWriter(partitions),
+        "sampler": PartitionedPrioritizedSampler(
+            partitions, config_copy.prio_alpha, config_copy.prio_beta, config_copy.prio_epsilon, torch.float64
         )
         if config_copy.prio_alpha > 0
-        else RandomSampler(),
+        else PartitionedRandomSampler(partitions),
+    }
+
+
+def make_buffers(buffer_size: int, save_dir: Path) -> tuple[ReplayBuffer, ReplayBuffer]:
+    memmap_dir = save_dir / "buffer_memmap" if config_copy.buffer_storage_on_disk else None
+    # Batches of a device storage are gathered and prepared with asynchronous device operations, a single prefetching thread suffices.
+    if config_copy.buffer_storage_on_device:
+        collate_fn = device_buffer_collate_function
+    elif config_copy.mini_races_on_device:
+        collate_fn = device_mini_races_collate_function
+    else:
+        collate_fn = buffer_collate_function
+    if config_copy.buffer_sampler_process:
+        buffer = SamplerProcessReplayBuffer(
+            storage=make_storage(buffer_size, memmap_dir),
+            batch_size=config_copy.batch_size,
+            prepare_fn=prepare_mini_races,
+            collate_fn=send_batch_to_gpu,
+            n_batches_ahead=config_copy.n_batches_prefetched,
+            **make_writer_and_sampler(buffer_size, buffer_size, config_copy.buffer_eviction_policy),
+        )
+    else:
+        buffer = PrefetchingReplayBuffer(
+            storage=make_storage(buffer_size, memmap_dir),
+            batch_size=config_copy.batch_size,
+            collate_fn=collate_fn,
+            n_workers=1 if config_copy.buffer_storage_on_device else config_copy.n_prefetch_workers,
+            n_batches_ahead=1 if config_copy.buffer_storage_on_device else config_copy.n_batches_prefetched,
+            **make_writer_and_sampler(buffer_size, buffer_size, config_copy.buffer_eviction_policy),
+        )
+    buffer_test = PrefetchingReplayBuffer(
+        storage=make_storage(int(buffer_size * config_copy.buffer_test_ratio), memmap_dir),
+        batch_size=config_copy.batch_size,
+        collate_fn=collate_fn,
+        n_workers=1,
+        n_batches_ahead=1,
+        **make_writer_and_sampler(int(buffer_size * config_copy.buffer_test_ratio), buffer_size),
     )
     return buffer, buffer_test
 
 
-def resize_buffers(buffer: ReplayBuffer, buffer_test: ReplayBuffer, new_buffer_size: int) -> tuple[ReplayBuffer, ReplayBuffer]:
-    new_buffer, new_buffer_test = make_buffers(new_buffer_size)
+def grow_buffer(buffer: ReplayBuffer, new_storage_size: int, new_sampler_capacity: int) -> None:
+    with buffer._replay_lock:
+        if isinstance(buffer._writer, PartitionedWriter):
+            # Each partition keeps its share of the larger capacity
+            buffer._storage.grow(new_storage_size)
+            old_slots, new_slots = buffer._writer.partitions.grow(new_storage_size)
+            if isinstance(buffer._sampler, PartitionedPrioritizedSampler):
+                buffer._sampler.grow_partitions(old_slots, new_slots)
+            return
+        if isinstance(buffer._writer, RingWriter):
+            # New transitions are written to the new rows first, then the oldest transitions are overwritten as before
+            buffer._writer.grow(new_storage_size)
+        buffer._storage.grow(new_storage_size)
+        if isinstance(buffer._sampler, CustomPrioritizedSampler):
+            buffer._sampler.grow(new_sampler_capacity)
+
+
+def resize_buffers(
+    buffer: ReplayBuffer, buffer_test: ReplayBuffer, new_buffer_size: int, save_dir: Path
+) -> tuple[ReplayBuffer, ReplayBuffer]:
+    """
+    When the capacity increases, buffers are grown in place: no transition is copied.
+    Otherwise, transitions are copied into new buffers. Buffers partitioned by map cannot shrink.
+    """
+    if new_buffer_size < buffer._storage.max_size and isinstance(buffer._writer, PartitionedWriter):
+        raise ValueError("Replay buffers partitioned by map cannot shrink")
+    if new_buffer_size >= buffer._storage.max_size:
+        grow_buffer(buffer, new_buffer_size, new_buffer_size)
+        grow_buffer(buffer_test, int(new_buffer_size * config_copy.buffer_test_ratio), new_buffer_size)
+        return buffer, buffer_test
+    buffer.flush_priority_updates()
+    buffer_test.flush_priority_updates()
+    buffer.stop_workers()
+    buffer_test.stop_workers()
+    new_buffer, new_buffer_test = make_buffers(new_buffer_size, save_dir)
     copy_buffer_content_to_other_buffer(buffer, new_buffer)
     copy_buffer_content_to_other_buffer(buffer_test, new_buffer_test)
     return new_buffer, new_buffer_test
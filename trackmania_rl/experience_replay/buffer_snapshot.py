@@ -0,0 +1,164 @@
+"""
+In this file, we define the BufferSnapshotter class, which saves the content of replay buffers to disk such that the learner can resume
+training from full buffers after a restart, instead of waiting for memory_size_start_learn transitions to be collected again.
+
+A snapshot directory contains:
+    - metadata.json: snapshot format version, whether the snapshot is complete, and the shape/dtype of each saved column
+    - {buffer_name}/{column_name}.npy: one file per column of the buffer's ColumnarStorage
+    - {buffer_name}/state.joblib: storage length, writer cursor, sampler state (including the sum tree of prioritized samplers) and the
+      map and rollout of each row
+
+Snapshots are incremental: ColumnarStorage tracks which chunks of rows were modified since the last snapshot, and only those chunks
+are rewritten. Snapshots are written by a background thread which copies one chunk at a time while holding the buffer's lock. A
+final pass, holding the locks for a short time, rewrites the chunks modified during the first pass and saves the writer and sampler
+states, such that a complete snapshot is a consistent view of the buffers.
+"""
+import json
+import os
+import threading
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict
+
+import joblib
+import numpy as np
+from torchrl.data import ReplayBuffer
+
+from trackmania_rl.experience_replay.columnar_storage import snapshot_chunk_size
+
+# Increment when the layout of snapshots changes, older snapshots are then ignored
+snapshot_format_version = 1
+
+
+class BufferSnapshotter:
+    def __init__(self, snapshot_dir: Path):
+        self.snapshot_dir = snapshot_dir
+        self._thread = None
+        # Storage whose content was last saved for each buffer name: a new storage (e.g. after resize_buffers) is saved entirely.
+        self._saved_storages = {}
+        self._metadata = None
+
+    def _read_metadata(self):
+        try:
+            with open(self.snapshot_dir / "metadata.json", "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_metadata(self, metadata) -> None:
+        tmp_path = self.snapshot_dir / "metadata.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(tmp_path, self.snapshot_dir / "metadata.json")
+
+    def load(self, buffers: Dict[str, ReplayBuffer]) -> bool:
+        """
+        Restores the content of the buffers from the snapshot, if a complete snapshot saved with the same buffer sizes exists.
+        Columns are read from memory-mapped files, such that they are streamed from disk into the storages.
+        """
+        metadata = self._read_metadata()
+        if metadata is None or metadata["format_version"] != snapshot_format_version or not metadata["complete"]:
+            return False
+        for name, buffer in buffers.items():
+            buffer_metadata = metadata["buffers"].get(name)
+            if (
+                buffer_metadata is None
+                or buffer_metadata["storage_class"] != type(buffer._storage).__name__
+                or buffer_metadata["max_size"] != buffer._storage.max_size
+            ):
+                print(f"Replay buffer snapshot does not match buffer {name}, it is not loaded.")
+                return False
+
+        for name, buffer in buffers.items():
+            state = joblib.load(self.snapshot_dir / name / "state.joblib")
+            columns = {
+                column_name: np.load(self.snapshot_dir / name / f"{column_name}.npy", mmap_mode="r")
+                for column_name in metadata["buffers"][name]["columns"]
+            }
+            with buffer._replay_lock:
+                buffer._storage.load_state_dict({"_columns": columns, "_length": state["length"]})
+                buffer._writer.load_state_dict(state["writer"])
+                buffer._sampler.load_state_dict(state["sampler"])
+                if "provenance" in state:
+                    buffer.provenance.load_state_dict(state["provenance"])
+            self._saved_storages[name] = buffer._storage
+        self._metadata = metadata
+        return True
+
+    def save_in_background(self, buffers: Dict[str, ReplayBuffer]) -> None:
+        """
+        Starts writing a snapshot of the buffers in a background thread. Does nothing if the previous snapshot is still being written.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self.save, args=(dict(buffers),), daemon=True)
+        self._thread.start()
+
+    def wait(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def save(self, buffers: Dict[str, ReplayBuffer]) -> None:
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        metadata = self._metadata if self._metadata is not None else self._read_metadata()
+        if metadata is None or metadata["format_version"] != snapshot_format_version:
+            metadata = {"format_version": snapshot_format_version, "buffers": {}}
+        # Files are about to be modified: the previous snapshot is no longer valid until this one completes.
+        metadata["complete"] = False
+        self._write_metadata(metadata)
+
+        for name, buffer in buffers.items():
+            (self.snapshot_dir / name).mkdir(exist_ok=True)
+            if self._saved_storages.get(name) is not buffer._storage or name not in metadata["buffers"]:
+                buffer._storage.mark_all_dirty()
+                metadata["buffers"][name] = {"columns": {}}
+                self._saved_storages[name] = buffer._storage
+            # First pass, while the learner keeps writing to the buffer. Chunks modified in the meantime are written again below.
+            self._save_dirty_chunks(name, buffer, metadata["buffers"][name])
+
+        with ExitStack() as stack:
+            for buffer in buffers.values():
+                stack.enter_context(buffer._replay_lock)
+            for name, buffer in buffers.items():
+                buffer_metadata = metadata["buffers"][name]
+                self._save_dirty_chunks(name, buffer, buffer_metadata)
+                buffer_metadata["storage_class"] = type(buffer._storage).__name__
+                buffer_metadata["max_size"] = buffer._storage.max_size
+                joblib.dump(
+                    {
+                        "length": len(buffer._storage),
+                        "writer": buffer._writer.state_dict(),
+                        "sampler": buffer._sampler.state_dict(),
+                        "provenance": buffer.provenance.state_dict(),
+                    },
+                    self.snapshot_dir / name / "state.joblib",
+                )
+
+        metadata["complete"] = True
+        self._write_metadata(metadata)
+        self._metadata = metadata
+
+    def _save_dirty_chunks(self, name: str, buffer: ReplayBuffer, buffer_metadata) -> None:
+        with buffer._replay_lock:
+            columns = buffer._storage.snapshot_columns()
+            dirty_chunks = {column_name: buffer._storage.pop_dirty_chunks(column_name) for column_name in columns}
+
+        for column_name, chunks in dirty_chunks.items():
+            if len(chunks) == 0:
+                continue
+            column = columns[column_name]
+            path = self.snapshot_dir / name / f"{column_name}.npy"
+            dtype = buffer._storage.copy_to_host(column[:0]).dtype
+            column_metadata = {"shape": list(column.shape), "dtype": dtype.str}
+            if buffer_metadata["columns"].get(column_name) != column_metadata or not path.exists():
+                snapshot_column = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(column.shape))
+                buffer_metadata["columns"][column_name] = column_metadata
+            else:
+                snapshot_column = np.load(path, mmap_mode="r+")
+            for chunk in chunks:
+                rows = slice(chunk * snapshot_chunk_size, (chunk + 1) * snapshot_chunk_size)
+                with buffer._replay_lock:
+                    chunk_content = buffer._storage.copy_to_host(column[rows])
+                snapshot_column[rows] = chunk_content
+            snapshot_column.flush()
+            del snapshot_column
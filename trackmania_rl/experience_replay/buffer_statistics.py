@@ -0,0 +1,109 @@
+"""
+In this file, we define the ColumnStatistics class, which maintains per-feature statistics (mean, standard deviation, min, max and
+approximate quantiles) of a column of a ColumnarStorage, without reading the whole column each time they are requested.
+
+Rows of the column are grouped in chunks. Statistics are kept per chunk, and a chunk is marked stale when one of its rows is written
+(including when a transition is overwritten in the ring). When statistics are requested, only stale chunks are read again, then the
+statistics of all chunks are merged. Means and variances are merged with the parallel algorithm of Chan et al., which is exact (up to
+rounding) for any split of the rows into chunks.
+
+Quantiles are estimated from a sketch kept per chunk: sketch_size rows taken at a regular stride in the chunk, each standing for
+count / sketch_size rows of the chunk. Quantiles of the column are the weighted quantiles of the sketches of all chunks.
+
+Statistics are not updated row by row when transitions are written and overwritten: min, max and quantiles cannot be updated when a row
+leaves the column without reading the rows that remain, and a per-row update would add work to every insertion, whereas statistics are
+only requested every few minutes. Marking a chunk stale on write costs one index operation, and a request reads each modified chunk once.
+"""
+from typing import Callable, Dict, List, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+
+
+# Quantiles returned by ColumnStatistics.compute()
+quantile_levels = (0.01, 0.25, 0.5, 0.75, 0.99)
+
+
+def weighted_quantiles(samples: npt.NDArray, weights: npt.NDArray, levels: tuple) -> npt.NDArray:
+    """
+    Per-feature quantiles of samples of shape (n, *feature_shape), where sample i stands for weights[i] rows.
+    Returns an array of shape (len(levels), *feature_shape).
+    """
+    order = np.argsort(samples, axis=0)
+    sorted_samples = np.take_along_axis(samples, order, axis=0)
+    cumulative_weights = np.cumsum(weights[order], axis=0)
+    cumulative_weights /= cumulative_weights[-1]
+    # First sample whose cumulative weight reaches each level
+    positions = np.minimum(np.stack([(cumulative_weights < level).sum(axis=0) for level in levels]), len(samples) - 1)
+    return np.take_along_axis(sorted_samples, positions, axis=0)
+
+
+class ColumnStatistics:
+    def __init__(self, chunk_size: int, sketch_size: int = 32):
+        self._chunk_size = chunk_size
+        self._sketch_size = sketch_size
+        self._sketches: List[Optional[npt.NDArray]] = []  # Rows sampled in each chunk, for quantiles
+        self._stale_chunks = np.zeros(0, dtype=bool)
+        self._count = np.zeros(0, dtype=np.int64)
+        self._mean = None
+        self._m2 = None  # Sum of squared differences to the mean of the chunk
+        self._min = None
+        self._max = None
+
+    def _resize(self, n_chunks: int, feature_shape: tuple) -> None:
+        old_n_chunks = len(self._count)
+        self._stale_chunks = np.concatenate([self._stale_chunks, np.ones(n_chunks - old_n_chunks, dtype=bool)])
+        self._count = np.concatenate([self._count, np.zeros(n_chunks - old_n_chunks, dtype=np.int64)])
+        self._sketches.extend([None] * (n_chunks - old_n_chunks))
+        for name in ["_mean", "_m2", "_min", "_max"]:
+            old_values = getattr(self, name)
+            values = np.zeros((n_chunks,) + feature_shape, dtype=np.float64)
+            if old_values is not None:
+                values[:old_n_chunks] = old_values
+            setattr(self, name, values)
+
+    def mark_stale(self, index: Union[int, npt.NDArray]) -> None:
+        chunks = np.asarray(index) // self._chunk_size
+        # Chunks which are not tracked yet will be read anyway
+        self._stale_chunks[chunks[chunks < len(self._stale_chunks)]] = True
+
+    def compute(
+        self, column: npt.NDArray, length: int, copy_to_host: Callable[[npt.NDArray], npt.NDArray] = np.asarray
+    ) -> Dict[str, npt.NDArray]:
+        """
+        Returns the statistics of rows [0, length) of the column, reading only the chunks modified since the previous call.
+        """
+        n_chunks = -(-length // self._chunk_size)
+        if n_chunks > len(self._count):
+            self._resize(n_chunks, tuple(column.shape[1:]))
+        for chunk in np.flatnonzero(self._stale_chunks[:n_chunks]).tolist():
+            rows = copy_to_host(column[chunk * self._chunk_size : min(length, (chunk + 1) * self._chunk_size)]).astype(np.float64)
+            self._count[chunk] = len(rows)
+            self._mean[chunk] = rows.mean(axis=0)
+            self._m2[chunk] = np.square(rows - self._mean[chunk]).sum(axis=0)
+            self._min[chunk] = rows.min(axis=0)
+            self._max[chunk] = rows.max(axis=0)
+            self._sketches[chunk] = rows[:: max(1, len(rows) // self._sketch_size)][: self._sketch_size].copy()
+            self._stale_chunks[chunk] = False
+
+        count = self._count[:n_chunks]
+        total_count = max(1, count.sum())
+        weights = (count / total_count).reshape((-1,) + (1,) * (self._mean.ndim - 1))
+        mean = (weights * self._mean[:n_chunks]).sum(axis=0)
+        m2 = self._m2[:n_chunks].sum(axis=0) + (weights * total_count * np.square(self._mean[:n_chunks] - mean)).sum(axis=0)
+        non_empty = count > 0
+        if non_empty.any():
+            chunks = np.flatnonzero(non_empty).tolist()
+            sketches = [self._sketches[chunk] for chunk in chunks]
+            sketch_lengths = [len(sketch) for sketch in sketches]
+            sketch_weights = np.repeat(count[chunks] / sketch_lengths, sketch_lengths)
+            quantiles = weighted_quantiles(np.concatenate(sketches), sketch_weights, quantile_levels)
+        else:
+            quantiles = np.full((len(quantile_levels),) + tuple(column.shape[1:]), np.nan)
+        return {
+            "mean": mean,
+            "std": np.sqrt(m2 / total_count),
+            "min": self._min[:n_chunks][non_empty].min(axis=0, initial=np.inf),
+            "max": self._max[:n_chunks][non_empty].max(axis=0, initial=-np.inf),
+            "quantiles": quantiles,
+        }
@@ -0,0 +1,474 @@
+"""
+In this file, we define the ColumnarStorage class, a torchrl Storage used as the backend of our ReplayBuffers.
+
+Instead of holding one Experience object per transition (as a torchrl ListStorage would), ColumnarStorage keeps each field of Experience
+in its own preallocated array of shape (max_size, *field_shape). Rows are written at the indices provided by the writer of the buffer
+(RingWriter by default), which makes the storage behave as a ring: once full, the oldest transitions are overwritten.
+
+Sampling a batch is then a handful of fancy-index gathers (one per field), instead of a Python loop over every attribute of every
+sampled transition.
+
+Arrays may optionally be memory-mapped files, such that the replay buffer can be larger than the available RAM.
+"""
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import numpy.typing as npt
+import torch
+from torchrl.data.replay_buffers.storages import Storage
+from torchrl.data.replay_buffers.utils import INT_CLASSES, _to_numpy
+
+from trackmania_rl.experience_replay.buffer_statistics import ColumnStatistics
+from trackmania_rl.experience_replay.experience_replay_interface import Experience, ExperienceBatch
+
+# Granularity at which modified rows are tracked, used to write incremental snapshots of a storage
+snapshot_chunk_size = 4096
+
+# dtype used to store each field of Experience
+experience_fields_dtypes = {
+    "state_img": np.uint8,
+    "state_float": np.float32,
+    "state_potential": np.float32,
+    "action": np.int64,
+    "n_steps": np.int64,
+    "rewards": np.float32,
+    "next_state_img": np.uint8,
+    "next_state_float": np.float32,
+    "next_state_potential": np.float32,
+    "gammas": np.float32,
+    "terminal_actions": np.float32,
+}
+
+
+def gather_rows_into_pinned_memory(column: npt.NDArray, index: npt.NDArray, out: Optional[npt.NDArray] = None) -> npt.NDArray:
+    """
+    Gather column[index] into a page-locked array, so that the subsequent host-to-device copy can be non-blocking.
+    The array is freshly allocated, unless a page-locked array of the right shape is provided with out.
+    Without CUDA, the array is not page-locked.
+    """
+    if out is None:
+        out = torch.empty(
+            size=(len(index),) + column.shape[1:],
+            dtype=torch.from_numpy(np.empty(0, dtype=column.dtype)).dtype,
+            pin_memory=torch.cuda.is_available(),
+        ).numpy()  # view the pinned tensor as a numpy array, they share memory
+    np.take(column, index, axis=0, out=out, mode="clip")  # mode="clip" avoids an intermediate copy, index is already within bounds
+    return out
+
+
+class ColumnarStorage(Storage):
+    """
+    Replay storage which keeps each field of Experience in its own preallocated numpy array, indexed as a ring.
+
+    Arrays are allocated when the first transition is written, as this is the first time the shape of each field is known.
+
+    The storage accepts Experience objects (ReplayBuffer.add()), lists of Experience objects or ExperienceBatch objects
+    (ReplayBuffer.extend()). Reading a single index returns an Experience, reading an array of indices returns an ExperienceBatch.
+
+    If memmap_dir is provided, arrays are np.memmap objects backed by anonymous temporary files created in memmap_dir. These files are
+    deleted by the operating system when the storage is garbage collected, or when the process dies.
+    """
+
+    # Type of the batches written to and read from the storage with set() and rows()
+    batch_type = ExperienceBatch
+
+    def __init__(self, max_size: int, memmap_dir: Optional[Path] = None):
+        super().__init__(max_size)
+        self._columns: Dict[str, npt.NDArray] = {}
+        self._length = 0
+        self._memmap_dir = memmap_dir
+        self._memmap_files = {}
+        self._dirty_chunks: Dict[str, npt.NDArray] = {}
+        self._column_statistics: Dict[str, ColumnStatistics] = {}
+        # Value of _write_counter when each row was last written, used to detect that a row was overwritten since it was sampled
+        self._row_versions = np.zeros(max_size, dtype=np.int64)
+        self._write_counter = 0
+
+    @property
+    def gather_sorted_index(self) -> bool:
+        """
+        Whether samplers should return indices sorted in increasing order.
+        When arrays live on disk, gathering rows in increasing file offset order is much friendlier to the page cache and to readahead.
+        """
+        return self._memmap_dir is not None
+
+    def _make_array(self, name: str, shape: tuple, dtype: np.dtype) -> npt.NDArray:
+        if self._memmap_dir is None:
+            return np.empty(shape, dtype=dtype)
+        self._memmap_dir.mkdir(parents=True, exist_ok=True)
+        self._memmap_files[name] = tempfile.TemporaryFile(prefix=f"{name}_", suffix=".bin", dir=self._memmap_dir)
+        return np.memmap(self._memmap_files[name], dtype=dtype, mode="w+", shape=shape)
+
+    def _resize_array(self, name: str, new_length: int) -> None:
+        """
+        Changes the length of the first dimension of a column, keeping its content.
+        Arrays in RAM are reallocated in place, which does not copy large arrays. Memory-mapped arrays are extended on disk and mapped again.
+        """
+        column = self._columns[name]
+        new_shape = (new_length,) + column.shape[1:]
+        if self._memmap_dir is None:
+            column.resize(new_shape, refcheck=False)
+        else:
+            column.flush()
+            self._memmap_files[name].truncate(int(np.prod(new_shape)) * column.dtype.itemsize)
+            self._columns[name] = np.memmap(self._memmap_files[name], dtype=column.dtype, mode="r+", shape=new_shape)
+
+    def _allocate(self, batch: ExperienceBatch) -> None:
+        for field in Experience.__slots__:
+            field_shape = np.shape(getattr(batch, field)[0])
+            self._columns[field] = self._make_array(field, (self.max_size,) + field_shape, experience_fields_dtypes[field])
+
+    def _set_rows(self, column: npt.NDArray, index: Union[npt.NDArray, slice], values: Any) -> None:
+        column[index] = values
+
+    def copy_to_host(self, values: npt.NDArray) -> npt.NDArray:
+        """
+        Returns a copy of (a part of) a column, as a numpy array.
+        """
+        return np.array(values)
+
+    def _write_rows(self, index: npt.NDArray, batch: ExperienceBatch) -> None:
+        for field, column in self._columns.items():
+            self._set_rows(column, index, getattr(batch, field))
+            self._mark_dirty(field, index)
+
+    def _gather(self, column: npt.NDArray, index: npt.NDArray, pin_memory: bool, out: Optional[npt.NDArray] = None) -> npt.NDArray:
+        return gather_rows_into_pinned_memory(column, index, out) if pin_memory else column[index]
+
+    def _read_rows(self, index: npt.NDArray, pin_memory: bool = True, out: Optional[ExperienceBatch] = None) -> ExperienceBatch:
+        return ExperienceBatch(
+            **{
+                field: self._gather(column, index, pin_memory, None if out is None else getattr(out, field))
+                for field, column in self._columns.items()
+            }
+        )
+
+    def set(self, cursor: Union[int, Sequence[int], slice], data: Any) -> None:
+        if isinstance(cursor, INT_CLASSES):
+            cursor = np.array([cursor])
+            data = [data]
+        elif isinstance(cursor, slice):
+            cursor = np.arange(self.max_size)[cursor]
+        else:
+            cursor = np.asarray(_to_numpy(cursor)).reshape(-1)
+        if not isinstance(data, self.batch_type):
+            data = ExperienceBatch.from_experiences(data)
+        if len(cursor) == 0:
+            return
+        if len(np.unique(cursor)) < len(cursor):
+            # A single write wrapped around the ring more than once: only the last transition written at each index is kept.
+            last_positions = len(cursor) - 1 - np.unique(cursor[::-1], return_index=True)[1]
+            cursor, data = cursor[last_positions], data.select(last_positions)
+        if not self._columns:
+            self._allocate(data)
+        self._write_rows(cursor, data)
+        self._write_counter += 1
+        self._row_versions[cursor] = self._write_counter
+        self._length = max(self._length, int(cursor.max()) + 1)
+
+    def get(self, index: Union[int, Sequence[int], slice]) -> Union[Experience, ExperienceBatch]:
+        if isinstance(index, INT_CLASSES):
+            batch = self._read_rows(np.array([index]), pin_memory=False)
+            return Experience(**{field: getattr(batch, field)[0] for field in Experience.__slots__})
+        if isinstance(index, slice):
+            index = np.arange(self._length)[index]
+        return self._read_rows(np.asarray(_to_numpy(index)).reshape(-1))
+
+    def get_into(self, index: npt.NDArray, out: ExperienceBatch) -> ExperienceBatch:
+        """
+        Same as get() for an array of indices, but rows are gathered into the page-locked arrays of out (previously returned by get()
+        for the same number of indices) instead of newly allocated arrays.
+        """
+        return self._read_rows(np.asarray(_to_numpy(index)).reshape(-1), out=out)
+
+    def begin_read(self, index: npt.NDArray, out: Optional[ExperienceBatch] = None) -> Callable[[], ExperienceBatch]:
+        """
+        Same as get() for an array of indices (or get_into() if out is provided), in two steps: this method must be called while holding
+        the buffer's lock, and the returned function completes the batch once the lock was released. Rows are read entirely by this
+        method, except by storages whose reads are expensive (see CompressedFramePoolStorage, which decodes frames after the lock).
+        """
+        batch = self._read_rows(np.asarray(_to_numpy(index)).reshape(-1), out=out)
+        return lambda: batch
+
+    def row_versions(self, index: npt.NDArray) -> npt.NDArray:
+        """
+        Returns a number which changes each time a row is written, for each row in index.
+        """
+        return self._row_versions[np.asarray(_to_numpy(index))]
+
+    def column(self, name: str) -> npt.NDArray:
+        """
+        Returns a view on the rows of a column that currently contain a transition.
+        """
+        return self._columns[name][: self._length]
+
+    def rows(self, start: int, stop: int) -> ExperienceBatch:
+        """
+        Returns an ExperienceBatch containing views on rows [start, stop). Unlike get(), no copy is made.
+        """
+        return ExperienceBatch(**{field: column[start:stop] for field, column in self._columns.items()})
+
+    def __len__(self) -> int:
+        return self._length
+
+    # Columns which are not indexed by transition, and are not resized with the ring
+    non_row_columns = ()
+
+    def grow(self, new_max_size: int) -> None:
+        """
+        Increases the capacity of the storage in place. Transitions keep their index.
+        Views previously returned by column() and rows() must not be used anymore.
+        """
+        assert new_max_size >= self.max_size
+        for name in list(self._columns):
+            if name not in self.non_row_columns:
+                self._resize_array(name, new_max_size)
+        self._resize_row_versions(new_max_size)
+        self.max_size = new_max_size
+
+    def _resize_row_versions(self, new_max_size: int) -> None:
+        self._row_versions.resize(new_max_size, refcheck=False)
+
+    # Columns which are not written to snapshots, because they can be rebuilt from other columns in load_state_dict()
+    snapshot_excluded_columns = ()
+
+    def _dirty_chunks_of(self, name: str) -> npt.NDArray:
+        n_chunks = -(-len(self._columns[name]) // snapshot_chunk_size)
+        dirty_chunks = self._dirty_chunks.get(name)
+        if dirty_chunks is None or len(dirty_chunks) != n_chunks:
+            # New or resized column: all chunks need to be written
+            dirty_chunks = self._dirty_chunks[name] = np.ones(n_chunks, dtype=bool)
+        return dirty_chunks
+
+    def _mark_dirty(self, name: str, index: Union[int, npt.NDArray]) -> None:
+        self._dirty_chunks_of(name)[np.asarray(index) // snapshot_chunk_size] = True
+        if name in self._column_statistics:
+            self._column_statistics[name].mark_stale(index)
+
+    def column_statistics(self, name: str) -> Dict[str, npt.NDArray]:
+        """
+        Returns the per-feature mean, std, min, max and approximate quantiles (see buffer_statistics.quantile_levels) of the rows of a
+        column that currently contain a transition. Statistics are kept per chunk of rows, and only the chunks written since the previous
+        call are read again.
+        """
+        if name not in self._column_statistics:
+            self._column_statistics[name] = ColumnStatistics(snapshot_chunk_size)
+        return self._column_statistics[name].compute(self._columns[name], self._statistics_length(name), self.copy_to_host)
+
+    def _statistics_length(self, name: str) -> int:
+        """
+        Number of rows of a column, starting from the first one, included in column_statistics().
+        """
+        return self._length
+
+    def snapshot_columns(self) -> Dict[str, npt.NDArray]:
+        return {name: column for name, column in self._columns.items() if name not in self.snapshot_excluded_columns}
+
+    def pop_dirty_chunks(self, name: str) -> npt.NDArray:
+        """
+        Returns the indices of chunks of rows of a column modified since the last call, and marks them as clean.
+        Rows [chunk * snapshot_chunk_size, (chunk + 1) * snapshot_chunk_size) belong to a given chunk.
+        """
+        dirty_chunks = self._dirty_chunks_of(name)
+        chunks = np.flatnonzero(dirty_chunks)
+        dirty_chunks[:] = False
+        return chunks
+
+    def mark_all_dirty(self) -> None:
+        self._dirty_chunks.clear()
+
+    def _empty(self) -> None:
+        self._length = 0
+        self._column_statistics.clear()
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {
+            "_columns": self._columns,
+            "_length": self._length,
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        for name, values in state_dict["_columns"].items():
+            if name not in self._columns or self._columns[name].shape != values.shape:
+                self._columns[name] = self._make_array(name, values.shape, values.dtype)
+            self._set_rows(self._columns[name], slice(None), values)
+            self._dirty_chunks_of(name)[:] = False
+        self._length = state_dict["_length"]
+        self._column_statistics.clear()
+
+
+class FramePoolStorage(ColumnarStorage):
+    """
+    ColumnarStorage variant where state_img and next_state_img are not stored per transition, but in a pool of frames.
+
+    Within a rollout, the next_state_img of a transition is the very same numpy array as the state_img of a later transition. The storage
+    remembers the frames it has written most recently (by identity), such that each frame is written to the pool only once.
+    Transitions hold integer indices into the pool (state_img_slot and next_state_img_slot).
+
+    Pool slots are reference counted: a slot is released when the last transition referring to it is overwritten in the ring.
+    The pool is slightly larger than max_size, and grows if all slots are in use.
+
+    With frames of shape (1, 120, 160) this roughly halves the memory used by the replay buffer.
+    """
+
+    image_fields = ("state_img", "next_state_img")
+    snapshot_excluded_columns = ("frame_refcount",)
+    non_row_columns = ("frame_pool", "frame_refcount")
+
+    def __init__(
+        self, max_size: int, memmap_dir: Optional[Path] = None, frame_pool_size_ratio: float = 1.1, recent_frames_window: int = 64
+    ):
+        super().__init__(max_size, memmap_dir)
+        self._frame_pool_size_ratio = frame_pool_size_ratio
+        self._recent_frames_window = recent_frames_window
+        self._recent_frames: OrderedDict = OrderedDict()  # id(frame) -> (frame, slot)
+        self._free_slots: List[int] = []
+
+    def _allocate(self, batch: ExperienceBatch) -> None:
+        for field in Experience.__slots__:
+            if field in self.image_fields:
+                self._columns[f"{field}_slot"] = self._make_array(f"{field}_slot", (self.max_size,), np.int64)
+            else:
+                field_shape = np.shape(getattr(batch, field)[0])
+                self._columns[field] = self._make_array(field, (self.max_size,) + field_shape, experience_fields_dtypes[field])
+        frame_pool_size = int(self.max_size * self._frame_pool_size_ratio) + self._recent_frames_window
+        self._columns["frame_pool"] = self._make_array(
+            "frame_pool", (frame_pool_size,) + np.shape(batch.state_img[0]), experience_fields_dtypes["state_img"]
+        )
+        self._columns["frame_refcount"] = self._make_array("frame_refcount", (frame_pool_size,), np.int32)
+        self._columns["frame_refcount"][:] = 0
+        self._free_slots = list(range(frame_pool_size - 1, -1, -1))
+
+    def _frame_pool_size(self) -> int:
+        return len(self._columns["frame_refcount"])
+
+    def _resize_frame_pool(self, new_size: int) -> None:
+        old_size = self._frame_pool_size()
+        for name in self.non_row_columns:
+            self._resize_array(name, new_size)
+        self._columns["frame_refcount"][old_size:] = 0
+        self._free_slots.extend(range(new_size - 1, old_size - 1, -1))
+
+    def _acquire_slot(self) -> int:
+        if not self._free_slots:
+            self._resize_frame_pool(int(self._frame_pool_size() * 1.25) + 1)
+        return self._free_slots.pop()
+
+    def grow(self, new_max_size: int) -> None:
+        super().grow(new_max_size)
+        if self._columns:
+            frame_pool_size = int(new_max_size * self._frame_pool_size_ratio) + self._recent_frames_window
+            if frame_pool_size > self._frame_pool_size():
+                self._resize_frame_pool(frame_pool_size)
+
+    def _release_slots(self, slots: npt.NDArray) -> npt.NDArray:
+        """
+        Decrements the reference count of each slot, and returns the slots which were freed.
+        """
+        refcount = self._columns["frame_refcount"]
+        np.subtract.at(refcount, slots, 1)
+        freed_slots = np.unique(slots[refcount[slots] == 0])
+        self._free_slots.extend(freed_slots.tolist())
+        return freed_slots
+
+    def _write_frames(self, slots: npt.NDArray, frames: List[npt.NDArray]) -> None:
+        self._set_rows(self._columns["frame_pool"], slots, frames)
+        self._mark_dirty("frame_pool", slots)
+
+    def _frames_to_slots(self, frames: Sequence[npt.NDArray]) -> npt.NDArray:
+        """
+        Returns the pool slot of each frame, writing to the pool the frames that have not been seen recently.
+        Each returned slot has its reference count incremented by one.
+
+        The window of recent frames holds one reference on each slot it contains, so that a slot cannot be released and reused
+        while a later transition may still refer to it.
+        """
+        slots = np.empty(len(frames), dtype=np.int64)
+        new_frames = []
+        new_slots = []
+        for i, frame in enumerate(frames):
+            recent_frame = self._recent_frames.get(id(frame))
+            if recent_frame is None:
+                slot = self._acquire_slot()
+                new_frames.append(frame)
+                new_slots.append(slot)
+                self._columns["frame_refcount"][slot] += 1  # Reference held by the window of recent frames
+                self._recent_frames[id(frame)] = (frame, slot)
+                if len(self._recent_frames) > self._recent_frames_window:
+                    _, (_, forgotten_slot) = self._recent_frames.popitem(last=False)
+                    self._release_slots(np.array([forgotten_slot]))
+            else:
+                slot = recent_frame[1]
+                self._recent_frames.move_to_end(id(frame))
+            # The pool may have been reallocated by _acquire_slot(), the column is looked up again
+            self._columns["frame_refcount"][slot] += 1
+            slots[i] = slot
+        if new_frames:
+            # New frames are written at once. Their slots cannot be released in the meantime, as each frame is referenced by a row.
+            self._write_frames(np.array(new_slots), new_frames)
+        return slots
+
+    def _write_rows(self, index: npt.NDArray, batch: ExperienceBatch) -> None:
+        # Slots of the new frames are acquired before the slots of overwritten transitions are released.
+        # This way, a frame still in the window of recent frames is never evicted from the pool.
+        # Frames are visited row by row, such that frames shared by nearby transitions of a large batch are found in the window.
+        frames = [frame for row_frames in zip(*(getattr(batch, field) for field in self.image_fields)) for frame in row_frames]
+        slots = self._frames_to_slots(frames).reshape(len(index), len(self.image_fields))
+        new_slots = {field: slots[:, i] for i, field in enumerate(self.image_fields)}
+        overwritten_index = index[index < self._length]
+        for field in self.image_fields:
+            self._release_slots(self._columns[f"{field}_slot"][overwritten_index])
+            self._set_rows(self._columns[f"{field}_slot"], index, new_slots[field])
+            self._mark_dirty(f"{field}_slot", index)
+        for field in Experience.__slots__:
+            if field not in self.image_fields:
+                self._set_rows(self._columns[field], index, getattr(batch, field))
+                self._mark_dirty(field, index)
+
+    def _read_rows(self, index: npt.NDArray, pin_memory: bool = True, out: Optional[ExperienceBatch] = None) -> ExperienceBatch:
+        return ExperienceBatch(
+            **{
+                field: self._gather(
+                    self._columns["frame_pool"] if field in self.image_fields else self._columns[field],
+                    self._columns[f"{field}_slot"][index] if field in self.image_fields else index,
+                    pin_memory,
+                    None if out is None else getattr(out, field),
+                )
+                for field in Experience.__slots__
+            }
+        )
+
+    def rows(self, start: int, stop: int) -> ExperienceBatch:
+        # A single view object is created per pool slot, such that another FramePoolStorage receiving these rows can deduplicate frames.
+        frame_views = {}
+        frame_pool = self._columns["frame_pool"]
+        return ExperienceBatch(
+            **{
+                field: [frame_views.setdefault(slot, frame_pool[slot]) for slot in self._columns[f"{field}_slot"][start:stop].tolist()]
+                if field in self.image_fields
+                else self._columns[field][start:stop]
+                for field in Experience.__slots__
+            }
+        )
+
+    def _empty(self) -> None:
+        super()._empty()
+        self._recent_frames.clear()
+        if self._columns:
+            self._columns["frame_refcount"][:] = 0
+            self._free_slots = list(range(len(self._columns["frame_refcount"]) - 1, -1, -1))
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        super().load_state_dict(state_dict)
+        # Reference counts are rebuilt from the transitions, as references held by the window of recent frames are not restored.
+        self._recent_frames.clear()
+        if len(self._columns.get("frame_refcount", [])) != len(self._columns["frame_pool"]):
+            self._columns["frame_refcount"] = self._make_array("frame_refcount", (len(self._columns["frame_pool"]),), np.int32)
+        refcount = self._columns["frame_refcount"]
+        refcount[:] = np.bincount(
+            np.concatenate([self.column(f"{field}_slot") for field in self.image_fields]), minlength=len(refcount)
+        )
+        self._free_slots = np.flatnonzero(refcount == 0)[::-1].tolist()
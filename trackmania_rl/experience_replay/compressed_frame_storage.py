@@ -0,0 +1,242 @@
+"""
+In this file, we define the CompressedFramePoolStorage class, a FramePoolStorage whose frames are kept compressed in RAM.
+
+Track frames compress well: large areas of sky and road are uniform, and neighbouring pixels are similar. Before compression, each row
+of a frame is delta-encoded along its width (as PNG's "Sub" filter), which turns smooth gradients into runs of small values. Each frame
+is then compressed independently with zlib, such that a frame can be decoded without decoding any other frame.
+
+Frames are compressed when transitions are added, and decoded when a batch is gathered. Both are done by a pool of threads, as zlib
+releases the GIL. The most recently decoded frames are kept in a small LRU cache.
+
+Batches prepared by PrefetchingReplayBuffer workers are decoded after the buffer's lock is released (see begin_read()): the other
+columns and the compressed frames of the sampled rows are read under the lock, and decoded without it. Compressed frames are immutable
+bytes objects, which stay valid even if their slot is released meanwhile.
+
+Bytes used per transition and time spent decoding are reported by compression_stats(), and logged to tensorboard by the learner.
+"""
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+from torchrl.data.replay_buffers.utils import _to_numpy
+
+from trackmania_rl.experience_replay.columnar_storage import FramePoolStorage, experience_fields_dtypes
+from trackmania_rl.experience_replay.experience_replay_interface import Experience, ExperienceBatch
+
+
+def encode_frame(frame: npt.NDArray, compression_level: int) -> bytes:
+    frame = np.ascontiguousarray(frame, dtype=np.uint8)
+    delta = np.empty_like(frame)
+    delta[..., 0] = frame[..., 0]
+    np.subtract(frame[..., 1:], frame[..., :-1], out=delta[..., 1:])  # uint8 arithmetic wraps around, which cumsum() undoes
+    return zlib.compress(delta, compression_level)
+
+
+def decode_frame(data: bytes, frame_shape: tuple) -> npt.NDArray:
+    delta = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(frame_shape)
+    return np.cumsum(delta, axis=-1, dtype=np.uint8)
+
+
+class CompressedFramePoolStorage(FramePoolStorage):
+    """
+    FramePoolStorage variant where each slot of the frame pool holds a compressed frame (a bytes object) instead of a row of a
+    preallocated array. Reference counting, deduplication and the layout of the other columns are unchanged.
+
+    Compressed frames are held in a Python list: they are not memory-mapped even if memmap_dir is provided, and they are not saved
+    by BufferSnapshotter.
+    """
+
+    non_row_columns = ("frame_refcount",)
+
+    def __init__(
+        self,
+        max_size: int,
+        memmap_dir: Optional[Path] = None,
+        frame_pool_size_ratio: float = 1.1,
+        recent_frames_window: int = 64,
+        compression_level: int = 1,
+        n_codec_threads: int = 4,
+        decoded_frames_cache_size: int = 1024,
+    ):
+        super().__init__(max_size, memmap_dir, frame_pool_size_ratio, recent_frames_window)
+        self._compression_level = compression_level
+        self._codec_pool = ThreadPoolExecutor(max_workers=n_codec_threads)
+        self._decoded_frames_cache_size = decoded_frames_cache_size
+        self._decoded_frames: OrderedDict = OrderedDict()  # slot -> decoded frame
+        # Protects the cache and the decoding statistics, which are updated by workers without the buffer's lock
+        self._decoded_frames_lock = threading.Lock()
+        self._compressed_frames: List[Optional[bytes]] = []
+        self._compressed_frames_bytes = 0
+        self._frame_shape = None
+        self._decode_duration = 0.0
+        self._decoded_batches = 0
+        self._decode_cache_hits = 0
+        self._decode_cache_misses = 0
+
+    def _allocate(self, batch: ExperienceBatch) -> None:
+        for field in Experience.__slots__:
+            if field in self.image_fields:
+                self._columns[f"{field}_slot"] = self._make_array(f"{field}_slot", (self.max_size,), np.int64)
+            else:
+                field_shape = np.shape(getattr(batch, field)[0])
+                self._columns[field] = self._make_array(field, (self.max_size,) + field_shape, experience_fields_dtypes[field])
+        frame_pool_size = int(self.max_size * self._frame_pool_size_ratio) + self._recent_frames_window
+        self._frame_shape = np.shape(batch.state_img[0])
+        self._compressed_frames = [None] * frame_pool_size
+        self._columns["frame_refcount"] = self._make_array("frame_refcount", (frame_pool_size,), np.int32)
+        self._columns["frame_refcount"][:] = 0
+        self._free_slots = list(range(frame_pool_size - 1, -1, -1))
+
+    def _resize_frame_pool(self, new_size: int) -> None:
+        self._compressed_frames.extend([None] * (new_size - self._frame_pool_size()))
+        super()._resize_frame_pool(new_size)
+
+    def _release_slots(self, slots: npt.NDArray) -> npt.NDArray:
+        freed_slots = super()._release_slots(slots)
+        with self._decoded_frames_lock:
+            for slot in freed_slots.tolist():
+                self._compressed_frames_bytes -= len(self._compressed_frames[slot])
+                self._compressed_frames[slot] = None
+                self._decoded_frames.pop(slot, None)
+        return freed_slots
+
+    def _write_frames(self, slots: npt.NDArray, frames: List[npt.NDArray]) -> None:
+        compressed_frames = self._codec_pool.map(encode_frame, frames, [self._compression_level] * len(frames))
+        for slot, compressed_frame in zip(slots.tolist(), compressed_frames):
+            self._compressed_frames[slot] = compressed_frame
+            self._compressed_frames_bytes += len(compressed_frame)
+
+    def _snapshot_slots(self, slots: npt.NDArray) -> tuple[list, list]:
+        """
+        Returns the cached decoded frame of each slot (None if it is not cached), and the compressed frame of each slot which is not
+        cached. Must be called while holding the buffer's lock, the returned frames can be decoded after it was released.
+        """
+        with self._decoded_frames_lock:
+            cached_frames = []
+            for slot in slots.tolist():
+                cached_frame = self._decoded_frames.get(slot)
+                if cached_frame is not None:
+                    self._decoded_frames.move_to_end(slot)
+                cached_frames.append(cached_frame)
+        compressed_frames = [
+            self._compressed_frames[slot] if cached_frame is None else None for slot, cached_frame in zip(slots.tolist(), cached_frames)
+        ]
+        return cached_frames, compressed_frames
+
+    def _decode_snapshot(self, slots: npt.NDArray, cached_frames: list, compressed_frames: list) -> npt.NDArray:
+        """
+        Returns an array containing the decoded frame of each slot, from the frames returned by _snapshot_slots(slots).
+        """
+        decoded = np.empty((len(slots),) + self._frame_shape, dtype=np.uint8)
+        positions_to_decode = []
+        for i, cached_frame in enumerate(cached_frames):
+            if cached_frame is None:
+                positions_to_decode.append(i)
+            else:
+                decoded[i] = cached_frame
+        decoded_frames = list(
+            self._codec_pool.map(
+                decode_frame, [compressed_frames[i] for i in positions_to_decode], [self._frame_shape] * len(positions_to_decode)
+            )
+        )
+        with self._decoded_frames_lock:
+            for i, frame in zip(positions_to_decode, decoded_frames):
+                decoded[i] = frame
+                slot = int(slots[i])
+                # The slot may have been released, or reused for another frame, since the snapshot
+                if self._compressed_frames[slot] is compressed_frames[i]:
+                    self._decoded_frames[slot] = frame
+                    if len(self._decoded_frames) > self._decoded_frames_cache_size:
+                        self._decoded_frames.popitem(last=False)
+            self._decode_cache_hits += len(slots) - len(positions_to_decode)
+            self._decode_cache_misses += len(positions_to_decode)
+        return decoded
+
+    def _decode_slots(self, slots: npt.NDArray) -> npt.NDArray:
+        """
+        Returns an array containing the decoded frame of each slot.
+        """
+        return self._decode_snapshot(slots, *self._snapshot_slots(slots))
+
+    def _begin_read_rows(self, index: npt.NDArray, pin_memory: bool, out: Optional[ExperienceBatch]) -> Callable[[], ExperienceBatch]:
+        # Frames shared by several sampled transitions (e.g. as state_img of one and next_state_img of another) are decoded once.
+        unique_slots, inverse = np.unique(
+            np.concatenate([self._columns[f"{field}_slot"][index] for field in self.image_fields]), return_inverse=True
+        )
+        frames_snapshot = self._snapshot_slots(unique_slots)
+        frame_index = dict(zip(self.image_fields, np.split(inverse, len(self.image_fields))))
+        columns = {
+            field: self._gather(self._columns[field], index, pin_memory, None if out is None else getattr(out, field))
+            for field in Experience.__slots__
+            if field not in self.image_fields
+        }
+
+        def finish_read() -> ExperienceBatch:
+            decode_start_time = time.perf_counter()
+            decoded_frames = self._decode_snapshot(unique_slots, *frames_snapshot)
+            with self._decoded_frames_lock:
+                self._decode_duration += time.perf_counter() - decode_start_time
+                self._decoded_batches += 1
+            for field in self.image_fields:
+                columns[field] = self._gather(decoded_frames, frame_index[field], pin_memory, None if out is None else getattr(out, field))
+            return ExperienceBatch(**{field: columns[field] for field in Experience.__slots__})
+
+        return finish_read
+
+    def _read_rows(self, index: npt.NDArray, pin_memory: bool = True, out: Optional[ExperienceBatch] = None) -> ExperienceBatch:
+        return self._begin_read_rows(index, pin_memory, out)()
+
+    def begin_read(self, index: npt.NDArray, out: Optional[ExperienceBatch] = None) -> Callable[[], ExperienceBatch]:
+        """
+        Reads the other columns and takes the compressed frames of the rows while the buffer's lock is held: frames are decoded by the
+        returned function, after the lock was released.
+        """
+        return self._begin_read_rows(np.asarray(_to_numpy(index)).reshape(-1), True, out)
+
+    def rows(self, start: int, stop: int) -> ExperienceBatch:
+        # Each slot is decoded once, such that another FramePoolStorage receiving these rows can deduplicate frames.
+        slots = {field: self._columns[f"{field}_slot"][start:stop] for field in self.image_fields}
+        unique_slots, inverse = np.unique(np.concatenate(list(slots.values())), return_inverse=True)
+        frames = list(self._decode_slots(unique_slots))
+        frame_index = dict(zip(self.image_fields, np.split(inverse, len(self.image_fields))))
+        return ExperienceBatch(
+            **{
+                field: [frames[i] for i in frame_index[field].tolist()] if field in self.image_fields else self._columns[field][start:stop]
+                for field in Experience.__slots__
+            }
+        )
+
+    def _empty(self) -> None:
+        super()._empty()
+        with self._decoded_frames_lock:
+            self._compressed_frames = [None] * len(self._compressed_frames)
+            self._compressed_frames_bytes = 0
+            self._decoded_frames.clear()
+
+    def snapshot_columns(self) -> Dict[str, npt.NDArray]:
+        raise NotImplementedError("Compressed frames cannot be saved in replay buffer snapshots")
+
+    def compression_stats(self) -> Dict[str, float]:
+        """
+        Returns the memory used per transition and the decoding statistics accumulated since the previous call, which are then reset.
+        """
+        bytes_per_row = sum(column.nbytes // len(column) for name, column in self._columns.items() if name not in self.non_row_columns)
+        # Decoding threads update the counters under the lock: they are read and reset at once
+        with self._decoded_frames_lock:
+            stats = {
+                "buffer_bytes_per_transition": (self._compressed_frames_bytes / max(1, self._length)) + bytes_per_row,
+                "buffer_frame_decode_ms_per_batch": 1000 * self._decode_duration / max(1, self._decoded_batches),
+                "buffer_frame_decode_cache_hit_rate": self._decode_cache_hits
+                / max(1, self._decode_cache_hits + self._decode_cache_misses),
+            }
+            self._decode_duration = 0.0
+            self._decoded_batches = 0
+            self._decode_cache_hits = 0
+            self._decode_cache_misses = 0
+        return stats
@@ -0,0 +1,99 @@
+"""
+In this file, we define storages which keep the replay buffer as torch tensors on the training device (usually a GPU).
+
+With these storages, sampling a batch gathers rows with device-side indexing, and buffer_utilities.device_buffer_collate_function()
+prepares mini-races with torch operations on the same device: batches are never copied from host to device. Only the indices of
+sampled transitions (chosen by the sampler on CPU) are sent to the device.
+
+DeviceStorage and DeviceFramePoolStorage behave like ColumnarStorage and FramePoolStorage. Integer bookkeeping columns of
+FramePoolStorage (pool slots of each transition and reference counts) stay in host memory, as they are only used on CPU.
+
+The device may be "cpu", in which case the storages can be used on learners without a GPU.
+"""
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+import torch
+
+from trackmania_rl.experience_replay.columnar_storage import ColumnarStorage, FramePoolStorage
+
+
+class DeviceColumnsMixin:
+    """
+    Overrides the methods of ColumnarStorage which allocate, write and read columns, such that columns are torch tensors on self.device.
+    Columns listed in host_columns remain numpy arrays.
+    """
+
+    host_columns = ()
+
+    def __init__(self, max_size: int, device: Union[str, torch.device] = "cuda", **kwargs):
+        super().__init__(max_size, **kwargs)
+        self.device = torch.device(device)
+
+    def _make_array(self, name: str, shape: tuple, dtype: np.dtype) -> Union[npt.NDArray, torch.Tensor]:
+        if name in self.host_columns:
+            return super()._make_array(name, shape, dtype)
+        return torch.empty(shape, dtype=torch.from_numpy(np.empty(0, dtype=dtype)).dtype, device=self.device)
+
+    def _resize_array(self, name: str, new_length: int) -> None:
+        column = self._columns[name]
+        if isinstance(column, np.ndarray):
+            return super()._resize_array(name, new_length)
+        new_column = torch.empty((new_length,) + tuple(column.shape[1:]), dtype=column.dtype, device=self.device)
+        new_column[: min(len(column), new_length)] = column[:new_length]
+        self._columns[name] = new_column
+
+    def _to_device_tensor(self, values: Any, dtype: torch.dtype) -> torch.Tensor:
+        if isinstance(values, (list, tuple)) and len(values) > 0 and isinstance(values[0], torch.Tensor):
+            values = torch.stack(values)
+        elif not isinstance(values, torch.Tensor):
+            values = torch.as_tensor(np.asarray(values))
+        return values.to(device=self.device, dtype=dtype, non_blocking=True)
+
+    def _set_rows(self, column: Union[npt.NDArray, torch.Tensor], index: Union[npt.NDArray, slice], values: Any) -> None:
+        if isinstance(column, np.ndarray):
+            return super()._set_rows(column, index, values)
+        if not isinstance(index, slice):
+            index = torch.as_tensor(index, device=self.device)
+        column[index] = self._to_device_tensor(values, column.dtype)
+
+    def _gather(
+        self, column: Union[npt.NDArray, torch.Tensor], index: npt.NDArray, pin_memory: bool, out: Optional[torch.Tensor] = None
+    ) -> Union[npt.NDArray, torch.Tensor]:
+        # Batches (pin_memory=True) stay on the device, single transitions read with get(int) are returned as numpy arrays.
+        # Gathered batches are new device tensors, out is ignored.
+        if isinstance(column, np.ndarray):
+            return column[index]
+        rows = column[torch.as_tensor(index, device=self.device)]
+        return rows if pin_memory else rows.cpu().numpy()
+
+    def copy_to_host(self, values: Union[npt.NDArray, torch.Tensor]) -> npt.NDArray:
+        if isinstance(values, np.ndarray):
+            return super().copy_to_host(values)
+        return values.cpu().numpy()
+
+    def column(self, name: str) -> npt.NDArray:
+        return self.copy_to_host(super().column(name))
+
+
+class DeviceStorage(DeviceColumnsMixin, ColumnarStorage):
+    def __init__(self, max_size: int, device: Union[str, torch.device] = "cuda", memmap_dir: Optional[Path] = None):
+        assert memmap_dir is None, "Device storages cannot be memory-mapped"
+        super().__init__(max_size, device)
+
+
+class DeviceFramePoolStorage(DeviceColumnsMixin, FramePoolStorage):
+    host_columns = ("state_img_slot", "next_state_img_slot", "frame_refcount")
+
+    def __init__(
+        self,
+        max_size: int,
+        device: Union[str, torch.device] = "cuda",
+        memmap_dir: Optional[Path] = None,
+        frame_pool_size_ratio: float = 1.1,
+        recent_frames_window: int = 64,
+    ):
+        assert memmap_dir is None, "Device storages cannot be memory-mapped"
+        super().__init__(max_size, device, frame_pool_size_ratio=frame_pool_size_ratio, recent_frames_window=recent_frames_window)
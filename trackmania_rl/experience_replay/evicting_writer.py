@@ -0,0 +1,123 @@
+"""
+In this file, we define the EvictingWriter class, a torchrl Writer which chooses the transitions overwritten by new transitions once the
+replay buffer is full, instead of always overwriting the oldest ones like torchrl's RoundRobinWriter.
+
+Policies:
+    - "lowest_priority"     overwrites the transitions with the lowest priority in the sampler (see CustomPrioritizedSampler)
+    - "most_sampled"        overwrites the transitions which were sampled the largest number of times since they were written
+
+Only the oldest eviction_window_fraction of the buffer may be overwritten, such that a transition stays in the buffer for at least
+(1 - eviction_window_fraction) * max_size insertions, and stale transitions still age out of the buffer.
+
+Finding the best transitions to overwrite for every insertion would require a full scan of the buffer, or a priority queue kept in sync
+with every priority update. Instead, the best eviction_candidates_fraction of the buffer is selected with a single partial sort, and
+used as a queue of rows to overwrite until it is exhausted. The cost of a refill is linear in the size of the buffer, and is amortized
+over eviction_candidates_fraction * max_size insertions. Scores of queued candidates are not updated until the next refill.
+Rows handed out for an insertion are excluded from the refills needed by the same insertion, such that each new transition gets its own
+row.
+"""
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+import numpy.typing as npt
+import torch
+from torchrl.data.replay_buffers.samplers import Sampler
+from torchrl.data.replay_buffers.utils import _to_numpy
+from torchrl.data.replay_buffers.writers import Writer
+
+eviction_policies = ("lowest_priority", "most_sampled")
+
+
+class EvictingWriter(Writer):
+    def __init__(self, policy: str, eviction_window_fraction: float = 0.5, eviction_candidates_fraction: float = 0.02):
+        super().__init__()
+        assert policy in eviction_policies, f"Unknown eviction policy {policy}"
+        assert 0 < eviction_candidates_fraction <= eviction_window_fraction <= 1
+        self.policy = policy
+        self._eviction_window_fraction = eviction_window_fraction
+        self._eviction_candidates_fraction = eviction_candidates_fraction
+        self._sampler: Optional[Sampler] = None
+        self._usage = np.zeros(0, dtype=np.int64)  # Number of times each row was sampled since it was written
+        self._candidates = np.zeros(0, dtype=np.int64)  # Rows to overwrite next, best candidate first
+
+    def register_sampler(self, sampler: Sampler) -> None:
+        """
+        The sampler provides priorities for the "lowest_priority" policy, with its priorities() method.
+        """
+        self._sampler = sampler
+
+    def _resize_usage(self) -> None:
+        if len(self._usage) < self._storage.max_size:
+            self._usage = np.concatenate((self._usage, np.zeros(self._storage.max_size - len(self._usage), dtype=np.int64)))
+
+    def record_sampled(self, index: npt.NDArray) -> None:
+        self._resize_usage()
+        np.add.at(self._usage, np.asarray(_to_numpy(index)), 1)
+
+    def _refill_candidates(self, excluded_rows: npt.NDArray) -> None:
+        """
+        Selects the next candidates among the rows which are not in excluded_rows. Excluded rows are rows already handed out for the
+        current insertion: their version and usage were not updated yet, they would be selected again.
+        """
+        n_rows = len(self._storage)
+        if len(excluded_rows) >= n_rows:
+            # More transitions are inserted at once than the buffer holds: rows are reused, as with a RoundRobinWriter
+            excluded_rows = np.zeros(0, dtype=np.int64)
+        row_versions = self._storage.row_versions(np.arange(n_rows)).astype(np.float64)
+        row_versions[excluded_rows] = np.inf
+        # Oldest rows of the buffer, by order of their last write
+        n_window_rows = max(1, min(int(self._eviction_window_fraction * n_rows), n_rows - len(excluded_rows)))
+        window = np.argpartition(row_versions, n_window_rows - 1)[:n_window_rows]
+        if self.policy == "lowest_priority":
+            score = self._sampler.priorities(n_rows)[window]
+        else:
+            score = -self._usage[window]
+        n_candidates = max(1, min(n_window_rows, int(self._eviction_candidates_fraction * n_rows)))
+        candidates = np.argpartition(score, n_candidates - 1)[:n_candidates]
+        self._candidates = window[candidates[np.argsort(score[candidates], kind="stable")]]
+
+    def _pop_candidates(self, n: int) -> npt.NDArray:
+        rows = []
+        while n > 0:
+            if len(self._candidates) == 0:
+                self._refill_candidates(np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64))
+            rows.append(self._candidates[:n])
+            n -= len(rows[-1])
+            self._candidates = self._candidates[len(rows[-1]) :]
+        return np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+    def add(self, data: Any) -> int:
+        return int(self.extend([data])[0])
+
+    def extend(self, data: Any) -> torch.Tensor:
+        self._resize_usage()
+        n_rows = len(self._storage)
+        # Free rows are used first, e.g. after the storage grew
+        free_rows = np.arange(n_rows, min(self._storage.max_size, n_rows + len(data)))
+        index = np.concatenate((free_rows, self._pop_candidates(len(data) - len(free_rows))))
+        self._storage.set(index, data)
+        self._usage[index] = 0
+        # Samplers expect a tensor, e.g. PrioritizedSampler.extend()
+        return torch.as_tensor(index)
+
+    def _empty(self) -> None:
+        self._usage[:] = 0
+        self._candidates = np.zeros(0, dtype=np.int64)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"_usage": self._usage, "_candidates": self._candidates}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self._usage = np.array(state_dict["_usage"])
+        self._candidates = np.array(state_dict["_candidates"])
+
+    def dumps(self, path) -> None:
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name, array in self.state_dict().items():
+            np.save(path / f"{name}.npy", array)
+
+    def loads(self, path) -> None:
+        path = Path(path)
+        self.load_state_dict({name: np.load(path / f"{name}.npy") for name in self.state_dict()})
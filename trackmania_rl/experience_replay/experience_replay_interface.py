@@ -1,7 +1,10 @@
 """
-In this file, we define the Experience type.
+In this file, we define the Experience, ExperienceBatch and TrajectoryBatch types.
 This is used to represent a transition sampled from a ReplayBuffer.
 """
+from typing import Sequence
+
+import numpy as np
 import numpy.typing as npt
 
 
@@ -63,3 +66,149 @@ class Experience:
         self.next_state_potential = next_state_potential
         self.gammas = gammas
         self.terminal_actions = terminal_actions
+
+
+class ExperienceBatch:
+    """
+    A batch of transitions, stored field by field.
+
+    Each attribute has the same name and meaning as in Experience, with an additional leading dimension of size len(batch).
+    This is the type written to and read from a ColumnarStorage, and the type received by buffer_collate_function.
+
+    Image fields may either be stacked arrays of shape (len(batch), 1, H, W) or sequences of arrays of shape (1, H, W).
+    Sequences are accepted so that frames shared between transitions of a rollout keep their identity when written to a storage.
+    """
+
+    __slots__ = Experience.__slots__
+
+    def __init__(
+        self,
+        state_img: npt.NDArray,
+        state_float: npt.NDArray,
+        state_potential: npt.NDArray,
+        action: npt.NDArray,
+        n_steps: npt.NDArray,
+        rewards: npt.NDArray,
+        next_state_img: npt.NDArray,
+        next_state_float: npt.NDArray,
+        next_state_potential: npt.NDArray,
+        gammas: npt.NDArray,
+        terminal_actions: npt.NDArray,
+    ):
+        self.state_img = state_img
+        self.state_float = state_float
+        self.state_potential = state_potential
+        self.action = action
+        self.n_steps = n_steps
+        self.rewards = rewards
+        self.next_state_img = next_state_img
+        self.next_state_float = next_state_float
+        self.next_state_potential = next_state_potential
+        self.gammas = gammas
+        self.terminal_actions = terminal_actions
+
+    def __len__(self) -> int:
+        return len(self.action)
+
+    def select(self, positions: npt.NDArray) -> "ExperienceBatch":
+        """
+        Returns a new ExperienceBatch containing the transitions at the given positions within this batch.
+        """
+        selected_fields = {}
+        for field in self.__slots__:
+            values = getattr(self, field)
+            selected_fields[field] = [values[i] for i in positions] if isinstance(values, list) else values[positions]
+        return ExperienceBatch(**selected_fields)
+
+    @classmethod
+    def from_experiences(cls, experiences: Sequence[Experience]) -> "ExperienceBatch":
+        return cls(
+            **{
+                field: [getattr(experience, field) for experience in experiences]
+                if field.endswith("img")
+                else np.array([getattr(experience, field) for experience in experiences])
+                for field in Experience.__slots__
+            }
+        )
+
+
+class TrajectoryBatch:
+    """
+    A batch of transitions represented by the frames of the rollout(s) they were extracted from. This is the type written to and read
+    from a TrajectoryStorage.
+
+    Per-frame attributes, with a leading dimension of size n_frames:
+        frames                      sequence of arrays of shape (1, H, W) and dtype np.uint8
+        state_float                 np.array of shape (n_frames, config.float_input_dim)
+        state_potential             np.array of shape (n_frames, )
+        action                      np.array of shape (n_frames, ), the action taken at each frame
+        reward_components           np.array of shape (n_frames, n_components), see buffer_management.get_reward_components()
+                                    The reward received when reaching frame i is computed from row i when transitions are sampled.
+
+    Per-transition attributes, with a leading dimension of size len(batch):
+        first_frame                 index of the frame of "state"
+        n_steps                     as in Experience. Frames first_frame to first_frame + n_steps are all present in the batch.
+        terminal_actions            as in Experience
+        next_state_has_passed_finish    True if "next state" is after the finish line. next_state_* then refer to "state".
+    """
+
+    __slots__ = (
+        "frames",
+        "state_float",
+        "state_potential",
+        "action",
+        "reward_components",
+        "first_frame",
+        "n_steps",
+        "terminal_actions",
+        "next_state_has_passed_finish",
+    )
+    frame_fields = ("frames", "state_float", "state_potential", "action", "reward_components")
+
+    def __init__(
+        self,
+        frames: Sequence[npt.NDArray],
+        state_float: npt.NDArray,
+        state_potential: npt.NDArray,
+        action: npt.NDArray,
+        reward_components: npt.NDArray,
+        first_frame: npt.NDArray,
+        n_steps: npt.NDArray,
+        terminal_actions: npt.NDArray,
+        next_state_has_passed_finish: npt.NDArray,
+    ):
+        self.frames = frames
+        self.state_float = state_float
+        self.state_potential = state_potential
+        self.action = action
+        self.reward_components = reward_components
+        self.first_frame = first_frame
+        self.n_steps = n_steps
+        self.terminal_actions = terminal_actions
+        self.next_state_has_passed_finish = next_state_has_passed_finish
+
+    def __len__(self) -> int:
+        return len(self.first_frame)
+
+    def select(self, positions: npt.NDArray) -> "TrajectoryBatch":
+        """
+        Returns a new TrajectoryBatch containing the transitions at the given positions within this batch, and only the frames they use.
+        """
+        first_frame = self.first_frame[positions]
+        n_steps = self.n_steps[positions]
+        # Frames [first_frame, first_frame + n_steps] of each transition are kept, they are marked with a difference array
+        frame_coverage = np.zeros(len(self.action) + 1, dtype=np.int64)
+        np.add.at(frame_coverage, first_frame, 1)
+        np.add.at(frame_coverage, first_frame + n_steps + 1, -1)
+        kept_frames = np.flatnonzero(np.cumsum(frame_coverage)[:-1] > 0)
+        return TrajectoryBatch(
+            frames=[self.frames[i] for i in kept_frames],
+            state_float=self.state_float[kept_frames],
+            state_potential=self.state_potential[kept_frames],
+            action=self.action[kept_frames],
+            reward_components=self.reward_components[kept_frames],
+            first_frame=np.searchsorted(kept_frames, first_frame),
+            n_steps=n_steps,
+            terminal_actions=self.terminal_actions[positions],
+            next_state_has_passed_finish=self.next_state_has_passed_finish[positions],
+        )
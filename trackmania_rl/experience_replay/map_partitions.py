@@ -0,0 +1,197 @@
+"""
+In this file, we define the classes which partition a replay buffer by map, such that transitions of a map only overwrite transitions
+of the same map, and batches are drawn from each map in configurable proportions.
+
+MapPartitions reserves a fraction of the buffer's capacity for each partition. Each partition owns a contiguous range of "slots", which
+it uses as a ring: once the partition is full, its oldest transitions are overwritten. Slots are mapped to rows of the storage, which are
+allocated in order, such that the storage has no gaps and len(buffer) is the number of transitions in the buffer.
+
+Samplers work in slot space: the sum tree of buffer_utilities.PartitionedPrioritizedSampler is indexed by slot, such that the priority
+mass of each partition is a contiguous range of the tree. A batch is then drawn from all partitions with a single descent of the tree.
+
+The partition receiving transitions is chosen with PartitionedWriter.select_partition(map_name) before extending the buffer.
+"""
+import json
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+import numpy.typing as npt
+import torch
+from torchrl.data.replay_buffers.writers import Writer
+
+# Partition receiving transitions of maps without a partition of their own
+other_maps_partition_name = "other"
+
+
+class MapPartitions:
+    def __init__(self, max_size: int, capacity_fractions: Dict[str, float], sampling_weights: Optional[Dict[str, float]] = None):
+        """
+        capacity_fractions: fraction of max_size reserved for each map. If they sum to less than 1, the remainder is reserved for the
+                            transitions of other maps.
+        sampling_weights:   relative share of each batch drawn from each partition (1 for partitions which are not listed).
+                            If None, partitions are sampled in proportion to the number of transitions they hold.
+        """
+        remaining_fraction = 1 - sum(capacity_fractions.values())
+        assert remaining_fraction > -1e-6, "Capacity fractions of map partitions sum to more than 1"
+        self._capacity_fractions = dict(capacity_fractions)
+        if remaining_fraction > 1e-6:
+            self._capacity_fractions[other_maps_partition_name] = remaining_fraction
+        self.names = list(self._capacity_fractions)
+        self._sampling_weights = (
+            None if sampling_weights is None else np.array([sampling_weights.get(name, 1.0) for name in self.names], dtype=np.float64)
+        )
+        n_partitions = len(self.names)
+        self.head = np.zeros(n_partitions, dtype=np.int64)  # Offset of the oldest transition within the ring of each partition
+        self.count = np.zeros(n_partitions, dtype=np.int64)
+        self.sampled_count = np.zeros(n_partitions, dtype=np.int64)
+        self._n_rows = 0
+        self._set_capacity(max_size)
+        self.slot_to_row = np.full(max_size, -1, dtype=np.int64)
+        self.row_to_slot = np.full(max_size, -1, dtype=np.int64)
+
+    def _set_capacity(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.capacity = np.array([int(self._capacity_fractions[name] * max_size) for name in self.names], dtype=np.int64)
+        self.start = np.concatenate(([0], np.cumsum(self.capacity)[:-1]))
+
+    def partition_of(self, map_name: str) -> int:
+        if map_name in self.names:
+            return self.names.index(map_name)
+        if other_maps_partition_name in self.names:
+            return self.names.index(other_maps_partition_name)
+        raise ValueError(f"Map {map_name} has no replay buffer partition, and no capacity is left for other maps")
+
+    def allocate(self, partition: int, n: int) -> npt.NDArray:
+        """
+        Returns the rows of the storage where n new transitions of a partition are written. Once the partition is full, the rows of its
+        oldest transitions are returned.
+        """
+        capacity = self.capacity[partition]
+        assert capacity > 0, f"Partition {self.names[partition]} has no capacity"
+        slots = self.start[partition] + (self.head[partition] + self.count[partition] + np.arange(n)) % capacity
+        n_new_rows = min(n, capacity - self.count[partition])
+        new_rows = np.arange(self._n_rows, self._n_rows + n_new_rows)
+        self.slot_to_row[slots[:n_new_rows]] = new_rows
+        self.row_to_slot[new_rows] = slots[:n_new_rows]
+        self._n_rows += n_new_rows
+        n_overwritten = self.count[partition] + n - capacity
+        if n_overwritten > 0:
+            self.head[partition] = (self.head[partition] + n_overwritten) % capacity
+        self.count[partition] = min(capacity, self.count[partition] + n)
+        return self.slot_to_row[slots]
+
+    def live_slots(self, partition: int) -> npt.NDArray:
+        """
+        Slots of the transitions of a partition, from the oldest to the most recent.
+        """
+        return self.start[partition] + (self.head[partition] + np.arange(self.count[partition])) % self.capacity[partition]
+
+    def grow(self, new_max_size: int) -> tuple[npt.NDArray, npt.NDArray]:
+        """
+        Increases the capacity of all partitions. Slots of each partition are moved to its new range, such that its oldest transition
+        is at the start of the range. Returns the previous and new slot of each transition.
+        """
+        assert new_max_size >= self.max_size
+        old_slots = np.concatenate([self.live_slots(partition) for partition in range(len(self.names))])
+        rows = self.slot_to_row[old_slots]
+        self._set_capacity(new_max_size)
+        new_slots = np.concatenate([self.start[partition] + np.arange(self.count[partition]) for partition in range(len(self.names))])
+        self.head[:] = 0
+        self.slot_to_row = np.full(new_max_size, -1, dtype=np.int64)
+        self.slot_to_row[new_slots] = rows
+        self.row_to_slot = np.resize(self.row_to_slot, new_max_size)
+        self.row_to_slot[rows] = new_slots
+        return old_slots, new_slots
+
+    def sample_counts(self, batch_size: int) -> npt.NDArray:
+        """
+        Number of transitions of the batch drawn from each partition.
+        """
+        weights = self.count.astype(np.float64) if self._sampling_weights is None else self._sampling_weights * (self.count > 0)
+        counts = np.random.multinomial(batch_size, weights / weights.sum())
+        self.sampled_count += counts
+        return counts
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the occupancy of each partition and its share of the transitions sampled since the previous call.
+        """
+        stats = {}
+        for partition, name in enumerate(self.names):
+            stats[f"buffer_partition_occupancy_{name}"] = self.count[partition] / max(1, self.capacity[partition])
+            stats[f"buffer_partition_sampling_share_{name}"] = self.sampled_count[partition] / max(1, self.sampled_count.sum())
+        self.sampled_count[:] = 0
+        return stats
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {
+            "names": self.names,
+            "max_size": self.max_size,
+            "head": self.head,
+            "count": self.count,
+            "n_rows": self._n_rows,
+            "slot_to_row": self.slot_to_row,
+            "row_to_slot": self.row_to_slot,
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        assert state_dict["names"] == self.names and state_dict["max_size"] == self.max_size, "Map partitions have changed"
+        self.head[:] = state_dict["head"]
+        self.count[:] = state_dict["count"]
+        self._n_rows = state_dict["n_rows"]
+        self.slot_to_row[:] = state_dict["slot_to_row"]
+        self.row_to_slot[:] = state_dict["row_to_slot"]
+
+
+class PartitionedWriter(Writer):
+    """
+    Writer which writes transitions to the rows allocated by MapPartitions for the selected partition.
+    """
+
+    def __init__(self, partitions: MapPartitions):
+        super().__init__()
+        self.partitions = partitions
+        self._partition = None
+
+    def select_partition(self, map_name: str) -> None:
+        self._partition = self.partitions.partition_of(map_name)
+
+    def add(self, data: Any) -> int:
+        raise NotImplementedError("Transitions are added to partitioned replay buffers with extend()")
+
+    def extend(self, data: Any) -> torch.Tensor:
+        assert self._partition is not None, "select_partition() must be called before adding transitions"
+        index = self.partitions.allocate(self._partition, len(data))
+        self._storage.set(index, data)
+        # Samplers expect a tensor, e.g. PrioritizedSampler.extend()
+        return torch.as_tensor(index)
+
+    def _empty(self) -> None:
+        raise NotImplementedError("Partitioned replay buffers cannot be emptied")
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"partitions": self.partitions.state_dict()}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self.partitions.load_state_dict(state_dict["partitions"])
+
+    def dumps(self, path) -> None:
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        metadata = {}
+        for name, value in self.partitions.state_dict().items():
+            if isinstance(value, np.ndarray):
+                np.save(path / f"{name}.npy", value)
+            else:
+                metadata[name] = value
+        with open(path / "metadata.json", "w") as f:
+            json.dump(metadata, f, default=int)
+
+    def loads(self, path) -> None:
+        path = Path(path)
+        with open(path / "metadata.json", "r") as f:
+            state_dict = json.load(f)
+        for array_path in path.glob("*.npy"):
+            state_dict[array_path.stem] = np.load(array_path)
+        self.partitions.load_state_dict(state_dict)
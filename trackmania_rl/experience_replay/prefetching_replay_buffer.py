@@ -0,0 +1,169 @@
+"""
+In this file, we define the PrefetchingReplayBuffer class, a torchrl ReplayBuffer whose batches are prepared ahead of time by worker
+threads, such that Trainer.train_on_batch() does not wait for sampling, gathering and collate.
+
+Each worker repeatedly:
+    - takes a free staging slot from a fixed ring of slots
+    - samples indices and gathers the corresponding rows into the page-locked arrays of the slot, while holding the buffer's lock
+      (expensive parts of the read, such as decoding compressed frames, are done after the lock, see ColumnarStorage.begin_read())
+    - collates the batch (mini-races, host-to-device copies, image normalization) without holding the lock
+    - hands the batch over to sample()
+
+Page-locked arrays are allocated once per slot, and reused for every batch prepared in that slot. A slot is reused only after the
+batch prepared in it was handed over, the next batch was requested (the previous batch may share memory with the slot when training
+on CPU), and the host-to-device copies issued from the slot have completed.
+
+Rows may be overwritten by new transitions between the moment a batch is sampled and the moment its priorities are updated. Each
+batch records the version of its rows (see ColumnarStorage.row_versions()), and update_priority() ignores rows whose version changed.
+
+Priorities computed on the GPU may be queued with queue_priority_update() instead of update_priority(): their copy to host memory is
+issued asynchronously, and queued updates are applied in bulk by flush_priority_updates(), in the order they were queued. Until they
+are flushed, batches keep being sampled with the previous priorities of these rows. Batches already prepared by the workers were
+sampled with the priorities of the moment they were prepared, whether updates are queued or not.
+
+Workers are started by the first call to sample(), and stopped by stop_workers(), which is also registered to run at interpreter exit.
+"""
+import atexit
+import queue
+import threading
+from typing import Any, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+import torch
+from torchrl.data import ReplayBuffer
+from torchrl.data.replay_buffers.utils import _to_numpy
+
+from trackmania_rl.experience_replay.evicting_writer import EvictingWriter
+from trackmania_rl.experience_replay.replay_dataset import RowProvenance
+
+
+class _StagingSlot:
+    __slots__ = ("batch", "copies_done")
+
+    def __init__(self):
+        self.batch = None  # ExperienceBatch of page-locked arrays, allocated by the first batch gathered in this slot
+        self.copies_done = None  # CUDA event recorded after the host-to-device copies issued from this slot
+
+
+class PrefetchingReplayBuffer(ReplayBuffer):
+    def __init__(self, *, n_workers: int = 1, n_batches_ahead: int = 2, **kwargs):
+        super().__init__(**kwargs)
+        self._n_workers = n_workers
+        self._ready_batches = queue.Queue()
+        self._free_slots = queue.Queue()
+        for _ in range(n_batches_ahead + n_workers):
+            self._free_slots.put(_StagingSlot())
+        self._slot_in_use = None
+        self._workers = []
+        self._stop_workers = threading.Event()
+        self._queued_priority_updates = []
+        self.provenance = RowProvenance()  # Map and rollout of each row, see replay_dataset.py
+
+    def _start_workers(self) -> None:
+        for _ in range(self._n_workers):
+            worker = threading.Thread(target=self._worker_loop, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        # Workers left running at exit abort the process
+        atexit.register(self.stop_workers)
+
+    def stop_workers(self) -> None:
+        atexit.unregister(self.stop_workers)
+        self._stop_workers.set()
+        for _ in self._workers:
+            self._free_slots.put(_StagingSlot())  # Wake up workers waiting for a free slot
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _worker_loop(self) -> None:
+        try:
+            while True:
+                slot = self._free_slots.get()
+                if self._stop_workers.is_set():
+                    return
+                if slot.copies_done is not None:
+                    slot.copies_done.synchronize()
+                with self._replay_lock:
+                    index, info = self._sample_index()
+                    info["index"] = index
+                    info["write_version"] = self._storage.row_versions(index)
+                    finish_read = self._storage.begin_read(
+                        index, slot.batch if slot.batch is not None and len(slot.batch) == len(index) else None
+                    )
+                slot.batch = finish_read()
+                data = self._collate_fn(slot.batch)
+                if torch.cuda.is_available():
+                    slot.copies_done = torch.cuda.Event()
+                    slot.copies_done.record()
+                self._ready_batches.put((data, info, slot))
+        except Exception as exception:
+            self._ready_batches.put(exception)
+
+    def _sample_index(self) -> tuple[Any, dict]:
+        """
+        Samples the indices of a batch. Must be called while holding the buffer's lock.
+        """
+        index, info = self._sampler.sample(self._storage, self._batch_size)
+        if isinstance(self._writer, EvictingWriter):
+            self._writer.record_sampled(index)
+        return index, info
+
+    def sample(self, batch_size: Optional[int] = None, return_info: bool = False) -> Any:
+        assert batch_size is None or batch_size == self._batch_size
+        if not self._workers:
+            self._start_workers()
+        if self._slot_in_use is not None:
+            # The previous batch is not used anymore: its slot can be reused.
+            self._free_slots.put(self._slot_in_use)
+        ready_batch = self._ready_batches.get()
+        if isinstance(ready_batch, Exception):
+            raise ready_batch
+        data, info, self._slot_in_use = ready_batch
+        return (data, info) if return_info else data
+
+    def update_priority(
+        self,
+        index: Union[int, torch.Tensor, npt.NDArray],
+        priority: Union[float, torch.Tensor, npt.NDArray],
+        write_version: Optional[npt.NDArray] = None,
+    ) -> None:
+        """
+        Same as ReplayBuffer.update_priority(). If write_version (batch_info["write_version"] of the sampled batch) is provided, rows which
+        were overwritten since they were sampled keep the default priority of the transition which replaced them.
+        """
+        with self._replay_lock:
+            if write_version is not None:
+                index = np.asarray(_to_numpy(index))
+                still_sampled_transition = self._storage.row_versions(index) == np.asarray(write_version)
+                index = index[still_sampled_transition]
+                priority = np.asarray(_to_numpy(priority))[still_sampled_transition]
+            self._sampler.update_priority(index, priority)
+
+    def queue_priority_update(self, index: npt.NDArray, priority: torch.Tensor, write_version: npt.NDArray) -> int:
+        """
+        Queues update_priority(index, priority, write_version) without waiting for priority, which may still be computed on the GPU. Rows
+        whose priority is NaN are not updated. Returns the number of queued updates.
+        """
+        host_priority = priority.detach().to("cpu", non_blocking=True)
+        copy_done = None
+        if priority.is_cuda:
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+        self._queued_priority_updates.append((np.asarray(_to_numpy(index)), host_priority, np.asarray(write_version), copy_done))
+        return len(self._queued_priority_updates)
+
+    def flush_priority_updates(self) -> None:
+        if not self._queued_priority_updates:
+            return
+        for _, _, _, copy_done in self._queued_priority_updates:
+            if copy_done is not None:
+                copy_done.synchronize()
+        index, priority, write_version, _ = zip(*self._queued_priority_updates)
+        self._queued_priority_updates = []
+        index = np.concatenate(index)
+        priority = torch.cat(priority).numpy()
+        write_version = np.concatenate(write_version)
+        updated = ~np.isnan(priority)
+        self.update_priority(index[updated], priority[updated], write_version=write_version[updated])
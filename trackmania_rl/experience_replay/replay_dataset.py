@@ -0,0 +1,246 @@
+"""
+In this file, we define replay datasets: the content of replay buffers exported to sharded columnar files, which can be read lazily with
+memory mapping. They allow offline experiments, benchmarks of Trainer.train_on_batch() on recorded transitions, and seeding new runs with
+transitions collected by previous runs.
+
+A replay dataset directory contains:
+    - index.json: format version, names of the maps, and for each buffer the number of transitions, the priority parameters of its
+      sampler, the number of transitions of each shard and the shape/dtype of each column
+    - {buffer_name}/shard_{i:05d}/{column_name}.npy: one file per column and per shard
+
+Columns of a shard:
+    - frames: the distinct frames of the transitions of the shard, uint8 array of shape (n_frames, 1, H, W)
+    - state_img_frame, next_state_img_frame: index in frames of the state_img and next_state_img of each transition
+    - the other fields of ExperienceBatch, one row per transition
+    - priority: the priority of each transition (as stored by the sampler), if the buffer used prioritized sampling
+    - map_id, rollout_id: where each transition comes from (see RowProvenance). map_id indexes the map names of index.json, -1 if unknown.
+
+Frames shared by several transitions of a shard, as in a FramePoolStorage, are written once.
+"""
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+from torchrl.data import ReplayBuffer
+from torchrl.data.replay_buffers.utils import _to_numpy
+
+from trackmania_rl.experience_replay.experience_replay_interface import Experience, ExperienceBatch
+
+# Increment when the layout of replay datasets changes
+dataset_format_version = 1
+
+image_fields = ("state_img", "next_state_img")
+
+
+class RowProvenance:
+    """
+    Map and rollout of the transition held by each row of a replay buffer. Rows are recorded after they are written with record();
+    rows which were never recorded have map_id -1 and rollout_id -1.
+    """
+
+    def __init__(self):
+        self.map_names: List[str] = []
+        self._map_ids: Dict[str, int] = {}
+        self._map_id = np.zeros(0, dtype=np.int32)
+        self._rollout_id = np.zeros(0, dtype=np.int64)
+
+    def map_id_of(self, map_name: str) -> int:
+        if map_name not in self._map_ids:
+            self._map_ids[map_name] = len(self.map_names)
+            self.map_names.append(map_name)
+        return self._map_ids[map_name]
+
+    def _resize(self, n_rows: int) -> None:
+        if n_rows > len(self._map_id):
+            n_new_rows = max(n_rows, 2 * len(self._map_id)) - len(self._map_id)
+            self._map_id = np.concatenate((self._map_id, np.full(n_new_rows, -1, dtype=np.int32)))
+            self._rollout_id = np.concatenate((self._rollout_id, np.full(n_new_rows, -1, dtype=np.int64)))
+
+    def record(self, index: npt.NDArray, map_id: Union[int, npt.NDArray], rollout_id: Union[int, npt.NDArray]) -> None:
+        index = np.asarray(_to_numpy(index)).reshape(-1)
+        if len(index) == 0:
+            return
+        self._resize(int(index.max()) + 1)
+        self._map_id[index] = map_id
+        self._rollout_id[index] = rollout_id
+
+    def get(self, index: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+        """
+        Returns the map_id and rollout_id of each row in index.
+        """
+        index = np.asarray(index)
+        recorded = index < len(self._map_id)
+        map_id = np.full(len(index), -1, dtype=np.int32)
+        rollout_id = np.full(len(index), -1, dtype=np.int64)
+        map_id[recorded] = self._map_id[index[recorded]]
+        rollout_id[recorded] = self._rollout_id[index[recorded]]
+        return map_id, rollout_id
+
+    def copy_rows(self, source: "RowProvenance", source_index: npt.NDArray, index: npt.NDArray) -> None:
+        source_map_id, source_rollout_id = source.get(source_index)
+        map_ids = np.array([self.map_id_of(map_name) for map_name in source.map_names] + [-1], dtype=np.int32)
+        self.record(index, map_ids[source_map_id], source_rollout_id)
+
+    def state_dict(self) -> dict:
+        return {"map_names": self.map_names, "map_id": self._map_id, "rollout_id": self._rollout_id}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.map_names = list(state_dict["map_names"])
+        self._map_ids = {map_name: i for i, map_name in enumerate(self.map_names)}
+        self._map_id = np.array(state_dict["map_id"])
+        self._rollout_id = np.array(state_dict["rollout_id"])
+
+
+def _deduplicate_frames(batch: ExperienceBatch, copy_to_host) -> tuple[npt.NDArray, Dict[str, npt.NDArray]]:
+    """
+    Returns the distinct frames of the image fields of batch, and the index of each image in these frames. Images given as sequences are
+    compared by identity: frames shared by rows of a FramePoolStorage are the same object in the batch returned by its rows() method.
+    Images given as stacked arrays are all distinct.
+    """
+    frames = []
+    frame_positions = {}
+    image_frame = {}
+    for field in image_fields:
+        images = getattr(batch, field)
+        if not isinstance(images, list):
+            image_frame[field] = np.arange(len(frames), len(frames) + len(images))
+            frames.extend(copy_to_host(images))
+            continue
+        image_frame[field] = np.empty(len(images), dtype=np.int64)
+        for i, image in enumerate(images):
+            position = frame_positions.setdefault(id(image), len(frames))
+            if position == len(frames):
+                frames.append(copy_to_host(image))
+            image_frame[field][i] = position
+    return np.stack(frames), image_frame
+
+
+def export_replay_dataset(
+    buffers: Dict[str, ReplayBuffer],
+    dataset_dir: Path,
+    shard_size: int = 16384,
+    provenances: Optional[Dict[str, RowProvenance]] = None,
+) -> None:
+    """
+    Writes the transitions of each buffer to a replay dataset in dataset_dir. Buffers are read one shard at a time while holding their
+    lock. The storages of the buffers must hold ExperienceBatch rows (not a TrajectoryStorage).
+    provenances defaults to the provenance attribute of the buffers (see PrefetchingReplayBuffer).
+    """
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    map_names = []
+    index = {"format_version": dataset_format_version, "map_names": map_names, "buffers": {}}
+    for name, buffer in buffers.items():
+        storage = buffer._storage
+        assert storage.batch_type is ExperienceBatch, "Only storages of ExperienceBatch rows can be exported"
+        provenance = provenances[name] if provenances is not None else getattr(buffer, "provenance", RowProvenance())
+        prioritized = hasattr(buffer._sampler, "priorities")
+        buffer_index = {
+            "n_transitions": len(storage),
+            "prio_alpha": float(buffer._sampler._alpha) if prioritized else None,
+            "prio_epsilon": float(buffer._sampler._eps) if prioritized else None,
+            "shards": [],
+            "columns": {},
+        }
+        for shard_number, start in enumerate(range(0, len(storage), shard_size)):
+            stop = min(start + shard_size, len(storage))
+            with buffer._replay_lock:
+                rows = storage.rows(start, stop)
+                frames, image_frame = _deduplicate_frames(rows, storage.copy_to_host)
+                columns = {"frames": frames, **{f"{field}_frame": image_frame[field] for field in image_fields}}
+                for field in Experience.__slots__:
+                    if field not in image_fields:
+                        columns[field] = np.asarray(storage.copy_to_host(getattr(rows, field)))
+                if prioritized:
+                    columns["priority"] = buffer._sampler.priorities(stop)[start:stop]
+                map_id, columns["rollout_id"] = provenance.get(np.arange(start, stop))
+            # map_id is written relative to the map names of the dataset
+            dataset_map_ids = []
+            for map_name in provenance.map_names:
+                if map_name not in map_names:
+                    map_names.append(map_name)
+                dataset_map_ids.append(map_names.index(map_name))
+            columns["map_id"] = np.array(dataset_map_ids + [-1], dtype=np.int32)[map_id]
+
+            shard_dir = dataset_dir / name / f"shard_{shard_number:05d}"
+            shard_dir.mkdir(parents=True, exist_ok=True)
+            for column_name, column in columns.items():
+                np.save(shard_dir / f"{column_name}.npy", column)
+                buffer_index["columns"][column_name] = {"shape": list(column.shape[1:]), "dtype": column.dtype.str}
+            buffer_index["shards"].append({"n_transitions": stop - start, "n_frames": len(frames)})
+        index["buffers"][name] = buffer_index
+    with open(dataset_dir / "index.json", "w") as f:
+        json.dump(index, f, indent=2)
+
+
+class ReplayDataset:
+    """
+    Reads a replay dataset written by export_replay_dataset(). Columns are memory-mapped: rows are read from disk when they are accessed.
+    """
+
+    def __init__(self, dataset_dir: Path):
+        self.dataset_dir = dataset_dir
+        with open(dataset_dir / "index.json", "r") as f:
+            self.index = json.load(f)
+        assert self.index["format_version"] == dataset_format_version, "Unsupported replay dataset format"
+        self.map_names: List[str] = self.index["map_names"]
+
+    def buffer_names(self) -> List[str]:
+        return list(self.index["buffers"])
+
+    def n_transitions(self, buffer_name: str) -> int:
+        return self.index["buffers"][buffer_name]["n_transitions"]
+
+    def n_shards(self, buffer_name: str) -> int:
+        return len(self.index["buffers"][buffer_name]["shards"])
+
+    def shard_columns(self, buffer_name: str, shard_number: int) -> Dict[str, np.memmap]:
+        shard_dir = self.dataset_dir / buffer_name / f"shard_{shard_number:05d}"
+        return {
+            column_name: np.load(shard_dir / f"{column_name}.npy", mmap_mode="r")
+            for column_name in self.index["buffers"][buffer_name]["columns"]
+        }
+
+    def shard_batch(self, buffer_name: str, shard_number: int) -> ExperienceBatch:
+        """
+        Returns the transitions of a shard. Images are views on the memory-mapped frames, the same view object for each occurrence of a
+        frame, such that a FramePoolStorage receiving the batch stores each frame once.
+        """
+        columns = self.shard_columns(buffer_name, shard_number)
+        frame_views = list(columns["frames"])
+        return ExperienceBatch(
+            **{
+                field: [frame_views[i] for i in columns[f"{field}_frame"].tolist()] if field in image_fields else columns[field]
+                for field in Experience.__slots__
+            }
+        )
+
+    def load_into_buffer(self, buffer_name: str, buffer: ReplayBuffer, max_transitions: Optional[int] = None) -> int:
+        """
+        Adds the transitions of a buffer of the dataset to buffer, with their priorities if both were prioritized, and their provenance if
+        buffer has a provenance attribute. Returns the number of transitions added.
+        """
+        buffer_index = self.index["buffers"][buffer_name]
+        restore_priorities = buffer_index["prio_alpha"] is not None and hasattr(buffer._sampler, "priorities")
+        provenance = getattr(buffer, "provenance", None)
+        if provenance is not None:
+            map_ids = np.array([provenance.map_id_of(map_name) for map_name in self.map_names] + [-1], dtype=np.int32)
+        n_added = 0
+        for shard_number in range(self.n_shards(buffer_name)):
+            if max_transitions is not None and n_added >= max_transitions:
+                break
+            columns = self.shard_columns(buffer_name, shard_number)
+            batch = self.shard_batch(buffer_name, shard_number)
+            positions = np.arange(min(len(batch), max_transitions - n_added) if max_transitions is not None else len(batch))
+            if len(positions) < len(batch):
+                batch = batch.select(positions)
+            index = buffer.extend(batch)
+            if restore_priorities and buffer_index["prio_alpha"] > 0:
+                # The sampler stores (priority + epsilon) ** alpha
+                priority = np.asarray(columns["priority"][positions], dtype=np.float64) ** (1 / buffer_index["prio_alpha"])
+                buffer.update_priority(index, np.maximum(priority - buffer_index["prio_epsilon"], 0))
+            if provenance is not None:
+                provenance.record(index, map_ids[columns["map_id"][positions]], columns["rollout_id"][positions])
+            n_added += len(positions)
+        return n_added
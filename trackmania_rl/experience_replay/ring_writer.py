@@ -0,0 +1,76 @@
+"""
+In this file, we define the RingWriter class, a torchrl Writer which overwrites the oldest transitions once the replay buffer is full, like
+torchrl's RoundRobinWriter, and keeps doing so after the storage grew in place.
+
+RoundRobinWriter assumes that the rows of the storage are overwritten in the order 0, 1, ..., max_size - 1. When a full storage grows,
+its oldest transition sits at the cursor, not at row 0: the new rows must be written first, then the ring must resume at the cursor.
+RingWriter keeps the order in which rows are overwritten in an array, and grow() inserts the new rows in that order, right before the
+row holding the oldest transition.
+"""
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy as np
+import numpy.typing as npt
+import torch
+from torchrl.data.replay_buffers.writers import Writer
+
+
+class RingWriter(Writer):
+    def __init__(self):
+        super().__init__()
+        self._cursor = 0  # Position in self._ring of the next row to write
+        self._ring = np.zeros(0, dtype=np.int64)  # Rows of the storage, in the order they are written
+
+    def _ring_rows(self) -> npt.NDArray:
+        if len(self._ring) != self._storage.max_size:
+            # Until the storage grows, rows are written in order
+            assert len(self._ring) == 0, "The storage was resized without RingWriter.grow()"
+            self._ring = np.arange(self._storage.max_size, dtype=np.int64)
+        return self._ring
+
+    def grow(self, new_max_size: int) -> None:
+        """
+        Inserts the rows added by storage.grow(new_max_size) in the ring. Must be called before the storage grows.
+        """
+        ring = self._ring_rows()
+        new_rows = np.arange(self._storage.max_size, new_max_size, dtype=np.int64)
+        # The rows which were never written follow the cursor, e.g. the rows added by a previous grow() which are not filled yet. They are
+        # followed by the oldest transition. The new rows are written after the former, such that the storage remains contiguous, and
+        # before the latter.
+        position = self._cursor + self._storage.max_size - len(self._storage)
+        assert position <= len(ring)
+        self._ring = np.concatenate((ring[:position], new_rows, ring[position:]))
+
+    def add(self, data: Any) -> int:
+        return int(self.extend([data])[0])
+
+    def extend(self, data: Any) -> torch.Tensor:
+        ring = self._ring_rows()
+        index = ring[(self._cursor + np.arange(len(data))) % len(ring)]
+        self._cursor = (self._cursor + len(data)) % len(ring)
+        self._storage.set(index, data)
+        # Samplers expect a tensor, e.g. PrioritizedSampler.extend()
+        return torch.as_tensor(index)
+
+    def _empty(self) -> None:
+        self._cursor = 0
+        self._ring = np.zeros(0, dtype=np.int64)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"_cursor": self._cursor, "_ring": self._ring}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self._cursor = int(state_dict["_cursor"])
+        # States saved by a RoundRobinWriter have no ring: rows were written in order
+        self._ring = np.array(state_dict.get("_ring", np.zeros(0, dtype=np.int64)), dtype=np.int64)
+
+    def dumps(self, path) -> None:
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name, value in self.state_dict().items():
+            np.save(path / f"{name}.npy", value)
+
+    def loads(self, path) -> None:
+        path = Path(path)
+        self.load_state_dict({name: np.load(path / f"{name}.npy") for name in self.state_dict()})
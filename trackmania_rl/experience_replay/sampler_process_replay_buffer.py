@@ -0,0 +1,245 @@
+"""
+In this file, we define the SamplerProcessReplayBuffer class, a PrefetchingReplayBuffer whose batches are gathered and prepared by a
+dedicated sampler process instead of threads of the learner process. The storage must be a SharedMemoryColumnsMixin storage.
+
+The learner and the sampler process share:
+    - the columns of the storage, written by the learner and read by the sampler process
+    - a ring of batch slots, each holding the gathered rows of a batch and the arrays prepared from them by prepare_fn
+    - the buffer's lock, a multiprocessing lock held by the learner while it modifies the buffer, and by the sampler process while it
+      gathers rows
+
+The learner keeps the sampler (priorities stay in the learner). For each free slot, it samples indices and sends them to the sampler
+process, which gathers the rows into the slot and runs prepare_fn (e.g. buffer_utilities.prepare_mini_races()) on them. sample() then
+only receives the index of a ready slot, and runs collate_fn (e.g. buffer_utilities.send_batch_to_gpu()) on the prepared arrays.
+Slot arrays are page-locked when CUDA is available, such that host-to-device copies from the slots are asynchronous.
+
+The sampler process reloads config_copy regularly, like the learner.
+"""
+import atexit
+import importlib
+import queue
+import time
+import traceback
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+import torch
+
+from config_files import config_copy
+from trackmania_rl.experience_replay.experience_replay_interface import ExperienceBatch
+from trackmania_rl.experience_replay.prefetching_replay_buffer import PrefetchingReplayBuffer
+from trackmania_rl.experience_replay.shared_memory_storage import (
+    SharedColumnsReader,
+    SharedMemoryColumnsMixin,
+    attach_shared_array,
+    close_segments,
+    create_shared_array,
+    mp_context,
+)
+
+# Interval between two reloads of config_copy in the sampler process
+config_reload_interval_s = 10.0
+# Interval at which sample() checks that the sampler process is still alive while it waits for a batch
+ready_slot_poll_interval_s = 1.0
+
+
+def _attach_slots(slots_layout: List[Dict[str, Any]]) -> tuple[list, list]:
+    """
+    Attaches to the arrays of each slot. Returns the segments, and the arrays of each slot by name.
+    """
+    segments = []
+    slots = []
+    for slot_layout in slots_layout:
+        arrays = {}
+        for name, (segment_name, shape, dtype) in slot_layout.items():
+            segment, arrays[name] = attach_shared_array(segment_name, shape, dtype)
+            segments.append(segment)
+        slots.append(arrays)
+    return segments, slots
+
+
+def _slot_batch(slot: Dict[str, npt.NDArray]) -> ExperienceBatch:
+    return ExperienceBatch(**{field: slot[field] for field in ExperienceBatch.__slots__})
+
+
+def _sampler_process_loop(
+    reader_class: type,
+    layout_generation,
+    layout_buffer,
+    lock,
+    slots_layout: List[Dict[str, Any]],
+    prepared_from_fields: Dict[int, str],
+    prepare_fn: Callable,
+    requests,
+    ready_slots,
+) -> None:
+    reader = SharedColumnsReader(reader_class, layout_generation, layout_buffer)
+    _slot_segments, slots = _attach_slots(slots_layout)
+    last_config_reload = time.perf_counter()
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            slot_index, index = request
+            if time.perf_counter() - last_config_reload > config_reload_interval_s:
+                importlib.reload(config_copy)
+                last_config_reload = time.perf_counter()
+            slot = slots[slot_index]
+            batch = _slot_batch(slot)
+            with lock:
+                reader.refresh()
+                reader.storage._read_rows(index, out=batch)
+                slot["write_version"][:] = reader.storage.row_versions(index)
+            for i, prepared_array in enumerate(prepare_fn(batch)):
+                if i not in prepared_from_fields:
+                    slot[f"prepared_{i}"][:] = prepared_array
+            ready_slots.put(slot_index)
+    except Exception:
+        ready_slots.put(traceback.format_exc())
+
+
+class SamplerProcessReplayBuffer(PrefetchingReplayBuffer):
+    def __init__(self, *, prepare_fn: Callable, n_batches_ahead: int = 2, **kwargs):
+        super().__init__(n_workers=1, n_batches_ahead=n_batches_ahead, **kwargs)
+        assert isinstance(self._storage, SharedMemoryColumnsMixin), "The storage must be in shared memory"
+        self._replay_lock = mp_context.RLock()
+        self._prepare_fn = prepare_fn
+        self._n_slots = n_batches_ahead + 1
+        self._process = None
+        self._requests = mp_context.Queue()
+        self._ready_slots = mp_context.Queue()
+        self._slot_segments: List[shared_memory.SharedMemory] = []
+        self._slots: List[Dict[str, npt.NDArray]] = []
+        self._prepared_from_fields: Dict[int, str] = {}
+        self._n_prepared_arrays = 0
+        self._free_slot_indices = deque()
+        self._slot_copies_done: List[Optional[torch.cuda.Event]] = []
+        self._sampled_info: Dict[int, Dict[str, Any]] = {}
+
+    def _allocate_slots(self) -> List[Dict[str, Any]]:
+        """
+        Allocates the slots, with shapes and dtypes found by gathering and preparing a batch in the learner. Returns their layout.
+        """
+        with self._replay_lock:
+            batch = self._storage.get(np.zeros(self._batch_size, dtype=np.int64))
+        prepared_batch = self._prepare_fn(batch)
+        self._n_prepared_arrays = len(prepared_batch)
+        self._prepared_from_fields = {
+            i: field
+            for i, prepared_array in enumerate(prepared_batch)
+            for field in ExperienceBatch.__slots__
+            if prepared_array is getattr(batch, field)
+        }
+        slot_arrays = {field: getattr(batch, field) for field in ExperienceBatch.__slots__}
+        slot_arrays.update({f"prepared_{i}": array for i, array in enumerate(prepared_batch) if i not in self._prepared_from_fields})
+        slot_arrays["write_version"] = np.zeros(self._batch_size, dtype=np.int64)
+        slots_layout = []
+        for _ in range(self._n_slots):
+            slot = {}
+            slot_layout = {}
+            for name, array in slot_arrays.items():
+                segment, slot[name] = create_shared_array(np.shape(array), np.asarray(array).dtype)
+                self._slot_segments.append(segment)
+                slot_layout[name] = (segment.name, slot[name].shape, slot[name].dtype.str)
+                if torch.cuda.is_available():
+                    torch.cuda.cudart().cudaHostRegister(slot[name].ctypes.data, slot[name].nbytes, 0)
+            self._slots.append(slot)
+            slots_layout.append(slot_layout)
+        self._free_slot_indices.extend(range(self._n_slots))
+        self._slot_copies_done = [None] * self._n_slots
+        return slots_layout
+
+    def _start_workers(self) -> None:
+        slots_layout = self._allocate_slots()
+        self._process = mp_context.Process(
+            target=_sampler_process_loop,
+            args=(
+                type(self._storage).reader_class,
+                self._storage.layout_generation,
+                self._storage.layout_buffer,
+                self._replay_lock,
+                slots_layout,
+                self._prepared_from_fields,
+                self._prepare_fn,
+                self._requests,
+                self._ready_slots,
+            ),
+            daemon=True,
+        )
+        self._process.start()
+        # The slots are unlinked from shared memory when the learner exits
+        atexit.register(self.stop_workers)
+
+    def stop_workers(self) -> None:
+        atexit.unregister(self.stop_workers)
+        if self._process is None:
+            return
+        self._requests.put(None)
+        self._process.join()
+        self._process = None
+        for copies_done in self._slot_copies_done:
+            if copies_done is not None:
+                copies_done.synchronize()
+        for slot in self._slots:
+            for array in slot.values():
+                if torch.cuda.is_available():
+                    torch.cuda.cudart().cudaHostUnregister(array.ctypes.data)
+        self._slots = []
+        for segment in self._slot_segments:
+            segment.unlink()
+        close_segments(self._slot_segments)
+        self._slot_segments = []
+
+    def _request_batch(self, slot_index: int) -> None:
+        if self._slot_copies_done[slot_index] is not None:
+            self._slot_copies_done[slot_index].synchronize()
+        with self._replay_lock:
+            index, info = self._sample_index()
+        info["index"] = index
+        self._sampled_info[slot_index] = info
+        self._requests.put((slot_index, np.asarray(index)))
+
+    def _wait_for_ready_slot(self) -> int:
+        """
+        Returns the index of the next slot prepared by the sampler process. Raises if the sampler process failed, or exited without
+        reporting an error (e.g. killed when out of memory, or crashed in native code).
+        """
+        while True:
+            try:
+                slot_index = self._ready_slots.get(timeout=ready_slot_poll_interval_s)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(f"The sampler process exited unexpectedly with code {self._process.exitcode}")
+                continue
+            if isinstance(slot_index, str):
+                raise RuntimeError(f"The sampler process failed:\n{slot_index}")
+            return slot_index
+
+    def sample(self, batch_size: Optional[int] = None, return_info: bool = False) -> Any:
+        assert batch_size is None or batch_size == self._batch_size
+        if self._process is None:
+            self._start_workers()
+        if self._slot_in_use is not None:
+            # The previous batch is not used anymore: its slot can be reused.
+            self._free_slot_indices.append(self._slot_in_use)
+        while self._free_slot_indices:
+            self._request_batch(self._free_slot_indices.popleft())
+        slot_index = self._wait_for_ready_slot()
+        slot = self._slots[slot_index]
+        info = self._sampled_info.pop(slot_index)
+        info["write_version"] = slot["write_version"].copy()
+        data = self._collate_fn(
+            tuple(
+                slot[self._prepared_from_fields[i]] if i in self._prepared_from_fields else slot[f"prepared_{i}"]
+                for i in range(self._n_prepared_arrays)
+            )
+        )
+        if torch.cuda.is_available():
+            self._slot_copies_done[slot_index] = torch.cuda.Event()
+            self._slot_copies_done[slot_index].record()
+        self._slot_in_use = slot_index
+        return (data, info) if return_info else data
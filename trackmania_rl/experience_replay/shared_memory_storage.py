@@ -0,0 +1,170 @@
+"""
+In this file, we define storages which keep their columns in shared memory segments (multiprocessing.shared_memory), such that another
+process can read transitions directly, without receiving them through a pipe. See sampler_process_replay_buffer.py.
+
+SharedMemoryStorage and SharedMemoryFramePoolStorage behave like ColumnarStorage and FramePoolStorage. Each column, and the version of
+each row, is a numpy array viewing its own segment.
+
+Segments cannot be resized. When a column grows, it is copied to a new segment, and the previous one is unlinked. The layout of the
+storage (segment name, shape and dtype of each array) is then written to a small shared buffer, and layout_generation is incremented.
+Readers (SharedColumnsReader) compare layout_generation with the generation they are attached to, and attach to the new segments when
+it changed. The storage is modified and read while holding a lock shared by both processes, such that readers never see a partially
+written layout.
+"""
+import ctypes
+import multiprocessing
+import pickle
+import struct
+import weakref
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from trackmania_rl.experience_replay.columnar_storage import ColumnarStorage, FramePoolStorage
+
+# Context used for all objects shared with a sampler process. Spawned processes do not inherit the state (CUDA context, threads) of
+# the learner.
+mp_context = multiprocessing.get_context("spawn")
+
+# Size of the shared buffer holding the pickled layout of a storage
+max_layout_size = 1 << 16
+
+
+def create_shared_array(shape: tuple, dtype: np.dtype) -> tuple[shared_memory.SharedMemory, npt.NDArray]:
+    dtype = np.dtype(dtype)
+    segment = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    return segment, np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+
+def attach_shared_array(segment_name: str, shape: tuple, dtype: str) -> tuple[shared_memory.SharedMemory, npt.NDArray]:
+    segment = shared_memory.SharedMemory(name=segment_name)
+    return segment, np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+
+
+def close_segments(segments: List[shared_memory.SharedMemory]) -> List[shared_memory.SharedMemory]:
+    """
+    Closes segments, and returns those which could not be closed because numpy views on them are still alive.
+    """
+    still_used_segments = []
+    for segment in segments:
+        try:
+            segment.close()
+        except BufferError:
+            still_used_segments.append(segment)
+    return still_used_segments
+
+
+def _release_segments(segments: Dict[str, shared_memory.SharedMemory], retired_segments: List[shared_memory.SharedMemory]) -> None:
+    for segment in segments.values():
+        segment.unlink()
+    close_segments(list(segments.values()) + retired_segments)
+
+
+class SharedMemoryColumnsMixin:
+    """
+    Overrides the methods of ColumnarStorage which allocate and resize columns, such that columns and row versions live in shared memory.
+    """
+
+    # Class of the storage built by SharedColumnsReader in the reading process, whose columns are then replaced by the shared arrays
+    reader_class = ColumnarStorage
+
+    def __init__(self, max_size: int, memmap_dir: Optional[Path] = None, **kwargs):
+        assert memmap_dir is None, "Shared memory storages cannot be memory-mapped"
+        self._segments: Dict[str, shared_memory.SharedMemory] = {}
+        self._retired_segments: List[shared_memory.SharedMemory] = []
+        # Segments are unlinked when the storage is garbage collected, or at the latest when the learner exits
+        self._finalizer = weakref.finalize(self, _release_segments, self._segments, self._retired_segments)
+        self.layout_generation = mp_context.Value(ctypes.c_int64, 0, lock=False)
+        self.layout_buffer = mp_context.Array(ctypes.c_char, max_layout_size, lock=False)
+        super().__init__(max_size, **kwargs)
+        self._row_versions = self._make_array("_row_versions", (max_size,), np.int64)
+        self._publish_layout()
+
+    def _make_array(self, name: str, shape: tuple, dtype: np.dtype) -> npt.NDArray:
+        previous_segment = self._segments.pop(name, None)
+        if previous_segment is not None:
+            # Readers may still be attached: the segment is only closed once they attached to the new layout
+            previous_segment.unlink()
+            self._retired_segments.append(previous_segment)
+        self._segments[name], array = create_shared_array(shape, dtype)
+        self._layout_changed = True
+        return array
+
+    def _resize_array(self, name: str, new_length: int) -> None:
+        column = self._columns[name]
+        new_column = self._make_array(name, (new_length,) + column.shape[1:], column.dtype)
+        new_column[: min(len(column), new_length)] = column[:new_length]
+        self._columns[name] = new_column
+
+    def _resize_row_versions(self, new_max_size: int) -> None:
+        row_versions = self._row_versions
+        self._row_versions = self._make_array("_row_versions", (new_max_size,), np.int64)
+        self._row_versions[: len(row_versions)] = row_versions[:new_max_size]
+
+    def _publish_layout(self) -> None:
+        arrays = dict(self._columns, _row_versions=self._row_versions)
+        layout = pickle.dumps({name: (self._segments[name].name, array.shape, array.dtype.str) for name, array in arrays.items()})
+        assert len(layout) + 8 <= max_layout_size, "Layout of the storage is too large"
+        self.layout_buffer.raw = struct.pack("q", len(layout)) + layout
+        self.layout_generation.value += 1
+        self._layout_changed = False
+        self._retired_segments[:] = close_segments(self._retired_segments)
+
+    def set(self, *args, **kwargs) -> None:
+        super().set(*args, **kwargs)
+        if self._layout_changed:
+            self._publish_layout()
+
+    def grow(self, new_max_size: int) -> None:
+        super().grow(new_max_size)
+        self._publish_layout()
+
+    def load_state_dict(self, *args, **kwargs) -> None:
+        super().load_state_dict(*args, **kwargs)
+        self._publish_layout()
+
+
+class SharedMemoryStorage(SharedMemoryColumnsMixin, ColumnarStorage):
+    pass
+
+
+class SharedMemoryFramePoolStorage(SharedMemoryColumnsMixin, FramePoolStorage):
+    reader_class = FramePoolStorage
+
+
+class SharedColumnsReader:
+    """
+    Holds a storage of class reader_class (see SharedMemoryColumnsMixin), whose columns are the shared arrays of a storage created in
+    another process. Only the methods of this storage which read rows (_read_rows(), row_versions()) may be used.
+    """
+
+    def __init__(self, reader_class: type, layout_generation, layout_buffer):
+        self.storage = reader_class(1)
+        self._layout_generation = layout_generation
+        self._layout_buffer = layout_buffer
+        self._attached_generation = None
+        self._segments: List[shared_memory.SharedMemory] = []
+        self._retired_segments: List[shared_memory.SharedMemory] = []
+
+    def refresh(self) -> None:
+        """
+        Attaches to the current layout of the storage, if it changed. Must be called while holding the lock shared with the storage.
+        """
+        if self._attached_generation == self._layout_generation.value:
+            return
+        raw_layout = self._layout_buffer.raw
+        (layout_size,) = struct.unpack("q", raw_layout[:8])
+        layout = pickle.loads(raw_layout[8 : 8 + layout_size])
+        previous_segments = self._segments
+        self._segments = []
+        arrays = {}
+        for name, (segment_name, shape, dtype) in layout.items():
+            segment, arrays[name] = attach_shared_array(segment_name, shape, dtype)
+            self._segments.append(segment)
+        self.storage._row_versions = arrays.pop("_row_versions")
+        self.storage._columns = arrays
+        self._attached_generation = self._layout_generation.value
+        self._retired_segments = close_segments(self._retired_segments + previous_segments)
@@ -0,0 +1,122 @@
+"""
+In this file, we define the SumTree class, a segment tree used by CustomPrioritizedSampler to sample transitions proportionally to their
+priority.
+
+SumTree stores the tree in a single NumPy array, and all its operations are batched: setting the priorities of a batch of transitions
+updates the tree one level at a time, and sampling a batch descends the tree one level at a time for all samples at once.
+It offers the subset of the interface of torchrl's SumSegmentTree used by torchrl's PrioritizedSampler, and also allows to export and
+load all priorities at once.
+"""
+from typing import Union
+
+import numpy as np
+import numpy.typing as npt
+import torch
+from torchrl.data.replay_buffers.utils import _to_numpy
+
+
+def _as_index_array(index: Union[int, npt.NDArray, torch.Tensor]) -> npt.NDArray:
+    return np.atleast_1d(_to_numpy(index)).astype(np.int64, copy=False)
+
+
+class SumTree:
+    """
+    Binary tree where each leaf holds the priority of a transition, and each inner node holds the sum of its children.
+    The root is stored at index 1 of self._tree, the children of node k at indices 2k and 2k+1, and leaf i at index capacity + i.
+    """
+
+    def __init__(self, size: int):
+        self._allocate(size)
+
+    def _allocate(self, size: int) -> None:
+        self._size = size
+        self._capacity = 1 << max(0, int(size - 1).bit_length())
+        self._tree = np.zeros(2 * self._capacity, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _update_ancestors(self, nodes: npt.NDArray) -> None:
+        nodes = np.unique(nodes >> 1)
+        while nodes[0] >= 1:
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+            nodes = np.unique(nodes >> 1)
+
+    def __setitem__(self, index: Union[int, npt.NDArray, torch.Tensor], value: Union[float, npt.NDArray, torch.Tensor]) -> None:
+        index = _as_index_array(index)
+        if len(index) == 0:
+            return
+        self._tree[self._capacity + index] = _to_numpy(value)
+        self._update_ancestors(self._capacity + index)
+
+    def __getitem__(self, index: Union[int, npt.NDArray, torch.Tensor]) -> Union[float, npt.NDArray]:
+        if isinstance(index, (int, np.integer)):
+            return self.at(index)
+        return self._tree[self._capacity + _as_index_array(index)]
+
+    def at(self, index: int) -> float:
+        return float(self._tree[self._capacity + index])
+
+    def query(self, start: int, stop: int) -> float:
+        """
+        Sum of the priorities of leaves [start, stop).
+        """
+        if start == 0 and stop >= self._size:
+            return float(self._tree[1])
+        total = 0.0
+        start += self._capacity
+        stop += self._capacity
+        while start < stop:
+            if start & 1:
+                total += self._tree[start]
+                start += 1
+            if stop & 1:
+                stop -= 1
+                total += self._tree[stop]
+            start >>= 1
+            stop >>= 1
+        return float(total)
+
+    def scan_lower_bound(self, mass: Union[float, npt.NDArray]) -> Union[int, npt.NDArray]:
+        """
+        For each value in mass, returns the smallest leaf index i such that mass <= sum of the priorities of leaves [0, i].
+        Returns len(self) for values larger than the sum of all priorities, like torchrl's SumSegmentTree.
+        """
+        is_scalar = np.ndim(mass) == 0
+        mass = np.array(mass, dtype=np.float64, ndmin=1)
+        larger_than_total = mass > self._tree[1]
+        nodes = np.ones(len(mass), dtype=np.int64)
+        while nodes[0] < self._capacity:
+            left_children = 2 * nodes
+            left_sums = self._tree[left_children]
+            go_right = mass > left_sums
+            mass -= np.where(go_right, left_sums, 0.0)
+            nodes = left_children + go_right
+        index = nodes - self._capacity
+        index[larger_than_total] = self._size
+        return int(index[0]) if is_scalar else index
+
+    def leaves(self) -> npt.NDArray:
+        """
+        Returns a copy of the priorities of all leaves.
+        """
+        return self._tree[self._capacity : self._capacity + self._size].copy()
+
+    def load_leaves(self, values: npt.NDArray) -> None:
+        """
+        Sets the priorities of leaves [0, len(values)), and rebuilds the whole tree in one pass per level.
+        """
+        self._tree[self._capacity : self._capacity + len(values)] = values
+        level_start = self._capacity
+        while level_start > 1:
+            parents = slice(level_start // 2, level_start)
+            self._tree[parents] = self._tree[level_start : 2 * level_start : 2] + self._tree[level_start + 1 : 2 * level_start : 2]
+            level_start //= 2
+
+    def resize(self, size: int) -> None:
+        """
+        Changes the number of leaves, keeping the priorities of leaves [0, size).
+        """
+        leaves = self.leaves()[:size]
+        self._allocate(size)
+        self.load_leaves(leaves)
@@ -0,0 +1,207 @@
+"""
+In this file, we define the TrajectoryStorage class, a ColumnarStorage which keeps rollouts as contiguous per-frame arrays instead of
+one row of rewards, gammas and next state per transition.
+
+Frames (image, state_float, potential, action and reward components) are written to a ring of frames, in the order of the rollouts.
+Each transition only holds the position of its first frame, its n_steps, terminal_actions and whether its next state is past the finish
+line. Frames are addressed by their global position (the number of frames written before them), stored at position % capacity of the
+frame ring.
+
+When transitions are sampled, next states, rewards and gammas are computed from the frames:
+    - rewards are the discounted cumulative sums of the rewards of the next n_steps frames, each being the sum of its reward components
+      multiplied by the current reward weights
+    - gammas are computed with the current gamma
+Reward weights and gamma are provided with set_reward_parameters(): changing a reward schedule or gamma_schedule applies to the whole
+buffer immediately.
+
+Reward components are stored in float64, and n-step rewards are accumulated in float32 step by step, as buffer_management.py does when
+it writes rewards to other storages: both storages return the same rewards for the same rollout.
+
+The frame ring grows when the frames still used by transitions of the buffer would be overwritten by new frames. The oldest frame still
+used is tracked per write: the rows written by each call to set() are kept, from the oldest write to the most recent, and only the rows
+of the oldest write which still hold one of its transitions are read.
+"""
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from trackmania_rl.experience_replay.columnar_storage import ColumnarStorage
+from trackmania_rl.experience_replay.experience_replay_interface import ExperienceBatch, TrajectoryBatch
+from trackmania_rl.reward_shaping import weigh_reward_components
+
+# Column of the frame ring storing each per-frame attribute of TrajectoryBatch, and its dtype
+frame_columns_dtypes = {
+    "frames": ("frame_img", np.uint8),
+    "state_float": ("frame_state_float", np.float32),
+    "state_potential": ("frame_state_potential", np.float32),
+    "action": ("frame_action", np.int64),
+    "reward_components": ("frame_reward_components", np.float64),
+}
+transition_columns_dtypes = {
+    "first_frame": np.int64,
+    "n_steps": np.int64,
+    "terminal_actions": np.float32,
+    "next_state_has_passed_finish": bool,
+}
+
+
+class TrajectoryStorage(ColumnarStorage):
+    batch_type = TrajectoryBatch
+    non_row_columns = tuple(column_name for column_name, _ in frame_columns_dtypes.values())
+
+    def __init__(self, max_size: int, memmap_dir: Optional[Path] = None, n_steps_max: int = 3, frame_ring_size_ratio: float = 1.25):
+        super().__init__(max_size, memmap_dir)
+        self.n_steps_max = n_steps_max
+        self._frame_ring_size_ratio = frame_ring_size_ratio
+        self._n_frames_written = 0
+        self._reward_parameters = None  # (gamma, reward weights)
+        self._rows_by_version: OrderedDict = OrderedDict()  # Write version -> rows written with it, from the oldest write
+
+    def set_reward_parameters(self, gamma: float, reward_weights: npt.NDArray) -> None:
+        self._reward_parameters = (gamma, np.asarray(reward_weights, dtype=np.float64))
+
+    def _frame_ring_size(self) -> int:
+        return len(self._columns["frame_img"])
+
+    def _allocate(self, batch: TrajectoryBatch) -> None:
+        for field, dtype in transition_columns_dtypes.items():
+            self._columns[field] = self._make_array(field, (self.max_size,), dtype)
+        frame_ring_size = int(self.max_size * self._frame_ring_size_ratio)
+        for field, (column_name, dtype) in frame_columns_dtypes.items():
+            self._columns[column_name] = self._make_array(column_name, (frame_ring_size,) + np.shape(getattr(batch, field)[0]), dtype)
+
+    def _resize_frame_ring(self, new_size: int, oldest_frame: int) -> None:
+        """
+        Grows the frame ring. Frames [oldest_frame, self._n_frames_written) are moved to their position in the larger ring.
+        """
+        old_positions = np.arange(oldest_frame, self._n_frames_written) % self._frame_ring_size()
+        new_positions = np.arange(oldest_frame, self._n_frames_written) % new_size
+        for column_name in self.non_row_columns:
+            kept_frames = self._columns[column_name][old_positions]
+            self._resize_array(column_name, new_size)
+            self._set_rows(self._columns[column_name], new_positions, kept_frames)
+            self._mark_dirty(column_name, np.arange(new_size))
+
+    def _write_rows(self, index: npt.NDArray, batch: TrajectoryBatch) -> None:
+        first_frame = self._n_frames_written + np.asarray(batch.first_frame)
+        for field in transition_columns_dtypes:
+            self._set_rows(self._columns[field], index, first_frame if field == "first_frame" else getattr(batch, field))
+            self._mark_dirty(field, index)
+
+        # Rows take the version set() gives them after this call, such that the transitions they held no longer count as live
+        self._row_versions[index] = self._write_counter + 1
+        self._rows_by_version[self._write_counter + 1] = index.copy()
+        # Frames still used by transitions of the buffer must not be overwritten by the new frames
+        oldest_frame = self._oldest_used_frame()
+        n_new_frames = len(batch.action)
+        if self._n_frames_written + n_new_frames - oldest_frame > self._frame_ring_size():
+            self._resize_frame_ring(
+                max(self._n_frames_written + n_new_frames - oldest_frame, int(self._frame_ring_size() * 1.25) + 1), oldest_frame
+            )
+        positions = np.arange(self._n_frames_written, self._n_frames_written + n_new_frames) % self._frame_ring_size()
+        for field, (column_name, _) in frame_columns_dtypes.items():
+            self._set_rows(self._columns[column_name], positions, getattr(batch, field))
+            self._mark_dirty(column_name, positions)
+        self._n_frames_written += n_new_frames
+
+    def _oldest_used_frame(self) -> int:
+        """
+        First frame of the oldest transition of the storage. Writes whose rows were all overwritten since are dropped.
+        """
+        while True:
+            version, rows = next(iter(self._rows_by_version.items()))
+            live_rows = rows[self._row_versions[rows] == version]
+            if len(live_rows) > 0:
+                # Frames of later writes come after the frames of this write
+                self._rows_by_version[version] = live_rows
+                return int(self._columns["first_frame"][live_rows].min())
+            del self._rows_by_version[version]
+
+    def _read_rows(self, index: npt.NDArray, pin_memory: bool = True, out: Optional[ExperienceBatch] = None) -> ExperienceBatch:
+        assert self._reward_parameters is not None, "set_reward_parameters() must be called before sampling a TrajectoryStorage"
+        gamma, reward_weights = self._reward_parameters
+        frame_ring_size = self._frame_ring_size()
+        first_frame = self._columns["first_frame"][index]
+        n_steps = self._columns["n_steps"][index]
+        next_state_has_passed_finish = self._columns["next_state_has_passed_finish"][index]
+        state_positions = first_frame % frame_ring_size
+        # It doesn't matter what next_state_img and next_state_float contain, as the transition will be forced to be final
+        next_state_positions = np.where(next_state_has_passed_finish, first_frame, first_frame + n_steps) % frame_ring_size
+
+        # rewards[:, j] = sum over k <= j of gamma**k * reward received when reaching frame first_frame + k + 1
+        steps = np.arange(self.n_steps_max)
+        in_n_steps = steps < n_steps[:, None]
+        reward_positions = (first_frame[:, None] + 1 + np.where(in_n_steps, steps, 0)) % frame_ring_size
+        reward_into = weigh_reward_components(self._columns["frame_reward_components"][reward_positions], reward_weights)
+        rewards = np.zeros((len(index), self.n_steps_max), dtype=np.float32)
+        for j in range(self.n_steps_max):
+            rewards[:, j] = (gamma**j) * reward_into[:, j] + (rewards[:, j - 1] if j >= 1 else 0)
+        rewards[~in_n_steps] = 0
+
+        def gather(field: str, column_name: str, positions: npt.NDArray) -> npt.NDArray:
+            return self._gather(self._columns[column_name], positions, pin_memory, None if out is None else getattr(out, field))
+
+        state_potential = self._columns["frame_state_potential"][state_positions]
+        next_state_potential = np.where(next_state_has_passed_finish, 0, self._columns["frame_state_potential"][next_state_positions])
+        return ExperienceBatch(
+            state_img=gather("state_img", "frame_img", state_positions),
+            state_float=gather("state_float", "frame_state_float", state_positions),
+            state_potential=state_potential,
+            action=self._columns["frame_action"][state_positions],
+            n_steps=n_steps,
+            rewards=rewards,
+            next_state_img=gather("next_state_img", "frame_img", next_state_positions),
+            next_state_float=gather("next_state_float", "frame_state_float", next_state_positions),
+            next_state_potential=next_state_potential.astype(np.float32),
+            gammas=np.broadcast_to(
+                (gamma ** np.linspace(1, self.n_steps_max, self.n_steps_max)).astype(np.float32), (len(index), self.n_steps_max)
+            ),
+            terminal_actions=self._columns["terminal_actions"][index],
+        )
+
+    def rows(self, start: int, stop: int) -> TrajectoryBatch:
+        """
+        Returns a TrajectoryBatch containing transitions [start, stop) and the frames they use. Images are views on the frame ring.
+        """
+        first_frame = self._columns["first_frame"][start:stop]
+        n_steps = self._columns["n_steps"][start:stop]
+        steps = np.arange(self.n_steps_max + 1)
+        used_frames = np.unique((first_frame[:, None] + steps)[steps <= n_steps[:, None]])
+        positions = used_frames % self._frame_ring_size()
+        frame_img = self._columns["frame_img"]
+        return TrajectoryBatch(
+            **{
+                field: [frame_img[position] for position in positions.tolist()]
+                if field == "frames"
+                else self._columns[column_name][positions]
+                for field, (column_name, _) in frame_columns_dtypes.items()
+            },
+            first_frame=np.searchsorted(used_frames, first_frame),
+            n_steps=n_steps,
+            terminal_actions=self._columns["terminal_actions"][start:stop],
+            next_state_has_passed_finish=self._columns["next_state_has_passed_finish"][start:stop],
+        )
+
+    def _statistics_length(self, name: str) -> int:
+        # Statistics of frame columns include frames which are no longer used by any transition, until they are overwritten
+        return min(self._n_frames_written, self._frame_ring_size()) if name in self.non_row_columns else self._length
+
+    def column_statistics(self, name: str) -> Dict[str, npt.NDArray]:
+        return super().column_statistics(frame_columns_dtypes[name][0] if name in frame_columns_dtypes else name)
+
+    def _empty(self) -> None:
+        super()._empty()
+        self._n_frames_written = 0
+        self._rows_by_version.clear()
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        super().load_state_dict(state_dict)
+        # Frames are written in increasing global position: the last frame written is the last frame of the latest transition
+        self._n_frames_written = int((self.column("first_frame") + self.column("n_steps")).max(initial=-1)) + 1
+        # Loaded transitions count as a single write
+        self._write_counter += 1
+        self._row_versions[: self._length] = self._write_counter
+        self._rows_by_version = OrderedDict([(self._write_counter, np.arange(self._length))])
@@ -38,18 +38,19 @@ def collector_process_fn(
         tmi_port=tmi_port,
     )
 
-    inference_network, uncompiled_inference_network = iqn.make_untrained_iqn_network(config_copy.use_jit)
+    utilities.set_cpu_threads(config_copy.collector_device, config_copy.collector_cpu_threads)
+    inference_network, uncompiled_inference_network = iqn.make_untrained_iqn_network(config_copy.use_jit, config_copy.collector_device)
     try:
-        inference_network.load_state_dict(torch.load(save_dir / "weights1.torch"))
+        inference_network.load_state_dict(torch.load(save_dir / "weights1.torch", map_location=config_copy.collector_device))
     except Exception as e:
         print("Worker could not load weights, exception:", e)
 
-    inferer = iqn.Inferer(inference_network, config_copy.iqn_k, config_copy.tau_epsilon_boltzmann)
+    inferer = iqn.Inferer(inference_network, config_copy.iqn_k, config_copy.tau_epsilon_boltzmann, config_copy.collector_device)
 
     def update_network():
         # Update weights of the inference network
         with shared_network_lock:
-            uncompiled_inference_network.load_state_dict(uncompiled_shared_network.state_dict())
+            utilities.copy_param(uncompiled_inference_network, uncompiled_shared_network)
 
     # ========================================================
     # Training loop
@@ -29,7 +29,18 @@ from trackmania_rl.analysis_metrics import (
     race_time_left_curves,
     tau_curves,
 )
-from trackmania_rl.buffer_utilities import make_buffers, resize_buffers
+from trackmania_rl.buffer_utilities import (
+    make_buffers,
+    map_partitions_stats,
+    resize_buffers,
+    sample_fixed_test_set,
+    select_map_partition,
+)
+from trackmania_rl.experience_replay.buffer_snapshot import BufferSnapshotter
+from trackmania_rl.experience_replay.buffer_statistics import quantile_levels
+from trackmania_rl.experience_replay.compressed_frame_storage import CompressedFramePoolStorage
+from trackmania_rl.experience_replay.replay_dataset import ReplayDataset
+from trackmania_rl.experience_replay.trajectory_storage import TrajectoryStorage
 from trackmania_rl.map_reference_times import reference_times
 
 
@@ -109,8 +120,9 @@ def learner_process_fn(
     # Create new stuff
     # ========================================================
 
-    online_network, uncompiled_online_network = make_untrained_iqn_network(config_copy.use_jit)
-    target_network, _ = make_untrained_iqn_network(config_copy.use_jit)
+    utilities.set_cpu_threads(config_copy.device, config_copy.learner_cpu_threads)
+    online_network, uncompiled_online_network = make_untrained_iqn_network(config_copy.use_jit, config_copy.device)
+    target_network, _ = make_untrained_iqn_network(config_copy.use_jit, config_copy.device)
 
     print(online_network)
     utilities.count_parameters(online_network)
@@ -126,14 +138,14 @@ def learner_process_fn(
     # ========================================================
     # noinspection PyBroadException
     try:
-        online_network.load_state_dict(torch.load(save_dir / "weights1.torch"))
-        target_network.load_state_dict(torch.load(save_dir / "weights2.torch"))
+        online_network.load_state_dict(torch.load(save_dir / "weights1.torch", map_location=config_copy.device))
+        target_network.load_state_dict(torch.load(save_dir / "weights2.torch", map_location=config_copy.device))
         print(" =====================     Learner weights loaded !     ============================")
     except:
         print(" Learner could not load weights")
 
     with shared_network_lock:
-        uncompiled_shared_network.load_state_dict(uncompiled_online_network.state_dict())
+        utilities.copy_param(uncompiled_shared_network, uncompiled_online_network)
 
     # noinspection PyBroadException
     try:
@@ -159,16 +171,27 @@ def learner_process_fn(
     )
     # optimizer1 = torch_optimizer.Lookahead(optimizer1, k=5, alpha=0.5)
 
-    scaler = torch.cuda.amp.GradScaler()
+    # Loss scaling is only needed with float16, bfloat16 autocast on CPU has the range of float32
+    scaler = torch.cuda.amp.GradScaler(enabled=torch.device(config_copy.device).type == "cuda")
     memory_size, memory_size_start_learn = utilities.from_staircase_schedule(
         config_copy.memory_size_schedule, accumulated_stats["cumul_number_memories_generated"]
     )
-    buffer, buffer_test = make_buffers(memory_size)
+    buffer, buffer_test = make_buffers(memory_size, save_dir)
+    buffer_snapshotter = BufferSnapshotter(save_dir / "buffer_snapshot")
+    if config_copy.save_buffer_snapshots and buffer_snapshotter.load({"buffer": buffer, "buffer_test": buffer_test}):
+        print(" =========================     Buffers loaded !     ==================================")
+    elif config_copy.seed_buffers_from_replay_dataset is not None and len(buffer) == 0:
+        replay_dataset = ReplayDataset(Path(config_copy.seed_buffers_from_replay_dataset))
+        for name, seeded_buffer in (("buffer", buffer), ("buffer_test", buffer_test)):
+            if name not in replay_dataset.buffer_names():
+                continue
+            n_seeded = replay_dataset.load_into_buffer(name, seeded_buffer, max_transitions=seeded_buffer._storage.max_size)
+            print(f" Seeded {name} with {n_seeded} transitions from {config_copy.seed_buffers_from_replay_dataset}")
     offset_cumul_number_single_memories_used = memory_size_start_learn * config_copy.number_times_single_memory_is_used_before_discard
 
     # noinspection PyBroadException
     try:
-        optimizer1.load_state_dict(torch.load(save_dir / "optimizer1.torch"))
+        optimizer1.load_state_dict(torch.load(save_dir / "optimizer1.torch", map_location=config_copy.device))
         scaler.load_state_dict(torch.load(save_dir / "scaler.torch"))
         print(" =========================     Optimizer loaded !     ================================")
     except:
@@ -182,6 +205,8 @@ def learner_process_fn(
 
     loss_history = []
     loss_test_history = []
+    fixed_test_set = None
+    n_evals_of_fixed_test_set = 0
     train_on_batch_duration_history = []
     grad_norm_history = []
     layer_grad_norm_history = defaultdict(list)
@@ -202,6 +227,7 @@ def learner_process_fn(
         inference_network=online_network,
         iqn_k=config_copy.iqn_k,
         tau_epsilon_boltzmann=config_copy.tau_epsilon_boltzmann,
+        device=config_copy.device,
     )
 
     while True:  # Trainer loop
@@ -242,7 +268,7 @@ def learner_process_fn(
             accumulated_stats["cumul_number_memories_generated"],
         )
         if new_memory_size != memory_size:
-            buffer, buffer_test = resize_buffers(buffer, buffer_test, new_memory_size)
+            buffer, buffer_test = resize_buffers(buffer, buffer_test, new_memory_size, save_dir)
             offset_cumul_number_single_memories_used += (
                 new_memory_size_start_learn - memory_size_start_learn
             ) * config_copy.number_times_single_memory_is_used_before_discard
@@ -285,6 +311,14 @@ def learner_process_fn(
             buffer._sampler._beta = config_copy.prio_beta
             buffer._sampler._eps = config_copy.prio_epsilon
 
+        if isinstance(buffer._storage, TrajectoryStorage):
+            # Rewards of stored trajectories are computed when transitions are sampled, with the current schedules
+            reward_weights = buffer_management.get_reward_weights(
+                engineered_speedslide_reward, engineered_neoslide_reward, engineered_kamikaze_reward, engineered_close_to_vcp_reward
+            )
+            for storage in [buffer._storage, buffer_test._storage]:
+                storage.set_reward_parameters(gamma, reward_weights)
+
         if config_copy.plot_race_time_left_curves and not is_explo and (loop_number // 5) % 17 == 0:
             race_time_left_curves(rollout_results, inferer, save_dir, map_name)
             tau_curves(rollout_results, inferer, save_dir, map_name)
@@ -413,6 +447,8 @@ def learner_process_fn(
         #   FILL BUFFER WITH (S, A, R, S') transitions
         # ===============================================
         if fill_buffer:
+            select_map_partition(buffer, map_name)
+            select_map_partition(buffer_test, map_name)
             (
                 buffer,
                 buffer_test,
@@ -429,6 +465,8 @@ def learner_process_fn(
                 engineered_neoslide_reward,
                 engineered_kamikaze_reward,
                 engineered_close_to_vcp_reward,
+                map_name=map_name,
+                rollout_id=accumulated_stats["cumul_number_frames_played"],
             )
 
             accumulated_stats["cumul_number_memories_generated"] += number_memories_added_train + number_memories_added_test
@@ -448,28 +486,24 @@ def learner_process_fn(
                 single_reset_flag = config_copy.single_reset_flag
                 accumulated_stats["cumul_number_single_memories_should_have_been_used"] += config_copy.additional_transition_after_reset
 
-                untrained_iqn_network = make_untrained_iqn_network(config_copy.use_jit)
+                # The untrained network is never used for inference: it does not need to be compiled
+                _, untrained_iqn_network = make_untrained_iqn_network(jit=False, device=config_copy.device)
                 utilities.soft_copy_param(online_network, untrained_iqn_network, config_copy.overall_reset_mul_factor)
 
                 with torch.no_grad():
-                    online_network.A_head[2].weight = utilities.linear_combination(
-                        online_network.A_head[2].weight,
-                        untrained_iqn_network.A_head[2].weight,
-                        config_copy.last_layer_reset_factor,
-                    )
-                    online_network.A_head[2].bias = utilities.linear_combination(
-                        online_network.A_head[2].bias,
-                        untrained_iqn_network.A_head[2].bias,
-                        config_copy.last_layer_reset_factor,
-                    )
-                    online_network.V_head[2].weight = utilities.linear_combination(
-                        online_network.V_head[2].weight,
-                        untrained_iqn_network.V_head[2].weight,
-                        config_copy.last_layer_reset_factor,
-                    )
-                    online_network.V_head[2].bias = utilities.linear_combination(
-                        online_network.V_head[2].bias,
-                        untrained_iqn_network.V_head[2].bias,
+                    utilities.foreach_linear_combination(
+                        [
+                            online_network.A_head[2].weight,
+                            online_network.A_head[2].bias,
+                            online_network.V_head[2].weight,
+                            online_network.V_head[2].bias,
+                        ],
+                        [
+                            untrained_iqn_network.A_head[2].weight,
+                            untrained_iqn_network.A_head[2].bias,
+                            untrained_iqn_network.V_head[2].weight,
+                            untrained_iqn_network.V_head[2].bias,
+                        ],
                         config_copy.last_layer_reset_factor,
                     )
 
@@ -485,7 +519,9 @@ def learner_process_fn(
                 and accumulated_stats["cumul_number_single_memories_used"] + offset_cumul_number_single_memories_used
                 <= accumulated_stats["cumul_number_single_memories_should_have_been_used"]
             ):
-                if (random.random() < config_copy.buffer_test_ratio and len(buffer_test) > 0) or len(buffer) == 0:
+                if config_copy.fixed_test_set_size == 0 and (
+                    (random.random() < config_copy.buffer_test_ratio and len(buffer_test) > 0) or len(buffer) == 0
+                ):
                     loss, _ = trainer.train_on_batch(buffer_test, do_learn=False)
                     loss_test_history.append(loss)
                     print(f"BT   {loss=:<8.2e}")
@@ -508,10 +544,25 @@ def learner_process_fn(
                     accumulated_stats["cumul_number_batches_done"] += 1
                     print(f"B    {loss=:<8.2e} {grad_norm=:<8.2e} {train_on_batch_duration_history[-1]*1000:<8.1f}")
 
+                    if (
+                        config_copy.fixed_test_set_size > 0
+                        and accumulated_stats["cumul_number_batches_done"] % config_copy.fixed_test_set_eval_every_n_batches == 0
+                    ):
+                        if fixed_test_set is None or n_evals_of_fixed_test_set >= config_copy.fixed_test_set_refresh_every_n_evals:
+                            fixed_test_set = sample_fixed_test_set(
+                                buffer_test, config_copy.fixed_test_set_size, config_copy.fixed_test_set_chunk_size
+                            )
+                            n_evals_of_fixed_test_set = 0
+                        if fixed_test_set is not None:
+                            loss_test = trainer.evaluate_fixed_test_set(fixed_test_set, config_copy.fixed_test_set_chunk_size)
+                            n_evals_of_fixed_test_set += 1
+                            loss_test_history.append(loss_test)
+                            print(f"BT   {loss_test=:<8.2e}")
+
                     utilities.custom_weight_decay(online_network, 1 - weight_decay)
                     if accumulated_stats["cumul_number_batches_done"] % config_copy.send_shared_network_every_n_batches == 0:
                         with shared_network_lock:
-                            uncompiled_shared_network.load_state_dict(uncompiled_online_network.state_dict())
+                            utilities.copy_param(uncompiled_shared_network, uncompiled_online_network)
 
                     # ===============================================
                     #   UPDATE TARGET NETWORK
@@ -575,7 +626,7 @@ def learner_process_fn(
                         }
                     )
             if isinstance(buffer._sampler, PrioritizedSampler):
-                all_priorities = np.array([buffer._sampler._sum_tree.at(i) for i in range(len(buffer))])
+                all_priorities = buffer._sampler.priorities(len(buffer))
                 step_stats.update(
                     {
                         "priorities_min": np.min(all_priorities),
@@ -588,6 +639,11 @@ def learner_process_fn(
                         "priorities_max": np.max(all_priorities),
                     }
                 )
+            if isinstance(buffer._storage, CompressedFramePoolStorage):
+                with buffer._replay_lock:
+                    step_stats.update(buffer._storage.compression_stats())
+            with buffer._replay_lock:
+                step_stats.update(map_partitions_stats(buffer))
             for key, value in accumulated_stats.items():
                 if key not in ["alltime_min_ms", "rolling_mean_ms"]:
                     step_stats[key] = value
@@ -606,7 +662,7 @@ def learner_process_fn(
 
             if online_network.training:
                 online_network.eval()
-            tau = torch.linspace(0.05, 0.95, config_copy.iqn_k)[:, None].to("cuda")
+            tau = torch.linspace(0.05, 0.95, config_copy.iqn_k)[:, None].to(config_copy.device)
             per_quantile_output = inferer.infer_network(rollout_results["frames"][0], rollout_results["state_float"][0], tau)
             for i, std in enumerate(list(per_quantile_output.std(axis=0))):
                 step_stats[f"std_within_iqn_quantiles_for_action{i}"] = std
@@ -682,11 +738,13 @@ def learner_process_fn(
             #   BUFFER STATS
             # ===============================================
 
-            mean_in_buffer = np.array([experience.state_float for experience in buffer._storage]).mean(axis=0)
-            std_in_buffer = np.array([experience.state_float for experience in buffer._storage]).std(axis=0)
+            state_float_statistics = buffer._storage.column_statistics("state_float")
+            mean_in_buffer = state_float_statistics["mean"]
+            std_in_buffer = state_float_statistics["std"]
 
             print("Raw mean in buffer  :", mean_in_buffer.round(1))
             print("Raw std in buffer   :", std_in_buffer.round(1))
+            print("Raw median in buffer:", state_float_statistics["quantiles"][quantile_levels.index(0.5)].round(1))
             print("")
             print(
                 "Corr mean in buffer :",
@@ -709,3 +767,7 @@ def learner_process_fn(
             # ===============================================
             utilities.save_checkpoint(save_dir, online_network, target_network, optimizer1, scaler)
             joblib.dump(accumulated_stats, save_dir / "accumulated_stats.joblib")
+            if config_copy.save_buffer_snapshots:
+                buffer.flush_priority_updates()
+                buffer_test.flush_priority_updates()
+                buffer_snapshotter.save_in_background({"buffer": buffer, "buffer_test": buffer_test})
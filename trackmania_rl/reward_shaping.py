@@ -1,21 +1,42 @@
 """
 Utility functions for reward shaping.
 """
+from typing import Union
+
 import numpy as np
+import numpy.typing as npt
 
 
 # largely inspired from https://github.com/TomashuTTTT7/TM-AlgoCrack/blob/main/cracks/speedslide_quality.py, yet also largely simplified
-def speedslide_quality_tarmac(speed_x: float, speed_z: float) -> float:
+def speedslide_quality_tarmac(
+    speed_x: Union[float, npt.NDArray], speed_z: Union[float, npt.NDArray]
+) -> Union[float, npt.NDArray]:
     """
     Extract from Tomashu's documentation:
     - speedslide_quality < 1: you don't utilize entire speedslide potential, steer more.
     - speedslide_quality == 1: you utilize entire speedslide potential.perfect speedslide.
     - speedslide_quality > 1: you utilize entire speedslide potential, but you start losing some speed from drifting, steer less.
+
+    speed_x and speed_z may be arrays, in which case the quality is computed elementwise. The side friction is computed in the precision
+    of speed_x, as for a float32 scalar.
     """
     material_max_side_friction_multiplier = 1.0  # will need to be changed in the future for dirt & grass
     max_side_friction = (
         np.interp(speed_z * 3.6, [0, 100, 200, 300, 400, 500], [80, 80, 75, 67, 60, 55]) * material_max_side_friction_multiplier
     )
-    side_friction = 20 * abs(speed_x)
-    speedslide_quality = (side_friction - max_side_friction) / max_side_friction if side_friction > max_side_friction else 0.0
-    return speedslide_quality
+    side_friction = 20 * np.abs(speed_x)
+    speedslide_quality = np.where(side_friction > max_side_friction, (side_friction - max_side_friction) / max_side_friction, 0.0)
+    return speedslide_quality if speedslide_quality.ndim > 0 else float(speedslide_quality)
+
+
+def weigh_reward_components(components: npt.NDArray, weights: npt.NDArray) -> npt.NDArray:
+    """
+    Sums the weighted reward components along the last axis.
+
+    Terms are added one at a time, in the order of the components. This is the order in which the former per-frame implementation of
+    reward computation added them, such that rewards are bit-identical to it (see buffer_management.py for the precision of components).
+    """
+    rewards = np.zeros(components.shape[:-1])
+    for k in range(len(weights)):
+        rewards += weights[k] * components[..., k]
+    return rewards
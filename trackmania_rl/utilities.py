@@ -3,8 +3,9 @@ Various neural network & scheduling utilities.
 """
 import math
 import shutil
+import weakref
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import joblib
 import numpy as np
@@ -46,26 +47,112 @@ def linear_combination(a, b, alpha):
     return a
 
 
-# From https://github.com/pfnet/pfrl/blob/2ad3d51a7a971f3fe7f2711f024be11642990d61/pfrl/utils/copy_param.py#L37
+def foreach_linear_combination(a: List[torch.Tensor], b: List[torch.Tensor], alpha: float) -> None:
+    """
+    Same as linear_combination() applied to each pair of tensors of a and b, with multi-tensor kernels.
+    """
+    torch._foreach_mul_(a, 1 - alpha)
+    torch._foreach_add_(a, b, alpha=alpha)
+
+
+# Tensors of the state_dict() of each module, listed once per module by _state_tensors()
+_state_tensors_cache = weakref.WeakKeyDictionary()
+
+
+def _state_tensors(module: torch.nn.Module) -> Tuple[Tuple[str, ...], List[torch.Tensor]]:
+    """
+    Returns the keys and the tensors of module.state_dict(). They are listed at the first call for a module, and reused afterwards: the
+    tensors share their memory with the parameters and buffers of the module, which are modified in place. Keys are stripped of the
+    prefix added by torch.compile(), such that a compiled network and an uncompiled network can be matched.
+    """
+    if module not in _state_tensors_cache:
+        state_dict = module.state_dict()
+        # Some modules such as BN have an integer value `num_batches_tracked`, which cannot be combined linearly
+        assert all(value.is_floating_point() for value in state_dict.values()), "Soft scalar update should not happen"
+        keys = tuple(key.removeprefix("_orig_mod.") for key in state_dict)
+        _state_tensors_cache[module] = (keys, list(state_dict.values()))
+    return _state_tensors_cache[module]
+
+
+def _matching_state_tensors(target_link, source_link) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+    target_keys, target_tensors = _state_tensors(target_link)
+    source_keys, source_tensors = _state_tensors(source_link)
+    assert target_keys == source_keys
+    return target_tensors, source_tensors
+
+
+def flatten_parameters(module: torch.nn.Module) -> torch.Tensor:
+    """
+    Moves the parameters of module into one flat contiguous buffer, stored in module._flat_parameters: each parameter becomes a view of
+    the buffer with the same shape, strides and memory format. The Parameter objects are kept, such that optimizers and compiled modules
+    created afterwards use the views. state_dict() then returns views of the same storage, which torch.save() writes contiguously once.
+
+    Must be called once the module was moved to its device and memory format, which would replace the parameters.
+    """
+    named_parameters = list(module.named_parameters())
+    assert len(module.state_dict()) == len(named_parameters), "Only modules whose state_dict() holds parameters only can be flattened"
+    assert len({param.dtype for _, param in named_parameters}) == 1 and len({param.device for _, param in named_parameters}) == 1
+    flat_parameters = torch.empty(
+        sum(param.numel() for _, param in named_parameters), dtype=named_parameters[0][1].dtype, device=named_parameters[0][1].device
+    )
+    layout = []
+    offset = 0
+    with torch.no_grad():
+        for name, param in named_parameters:
+            assert param.is_contiguous() or param.is_contiguous(memory_format=torch.channels_last)
+            view = flat_parameters.as_strided(param.shape, param.stride(), offset)
+            view.copy_(param)
+            param.data = view
+            layout.append((name, tuple(param.shape), param.stride()))
+            offset += param.numel()
+    module._flat_parameters = flat_parameters
+    module._flat_parameters_layout = tuple(layout)
+    return flat_parameters
+
+
+def _matching_flat_parameters(target_link, source_link) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Returns the flat buffers of target_link and source_link if both were flattened with the same layout, None otherwise.
+    """
+    target_module = getattr(target_link, "_orig_mod", target_link)
+    source_module = getattr(source_link, "_orig_mod", source_link)
+    if not (hasattr(target_module, "_flat_parameters") and hasattr(source_module, "_flat_parameters")):
+        return None
+    if target_module._flat_parameters_layout != source_module._flat_parameters_layout:
+        return None
+    return target_module._flat_parameters, source_module._flat_parameters
+
+
+# Adapted from https://github.com/pfnet/pfrl/blob/2ad3d51a7a971f3fe7f2711f024be11642990d61/pfrl/utils/copy_param.py#L37
 def soft_copy_param(target_link, source_link, tau):
     """Soft-copy parameters of a link to another link."""
-    target_dict = target_link.state_dict()
-    source_dict = source_link.state_dict()
-    for k, target_value in target_dict.items():
-        source_value = source_dict[k]
-        if source_value.dtype in [torch.float32, torch.float64, torch.float16]:
-            target_value = linear_combination(target_value, source_value, tau)
-        else:
-            # Scalar type
-            # Some modules such as BN has scalar value `num_batches_tracked`
-            target_dict[k] = source_value
-            assert False, "Soft scalar update should not happen"
+    flat_parameters = _matching_flat_parameters(target_link, source_link)
+    if flat_parameters is not None:
+        foreach_linear_combination([flat_parameters[0]], [flat_parameters[1]], tau)
+    else:
+        foreach_linear_combination(*_matching_state_tensors(target_link, source_link), tau)
 
 
 def custom_weight_decay(target_link, decay_factor):
-    target_dict = target_link.state_dict()
-    for k, target_value in target_dict.items():
-        target_value.mul_(decay_factor)
+    flat_parameters = getattr(getattr(target_link, "_orig_mod", target_link), "_flat_parameters", None)
+    if flat_parameters is not None:
+        flat_parameters.mul_(decay_factor)
+    else:
+        torch._foreach_mul_(_state_tensors(target_link)[1], decay_factor)
+
+
+def copy_param(target_link, source_link):
+    """
+    Copies the parameters of a link to another link, like target_link.load_state_dict(source_link.state_dict()), with multi-tensor
+    kernels, or a single copy if both links were flattened by flatten_parameters(). Used to publish the weights of the online network to
+    the network shared with collectors.
+    """
+    flat_parameters = _matching_flat_parameters(target_link, source_link)
+    with torch.no_grad():
+        if flat_parameters is not None:
+            flat_parameters[0].copy_(flat_parameters[1])
+        else:
+            torch._foreach_copy_(*_matching_state_tensors(target_link, source_link))
 
 
 def from_exponential_schedule(schedule: List[Tuple[int, float]], current_step: int):
@@ -171,3 +258,31 @@ def save_checkpoint(
     torch.save(target_network.state_dict(), checkpoint_dir / "weights2.torch")
     torch.save(optimizer.state_dict(), checkpoint_dir / "optimizer1.torch")
     torch.save(scaler.state_dict(), checkpoint_dir / "scaler.torch")
+
+
+def autocast(device: str) -> torch.amp.autocast:
+    """
+    Mixed precision context for the given device: float16 on GPU, bfloat16 on CPU where float16 matmuls are slow.
+    """
+    device_type = torch.device(device).type
+    return torch.amp.autocast(device_type=device_type, dtype=torch.float16 if device_type == "cuda" else torch.bfloat16)
+
+
+def autocast_dtype(device_type: str) -> Optional[torch.dtype]:
+    """
+    Returns the dtype of the enclosing autocast context for device_type, None outside of autocast.
+    """
+    if hasattr(torch, "get_autocast_dtype"):  # torch >= 2.4
+        return torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else None
+    if device_type == "cuda":
+        return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
+    return torch.get_autocast_cpu_dtype() if torch.is_autocast_cpu_enabled() else None
+
+
+def set_cpu_threads(device: str, n_cpu_threads: int) -> None:
+    """
+    Processes which compute on the CPU use n_cpu_threads threads. Processes which compute on the GPU keep the single thread set in
+    scripts/train.py.
+    """
+    if torch.device(device).type == "cpu":
+        torch.set_num_threads(n_cpu_threads)